@@ -1,20 +1,35 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import logging
 import os
-import pandas as pd
-import astropy.table
-from astropy.table import Table
 
-from swgworkflow.xmlanalysis import parse_configured_xmls
+from swgworkflow import instrumentation, xmlio
+from swgworkflow.configure_manifest import file_hash
 
+# The columns identifying a target (ICD-30) and the directory of the output
+# directory in which the contribution of each field is kept for incremental
+# updates
+KEY_COLUMNS = ('TARGSRVY', 'TARGID', 'PROGTEMP', 'OBSTEMP')
+CONTRIBUTIONS_DIR = 'contributions'
 
-def add_configured_to_catalogues(xml_file_list, target_cat, output_dir,
-                                 overwrite=False):
+
+def _get_output_filename(target_cat, output_dir):
     input_basename_wo_ext = os.path.splitext(os.path.basename(target_cat))[0]
     output_basename_wo_ext = input_basename_wo_ext + '-configured'
     output_file = os.path.join(output_dir, output_basename_wo_ext + '.fits')
+    return output_file
+
+
+def add_configured_to_catalogues(xml_file_list, target_cat, output_dir,
+                                 overwrite=False, parsed_xmls=None,
+                                 max_memory_mb=None):
+    from astropy.table import Table
+
+    from swgworkflow.xmlanalysis import parse_configured_xmls
+
+    output_file = _get_output_filename(target_cat, output_dir)
 
     # If the output file already exists, delete it or continue with the next
     # one
@@ -29,11 +44,43 @@ def add_configured_to_catalogues(xml_file_list, target_cat, output_dir,
                     target_cat, output_file))
             return
 
-    catalog_targets = Table.read(target_cat)
-
     # Parse all the XMLs into pandas dataframes describing the targets and
-    # Summarising the fields
-    summaries, xml_targets = parse_configured_xmls(xml_file_list)
+    # Summarising the fields (unless the caller already did so)
+    if parsed_xmls is None:
+        with instrumentation.phase('parse'):
+            parsed_xmls = parse_configured_xmls(xml_file_list)
+    summaries, xml_targets = parsed_xmls
+
+    if max_memory_mb is not None:
+        annotate_catalogue_chunked(target_cat, output_file, summaries,
+                                   xml_targets, max_memory_mb)
+        return output_file
+
+    with instrumentation.phase('read'):
+        catalog_targets = Table.read(target_cat)
+
+    with instrumentation.phase('join'):
+        catalogue_appended = annotate_catalogue(catalog_targets, summaries,
+                                                xml_targets)
+
+    # Finally write to fits file
+    with instrumentation.phase('write'):
+        catalogue_appended.write(output_file)
+    return output_file
+
+
+def annotate_catalogue(catalog_targets, summaries, xml_targets):
+    """
+    Add the CONFIGURED, ASSIGNED and FIELD_NAME columns to a catalogue in
+    memory.
+
+    :param catalog_targets: the catalogue as an astropy Table
+    :param summaries: the field summaries from parse_configured_xmls
+    :param xml_targets: the targets from parse_configured_xmls
+    :return: the annotated catalogue as a new astropy Table
+    """
+    import astropy.table
+    from astropy.table import Table
 
     # ICD-30 says uniqueness within a targsrvy is enforced on (targid,obstemp,
     # progtemp) so match on these
@@ -91,11 +138,253 @@ def add_configured_to_catalogues(xml_file_list, target_cat, output_dir,
     assert len(catalogue_appended) == len(catalog_targets), \
         'Size mismatch when cross-matching between catalogues'
 
-    # Finally write to fits file
-    catalogue_appended.write(output_file)
-    return output_file
+    return catalogue_appended
+
+
+def annotate_catalogue_chunked(target_cat, output_file, summaries, xml_targets,
+                               max_memory_mb=1024):
+    """
+    Add the CONFIGURED, ASSIGNED and FIELD_NAME columns to a catalogue too
+    big for memory, reading and writing it a chunk of rows at a time.
+
+    The values are the same as those of annotate_catalogue but the rows stay
+    in the order of the input catalogue (the join of annotate_catalogue
+    sorts them by TARGSRVY, TARGID, PROGTEMP and OBSTEMP).
+
+    :param target_cat: the catalogue file
+    :param output_file: the output catalogue file
+    :param summaries: the field summaries from parse_configured_xmls
+    :param xml_targets: the targets from parse_configured_xmls
+    :param max_memory_mb: roughly how much memory the chunks can use [MB]
+    """
+    import pandas as pd
+    from astropy.io import fits
+
+    from swgworkflow import fits_stream
+
+    # The combined contribution of all the fields is the index to annotate
+    # each chunk from
+    index = field_contribution(summaries, xml_targets).set_index(list(KEY_COLUMNS))
+    # The longest FIELD_NAME sets the width of the column, which is 1 if no
+    # target was configured
+    width = max(1, int(index['FIELD_NAME'].str.len().max())) if len(index) > 0 else 1
+
+    reader = fits_stream.TableReader(target_cat)
+    columns = reader.columns + fits.ColDefs([fits.Column('CONFIGURED', 'K'),
+                                             fits.Column('ASSIGNED', 'K'),
+                                             fits.Column('FIELD_NAME', '{}A'.format(width))])
+    # Written to a temporary file, so a run that dies partway through doesn't
+    # leave a truncated output that the next run would skip
+    with fits_stream.atomic_output(output_file) as tmp_file, \
+            fits_stream.TableWriter(tmp_file, columns, reader.n_rows, header=reader.header,
+                                    primary_header=reader.primary_header) as writer:
+        n_rows = fits_stream.chunk_rows(writer.dtype.itemsize, max_memory_mb)
+        for _, chunk in reader.iter_chunks(n_rows):
+            with instrumentation.phase('read'):
+                records = writer.empty(len(chunk))
+                for name in chunk.dtype.names:
+                    records[name] = chunk[name]
+
+            with instrumentation.phase('join'):
+                # TODO same fix as in annotate_catalogue
+                progtemp = fits_stream.decoded_column(chunk, 'PROGTEMP')
+                records['PROGTEMP'][progtemp == '11331+'] = b'11331.1+'
+                keys = pd.MultiIndex.from_arrays(
+                    [fits_stream.decoded_column(records, column) for column in KEY_COLUMNS])
+                values = index.reindex(keys)
+                records['CONFIGURED'] = values['CONFIGURED'].fillna(0).to_numpy(dtype=int)
+                records['ASSIGNED'] = values['ASSIGNED'].fillna(0).to_numpy(dtype=int)
+                records['FIELD_NAME'] = values['FIELD_NAME'].fillna('').to_numpy(dtype=str)
+
+            with instrumentation.phase('write'):
+                writer.write(records)
+
+
+def field_contribution(summary, xml_targets):
+    """
+    What one configured field adds to CONFIGURED, ASSIGNED and FIELD_NAME of
+    each target, so that annotations can be updated a field at a time.
+
+    :param summary: the summary of the field from parse_configured_xml
+    :param xml_targets: the targets of the field from parse_configured_xml
+    :return: a pandas DataFrame with the KEY_COLUMNS, CONFIGURED, ASSIGNED and
+        FIELD_NAME of each target in the field
+    """
+    keys = ['targsrvy', 'targid', 'progtemp', 'obstemp']
+    extra_columns = summary[['field_name', 'progtemp', 'obstemp']]
+    xml_targets = xml_targets.merge(extra_columns, on=['field_name'],
+                                    how='left')
+    xml_targets = xml_targets.dropna(subset=keys)
+    contribution = xml_targets.groupby(keys, sort=False).agg(
+        CONFIGURED=('assigned', 'size'), ASSIGNED=('assigned', 'sum'),
+        FIELD_NAME=('field_name', '|'.join)).reset_index()
+    contribution.rename(columns=dict(zip(keys, KEY_COLUMNS)), inplace=True)
+    contribution['ASSIGNED'] = contribution['ASSIGNED'].astype(int)
+    return contribution
+
+
+def _contribution_file(xml_name, xml_hash, contributions_dir):
+    # The contributions are kept by the hash of their xml so that the
+    # contribution of the previous version of a field is still there after
+    # it has been configured again
+    return os.path.join(contributions_dir, '{}-{}.csv'.format(
+        xmlio.xml_basename_wo_ext(xml_name), xml_hash[:16]))
+
+
+def _read_contribution(contribution_file):
+    import pandas as pd
+
+    return pd.read_csv(contribution_file, keep_default_na=False,
+                       dtype={column: str for column in KEY_COLUMNS + ('FIELD_NAME',)})
+
+
+def _write_contribution(contribution, contribution_file):
+    contribution.to_csv(contribution_file + '.tmp', index=False)
+    os.replace(contribution_file + '.tmp', contribution_file)
+
+
+def _aggregate_contributions(contributions):
+    # Combine contributions (in the order of the xmls) as annotate_catalogue
+    # does for all the xmls together
+    import pandas as pd
+
+    # An empty frame keeps the columns when there are no fields at all
+    df = pd.concat([pd.DataFrame(columns=list(KEY_COLUMNS) + ['CONFIGURED', 'ASSIGNED', 'FIELD_NAME'])] +
+                   contributions, ignore_index=True)
+    # The longest FIELD_NAME of any target sets the width of the column
+    df['_length'] = df['FIELD_NAME'].str.len() + 1
+    return df.groupby(list(KEY_COLUMNS), sort=False).agg(
+        CONFIGURED=('CONFIGURED', 'sum'), ASSIGNED=('ASSIGNED', 'sum'),
+        FIELD_NAME=('FIELD_NAME', '|'.join), _length=('_length', 'sum'))
+
+
+def _patch_catalogue(catalogue, aggregated, affected_keys):
+    """Recompute CONFIGURED, ASSIGNED and FIELD_NAME for the rows of an
+    annotated catalogue with affected_keys from the aggregated contributions
+    of all the fields."""
+    import numpy as np
+    import pandas as pd
+    from astropy.table import MaskedColumn
+
+    catalogue_keys = pd.MultiIndex.from_arrays(
+        [np.asarray(catalogue[column]).astype(str) for column in KEY_COLUMNS])
+    rows = np.nonzero(catalogue_keys.isin(affected_keys))[0]
+    values = aggregated.reindex(catalogue_keys[rows])
+    configured = values['CONFIGURED'].notna().to_numpy()
+
+    catalogue['CONFIGURED'][rows] = values['CONFIGURED'].fillna(0).to_numpy(dtype=int)
+    catalogue['ASSIGNED'][rows] = values['ASSIGNED'].fillna(0).to_numpy(dtype=int)
+
+    width = int(aggregated['_length'].max()) - 1 if len(aggregated) > 0 else 1
+    field_name = MaskedColumn(catalogue['FIELD_NAME'])
+    field_name_data = field_name.filled('').astype('U{}'.format(width))
+    field_name_data[rows] = values['FIELD_NAME'].fillna('').to_numpy()
+    mask = np.array(field_name.mask)
+    mask[rows] = ~configured
+    catalogue['FIELD_NAME'] = MaskedColumn(field_name_data, mask=mask)
+    return len(rows)
+
 
+def update_configured_catalogue(xml_file_list, target_cat, output_dir, overwrite=False):
+    """
+    Add the configured information to a catalogue, updating the output of a
+    previous run rather than starting again when only some of the fields
+    have changed.
 
+    The contribution of each field to every target is kept in
+    output_dir/contributions. When some fields have been configured again
+    (or added or removed) only the rows of the targets in those fields are
+    recomputed, from the contributions, and the result is identical to that
+    of add_configured_to_catalogues. If there is no previous output, or the
+    catalogue or the order of the fields has changed, the catalogue is
+    annotated from scratch.
+
+    :param xml_file_list: the configured xmls
+    :param target_cat: the catalogue
+    :param output_dir: the directory containing the output catalogue
+    :param overwrite: annotate the catalogue and compute the contributions
+        from scratch even if there is a previous output
+    :return: the output file
+    """
+    import pandas as pd
+    from astropy.table import Table
+
+    from swgworkflow.xmlanalysis import parse_configured_xml
+
+    output_file = _get_output_filename(target_cat, output_dir)
+    state_file = os.path.splitext(output_file)[0] + '.state.json'
+    contributions_dir = os.path.join(output_dir, CONTRIBUTIONS_DIR)
+    os.makedirs(contributions_dir, exist_ok=True)
+
+    with instrumentation.phase('hash'):
+        fields = [(os.path.basename(xml_file), file_hash(xml_file)) for xml_file in xml_file_list]
+        catalogue_hash = file_hash(target_cat)
+    contribution_files = [_contribution_file(name, xml_hash, contributions_dir) for name, xml_hash in fields]
+
+    previous_fields = None
+    if overwrite:
+        logging.info('Annotating {} from scratch'.format(target_cat))
+    elif os.path.exists(output_file) and os.path.exists(state_file):
+        with open(state_file) as fd:
+            previous = json.load(fd)
+        previous_fields = [tuple(field) for field in previous['fields']]
+        names, previous_names = dict(fields), dict(previous_fields)
+        if previous['catalogue_hash'] != catalogue_hash:
+            logging.info('{} has changed, annotating it from scratch'.format(target_cat))
+            previous_fields = None
+        elif ([name for name, _ in fields if name in previous_names] !=
+              [name for name, _ in previous_fields if name in names]):
+            logging.info('The order of the fields has changed, annotating {} from scratch'.format(target_cat))
+            previous_fields = None
+        elif not all(os.path.exists(_contribution_file(name, xml_hash, contributions_dir))
+                     for name, xml_hash in set(previous_fields) - set(fields)):
+            logging.info('The contributions of the previous fields are missing, annotating {} from scratch'.format(
+                target_cat))
+            previous_fields = None
+
+    if previous_fields is None:
+        # Annotate from scratch exactly as add_configured_to_catalogues does,
+        # keeping the contribution of each field for next time
+        summaries, xml_targets = [], []
+        with instrumentation.phase('parse'):
+            for xml_file, contribution_file in zip(xml_file_list, contribution_files):
+                summary, targets = parse_configured_xml(xml_file)
+                summaries.append(summary)
+                xml_targets.append(targets)
+                if overwrite or not os.path.exists(contribution_file):
+                    _write_contribution(field_contribution(summary, targets), contribution_file)
+        with instrumentation.phase('read'):
+            catalogue = Table.read(target_cat)
+        with instrumentation.phase('join'):
+            catalogue = annotate_catalogue(catalogue, pd.concat(summaries), pd.concat(xml_targets))
+    else:
+        # Only the fields that are new or were configured again need parsing
+        changed_fields = set(fields).symmetric_difference(previous_fields)
+        logging.info('{} fields are new or were configured again and {} were removed since {} was written'.format(
+            len(set(fields) - set(previous_fields)),
+            len(set(dict(previous_fields)) - set(dict(fields))), output_file))
+        with instrumentation.phase('parse'):
+            for xml_file, field, contribution_file in zip(xml_file_list, fields, contribution_files):
+                if not os.path.exists(contribution_file):
+                    _write_contribution(field_contribution(*parse_configured_xml(xml_file)), contribution_file)
+            contributions = [_read_contribution(contribution_file) for contribution_file in contribution_files]
+            # The targets the changed fields had before and have now
+            changed = [_read_contribution(_contribution_file(name, xml_hash, contributions_dir))
+                       for name, xml_hash in changed_fields]
+        with instrumentation.phase('read'):
+            catalogue = Table.read(output_file)
+        with instrumentation.phase('join'):
+            affected_keys = pd.MultiIndex.from_frame(
+                pd.concat(changed + [pd.DataFrame(columns=list(KEY_COLUMNS))])[list(KEY_COLUMNS)])
+            n_rows = _patch_catalogue(catalogue, _aggregate_contributions(contributions), affected_keys)
+        logging.info('Updated {} rows of {}'.format(n_rows, output_file))
+
+    with instrumentation.phase('write'):
+        catalogue.write(output_file, overwrite=True)
+    with open(state_file, 'w') as fd:
+        json.dump({'catalogue': os.path.abspath(target_cat), 'catalogue_hash': catalogue_hash,
+                   'fields': fields}, fd, indent=1)
+    return output_file
 
 
 if __name__ == '__main__':
@@ -117,21 +406,58 @@ if __name__ == '__main__':
     parser.add_argument('--overwrite', action='store_true',
                         help='overwrite the output files')
 
+    parser.add_argument('--max_memory', default=None, type=float,
+                        help='stream the catalogues in chunks of rows using '
+                             'about this much memory [MB] rather than '
+                             'reading them whole')
+
+    parser.add_argument('--incremental', action='store_true',
+                        help='update existing output catalogues for the '
+                             'fields that have changed since they were '
+                             'written rather than skipping them (with '
+                             '--overwrite they are annotated from scratch). '
+                             'Can\'t be used with --max_memory')
+
     parser.add_argument('--log_level', default='info',
                         choices=['debug', 'info', 'warning', 'error'],
                         help='the level for the logging messages')
 
+    instrumentation.add_metrics_argument(parser)
+
     args = parser.parse_args()
 
+    if args.incremental and args.max_memory is not None:
+        # The update reads the previous output whole
+        parser.error('--incremental can\'t be used with --max_memory')
+
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
+    metrics = instrumentation.start_stage('add-configured-to-catalogues',
+                                          args.metrics)
+
     if not os.path.exists(args.output_dir):
         logging.info('Creating the output directory')
         os.mkdir(args.output_dir)
 
-    for target_cat in args.catalogues:
-        # Clean after adding the last catalogue if we were asked to
-        add_configured_to_catalogues(xml_file_list=args.xml_file,
-                                     target_cat=target_cat,
-                                     output_dir=args.output_dir,
-                                     overwrite=args.overwrite)
+    if args.incremental:
+        for target_cat in args.catalogues:
+            update_configured_catalogue(args.xml_file, target_cat,
+                                        args.output_dir,
+                                        overwrite=args.overwrite)
+    else:
+        from swgworkflow.xmlanalysis import parse_configured_xmls
+
+        # The xmls are the same for every catalogue so only parse them once
+        with instrumentation.phase('parse'):
+            parsed_xmls = parse_configured_xmls(args.xml_file)
+
+        for target_cat in args.catalogues:
+            # Clean after adding the last catalogue if we were asked to
+            add_configured_to_catalogues(xml_file_list=args.xml_file,
+                                         target_cat=target_cat,
+                                         output_dir=args.output_dir,
+                                         overwrite=args.overwrite,
+                                         parsed_xmls=parsed_xmls,
+                                         max_memory_mb=args.max_memory)
+
+    metrics.finish()
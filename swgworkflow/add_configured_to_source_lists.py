@@ -1,31 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import json
 import logging
+import multiprocessing
 import os
 import numpy as np
-import pandas as pd
-import astropy.table
-from astropy.table import Table
 
-from swgworkflow.xmlanalysis import parse_configured_xmls
+from swgworkflow import instrumentation
 
+# The columns copied from the configured catalogues to the source lists, and
+# their values for sources that were never targeted
+NEW_COLUMNS = ('GA_TARGBITS', 'TARGPROG', 'TARGPRIO', 'CONFIGURED',
+               'ASSIGNED')
+DEFAULT_VALUES = (0, 40*' ', 0.0, 0, 0)
 
-def _match_masked_columns(col1, col2, mask1=None, mask2=None):
-    if mask1 is None:
-        mask1 = np.zeros(col1.shape, dtype=bool)
-    if mask2 is None:
-        mask2 = np.zeros(col2.shape, dtype=bool)
+# The keys sources are matched to targets on, in order: the Gaia ID of the
+# sources that have one (GAIA_REV_ID != 0), otherwise their PS1 ID. Each is
+# (target column, source column).
+MATCH_KEYS = (('GAIA_ID', 'SOURCE_ID'), ('PS_ID', 'PS1_ID'))
 
-    good_col1_values = col1[~mask1]
-    good_col1_idx = np.nonzero(~mask1)[0]
-    good_col2_values = col2[~mask2]
-    good_col2_idx = np.nonzero(~mask2)[0]
-    _, col1_ind_unmasked, col2_ind_unmasked = np.intersect1d(
-        good_col1_values, good_col2_values, return_indices=True)
-    col1_idx = good_col1_idx[col1_ind_unmasked]
-    col2_idx = good_col2_idx[col2_ind_unmasked]
-    return col1_idx, col2_idx
+# The columns of the optional positional match of the sources left unmatched
+# by MATCH_KEYS, and those used to move the targets to the epoch of the
+# source lists
+POSITION_COLUMNS = ('GAIA_RA', 'GAIA_DEC')
+PROPER_MOTION_COLUMNS = ('GAIA_PMRA', 'GAIA_PMDEC')
+EPOCH_COLUMN = 'GAIA_EPOCH'
 
 
 def _unmask_column(table, column):
@@ -39,16 +41,286 @@ def _unmask_column(table, column):
     return unmasked_column, mask
 
 
-def _match_source_to_target_lists(target_list, target_column_name, source_list,
-                                  source_column_name, source_list_mask=None):
-
-    target_column, target_mask = _unmask_column(target_list, target_column_name)
-    source_column, source_mask = _unmask_column(source_list, source_column_name)
-
-    target_ind, source_ind = _match_masked_columns(
-        col1=target_column, col2=source_column,
-        mask1=target_mask, mask2=source_mask)
-    return target_ind, source_ind
+def _source_key_masks(gaia_rev_id):
+    # Which sources each of MATCH_KEYS applies to. Sources without a Gaia
+    # revision (including a masked one) fall back to PS1.
+    if hasattr(gaia_rev_id, 'mask'):
+        gaia_rev_id = np.ma.filled(gaia_rev_id, 0)
+    has_gaia = np.asarray(gaia_rev_id) != 0
+    return {'SOURCE_ID': has_gaia, 'PS1_ID': ~has_gaia}
+
+
+def source_key_index(source_columns, key_masks):
+    """
+    Sort the keys of a source list once, so that it can be matched to any
+    number of target catalogues with match_to_source_keys.
+
+    :param source_columns: a dictionary from each source column of
+        MATCH_KEYS to a tuple of its values and mask (or None)
+    :param key_masks: a dictionary from each source column of MATCH_KEYS to
+        the rows it applies to (see _source_key_masks)
+    :return: a list with, for each of MATCH_KEYS, a tuple of the target
+        column, source column, the sorted keys and the row of each
+    """
+    index = []
+    for target_column, source_column in MATCH_KEYS:
+        values, mask = source_columns[source_column]
+        values = np.asarray(values)
+        usable = key_masks[source_column]
+        if mask is not None:
+            usable = usable & ~np.asarray(mask)
+        rows = np.nonzero(usable)[0]
+        # A stable sort, so a key repeated in the source list matches its
+        # first row
+        order = np.argsort(values[rows], kind='stable')
+        index.append((target_column, source_column, values[rows][order],
+                      rows[order]))
+    return index
+
+
+def match_to_source_keys(index, target_columns, n_sources):
+    """
+    Match the targets of a catalogue to a source list, working down
+    MATCH_KEYS: each key only considers the sources that no earlier key
+    matched.
+
+    :param index: the source list from source_key_index
+    :param target_columns: a dictionary from each target column of
+        MATCH_KEYS to a tuple of its values and mask (or None)
+    :param n_sources: the number of rows of the source list
+    :return: a tuple of the matched target rows, the matched source rows
+        and a dictionary of how many sources each key matched
+    """
+    matched = np.zeros(n_sources, dtype=bool)
+    target_ind = []
+    source_ind = []
+    counts = {}
+    for target_column, source_column, sorted_keys, sorted_rows in index:
+        values, mask = target_columns[target_column]
+        values = np.asarray(values)
+        if mask is None:
+            good = np.arange(len(values))
+        else:
+            good = np.nonzero(~np.asarray(mask))[0]
+        # The first target with each key
+        keys, first = np.unique(values[good], return_index=True)
+        position = np.searchsorted(sorted_keys, keys)
+        found = position < len(sorted_keys)
+        found[found] = sorted_keys[position[found]] == keys[found]
+        targets = good[first[found]]
+        sources = sorted_rows[position[found]]
+
+        unmatched = ~matched[sources]
+        targets, sources = targets[unmatched], sources[unmatched]
+        matched[sources] = True
+        target_ind.append(targets)
+        source_ind.append(sources)
+        counts['{}->{}'.format(target_column, source_column)] = len(sources)
+    return np.concatenate(target_ind), np.concatenate(source_ind), counts
+
+
+def _float_column(table, column, fill_value=np.nan):
+    # The values of a numerical column as floats, with masked entries filled
+    return np.ma.filled(np.ma.asarray(table[column]).astype(float), fill_value)
+
+
+def _epoch_column(table):
+    # GAIA_EPOCH is text in the catalogue templates. Missing epochs are NaN.
+    values = np.ma.asarray(table[EPOCH_COLUMN])
+    if values.dtype.kind not in 'SU':
+        return np.ma.filled(values.astype(float), np.nan)
+    values = np.char.strip(np.ma.filled(values, '').astype(str))
+    epochs = np.full(len(values), np.nan)
+    known = values != ''
+    epochs[known] = values[known].astype(float)
+    return epochs
+
+
+def propagate_positions(ra, dec, pmra, pmdec, epoch, to_epoch):
+    """
+    Move positions to another epoch with their proper motions. The motion is
+    taken to be linear, which is plenty for matching over a few years.
+
+    :param ra: right ascension [deg]
+    :param dec: declination [deg]
+    :param pmra: proper motion in right ascension, including cos(dec)
+        [mas/yr]
+    :param pmdec: proper motion in declination [mas/yr]
+    :param epoch: the epoch of the positions [yr] (NaN for unknown, which
+        leaves the position as it is)
+    :param to_epoch: the epoch to move them to [yr]
+    :return: a tuple of the right ascension and declination at to_epoch
+    """
+    dt = np.nan_to_num(to_epoch - np.asarray(epoch, dtype=float))
+    pmra = np.nan_to_num(np.asarray(pmra, dtype=float))
+    pmdec = np.nan_to_num(np.asarray(pmdec, dtype=float))
+    mas = 1 / 3.6e6
+    new_dec = dec + pmdec * dt * mas
+    new_ra = (ra + pmra * dt * mas / np.cos(np.radians(dec))) % 360
+    return new_ra, new_dec
+
+
+def _target_unit_vectors(target_list, name, match_epoch=None):
+    # The unit vectors of the positions of the targets at match_epoch, NaN
+    # for targets without a position
+    from swgworkflow.partition_catalogues import _unit_vectors
+
+    ra = _float_column(target_list, POSITION_COLUMNS[0])
+    dec = _float_column(target_list, POSITION_COLUMNS[1])
+    if match_epoch is not None:
+        columns = PROPER_MOTION_COLUMNS + (EPOCH_COLUMN,)
+        if all(column in target_list.columns for column in columns):
+            ra, dec = propagate_positions(
+                ra, dec, _float_column(target_list, PROPER_MOTION_COLUMNS[0]),
+                _float_column(target_list, PROPER_MOTION_COLUMNS[1]),
+                _epoch_column(target_list), match_epoch)
+        else:
+            logging.warning('{} has no {}, so its positions are matched at '
+                            'their own epoch'.format(name, ', '.join(columns)))
+    return _unit_vectors(ra, dec)
+
+
+def match_positions(target_positions, target_available, source_ra,
+                    source_dec, source_available, radius):
+    """
+    Match sources to targets by position: each source is matched to the
+    nearest target within radius, and where several sources are nearest to
+    the same target only the closest of them is matched.
+
+    The available targets are put in a KD-tree of unit vectors and all the
+    sources are queried at once for their two nearest targets, the second
+    telling whether the match was ambiguous.
+
+    :param target_positions: the unit vectors of the targets (NaN for those
+        without a position)
+    :param target_available: which targets can be matched
+    :param source_ra: right ascension of the sources [deg]
+    :param source_dec: declination of the sources [deg]
+    :param source_available: which sources can be matched
+    :param radius: the match radius [arcsec]
+    :return: a tuple of the matched target rows, the matched source rows and
+        a dictionary with how many of the available sources with a position
+        (candidates) were matched to the only target within radius (unique) or
+        to the nearest of several (ambiguous), lost a target to a closer source
+        (conflicts) or had no target within radius (unmatched)
+    """
+    from scipy.spatial import cKDTree
+
+    from swgworkflow.partition_catalogues import _unit_vectors
+
+    source_ra = np.asarray(source_ra, dtype=float)
+    source_dec = np.asarray(source_dec, dtype=float)
+    targets = np.nonzero(target_available &
+                         np.all(np.isfinite(target_positions), axis=1))[0]
+    sources = np.nonzero(source_available & np.isfinite(source_ra) &
+                         np.isfinite(source_dec))[0]
+    stats = {'candidates': len(sources), 'unique': 0, 'ambiguous': 0,
+             'conflicts': 0, 'unmatched': len(sources)}
+    if len(targets) == 0 or len(sources) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), stats
+
+    # chord length between two unit vectors separated by radius
+    chord = 2 * np.sin(np.radians(radius / 3600) / 2)
+    distance, nearest = cKDTree(target_positions[targets]).query(
+        _unit_vectors(source_ra[sources], source_dec[sources]), k=2,
+        distance_upper_bound=chord)
+    found = np.isfinite(distance[:, 0])
+    ambiguous = np.isfinite(distance[found, 1])
+    sources = sources[found]
+    distance = distance[found, 0]
+    nearest = targets[nearest[found, 0]]
+
+    # The closest source to each target
+    order = np.lexsort((distance, nearest))
+    closest = np.ones(len(order), dtype=bool)
+    closest[1:] = nearest[order[1:]] != nearest[order[:-1]]
+    keep = np.sort(order[closest])
+
+    stats['unique'] = int(np.sum(~ambiguous[keep]))
+    stats['ambiguous'] = int(np.sum(ambiguous[keep]))
+    stats['conflicts'] = len(sources) - len(keep)
+    stats['unmatched'] = int(np.sum(~found))
+    return nearest[keep], sources[keep], stats
+
+
+def match_to_catalogues(index, targets, n_sources, source_ra=None,
+                        source_dec=None, match_radius=None):
+    """
+    Match target catalogues to a source list with match_to_source_keys and,
+    if match_radius is given, match the sources and targets left over by
+    position with match_positions.
+
+    Every catalogue is matched by ID before any is matched by position, and
+    only the sources that no catalogue matched by ID are matched by
+    position, so that a position never overrides the ID match of a source to
+    another catalogue.
+
+    :param index: the source list from source_key_index
+    :param targets: the TargetCatalogues, with positions if match_radius is
+        given
+    :param n_sources: the number of rows of the source list
+    :param source_ra: right ascension of the sources [deg]
+    :param source_dec: declination of the sources [deg]
+    :param match_radius: the radius of the positional match [arcsec], or None
+        to match on the IDs alone
+    :return: a list with, for each catalogue, a tuple of the matched target
+        rows, the matched source rows, a dictionary of how many sources each
+        key (and 'position') matched and the statistics of match_positions
+        (None without match_radius)
+    """
+    id_matches = [match_to_source_keys(index, target.id_columns, n_sources)
+                  for target in targets]
+    if match_radius is None:
+        return [(target_ind, source_ind, counts, None)
+                for target_ind, source_ind, counts in id_matches]
+
+    source_available = np.ones(n_sources, dtype=bool)
+    for _, source_ind, _ in id_matches:
+        source_available[source_ind] = False
+    matches = []
+    for target, (target_ind, source_ind, counts) in zip(targets, id_matches):
+        assert target.positions is not None, \
+            '{} was loaded without its positions'.format(target.name)
+        target_available = np.ones(len(target.positions), dtype=bool)
+        target_available[target_ind] = False
+        position_targets, position_sources, stats = match_positions(
+            target.positions, target_available, source_ra, source_dec,
+            source_available, match_radius)
+        counts['position'] = len(position_sources)
+        matches.append((np.concatenate([target_ind, position_targets]),
+                        np.concatenate([source_ind, position_sources]),
+                        counts, stats))
+    return matches
+
+
+def _add_counts(total, counts):
+    for key, n in counts.items():
+        total[key] = total.get(key, 0) + n
+
+
+def _match_stats_filename(output_file):
+    return os.path.splitext(output_file)[0] + '-match.json'
+
+
+def _write_match_stats(output_file, source_file, match_radius, match_epoch,
+                       target_lists, match_counts, position_stats):
+    # The statistics of the match to each catalogue, next to the output
+    stats = {'source_list': source_file,
+             'match_radius': match_radius,
+             'match_epoch': match_epoch,
+             'catalogues': [{'catalogue': target.name,
+                             'matched': counts,
+                             'position': stats}
+                            for target, counts, stats in zip(
+                                target_lists, match_counts, position_stats)]}
+    with open(_match_stats_filename(output_file), 'w') as fd:
+        json.dump(stats, fd, indent=2)
+
+
+def _log_match_counts(target_cat, source_file, counts):
+    logging.info('Matched {} sources of {} to {} ({})'.format(
+        sum(counts.values()), source_file, target_cat,
+        ', '.join('{} by {}'.format(n, key) for key, n in counts.items())))
 
 
 def _get_output_filename(source_file, output_dir,
@@ -75,9 +347,208 @@ def _check_output_file(output_file, overwrite=False):
     return True
 
 
+def _read_target_catalogue(target_cat):
+    # Target catalogues can be passed either as a filename or as an already
+    # loaded table (e.g. from the in-process pipeline)
+    from astropy.table import Table
+
+    if isinstance(target_cat, str):
+        return target_cat, Table.read(target_cat)
+    return target_cat.meta.get('FILENAME', 'in-memory catalogue'), target_cat
+
+
+# A target catalogue ready to be matched to source lists: its name, a table of
+# the columns to copy, the (unmasked values, mask) of each ID column and the
+# unit vectors of its positions (None unless loaded for a positional match)
+TargetCatalogue = collections.namedtuple(
+    'TargetCatalogue', ['name', 'table', 'id_columns', 'positions'])
+
+
+def load_target_catalogue(target_cat, new_columns, positions=False,
+                          match_epoch=None):
+    """
+    Read a target catalogue once for any number of source lists, keeping only
+    new_columns and the ID columns of MATCH_KEYS.
+
+    :param target_cat: a filename, a table or an already loaded
+        TargetCatalogue (which is returned as it is)
+    :param new_columns: the columns that will be copied to the source lists
+    :param positions: also keep the positions of the targets, for
+        match_positions
+    :param match_epoch: the epoch of the positions of the source lists, to
+        move the targets to with their proper motions (None to use the
+        positions as they are)
+    :return: a TargetCatalogue
+    """
+    if isinstance(target_cat, TargetCatalogue):
+        return target_cat
+    name, target_list = _read_target_catalogue(target_cat)
+
+    # Check the requested columns actually exist in the target catalogue
+    for column in new_columns:
+        assert column in target_list.columns, \
+            "Didn't find {} in {}. ".format(column, name)
+
+    target_positions = None
+    if positions:
+        target_positions = _target_unit_vectors(target_list, name, match_epoch)
+
+    # A copy, so the table of the caller isn't changed by _unmask_column
+    target_list = target_list[list(new_columns) +
+                              [column for column, _ in MATCH_KEYS]]
+    return TargetCatalogue(name, target_list,
+                           {column: _unmask_column(target_list, column)
+                            for column, _ in MATCH_KEYS},
+                           target_positions)
+
+
+def _fits_format(default):
+    # The FITS format of a new column, matching the type the column gets
+    # from its default value in add_columns_to_source_list
+    if isinstance(default, str):
+        return '{}A'.format(len(default))
+    if isinstance(default, float):
+        return 'D'
+    return 'K'
+
+
+def _fits_text(values, default):
+    # The bytes astropy writes to FITS for text in a column of the type of
+    # default: cut to the width of default and without trailing spaces, except
+    # that text of only spaces keeps one, padded with NULs. The characters are
+    # handled as an array of codes, as np.char is slow for large chunks.
+    width = len(default)
+    text = np.ascontiguousarray(values, dtype='U{}'.format(width))
+    codes = text.view(np.uint32).reshape(len(text), width)
+    if np.any(codes > 127):
+        raise ValueError('Only ASCII text can be written to FITS')
+    blank = (codes == ord(' ')) | (codes == 0)
+    # Everything up to the last character that isn't a space or NUL is kept
+    length = width - np.argmin(blank[:, ::-1], axis=1)
+    length[np.all(blank, axis=1)] = 0
+    keep = np.arange(width) < length[:, np.newaxis]
+    keep[:, 0] |= codes[:, 0] == ord(' ')
+    return np.where(keep, codes, 0).astype(np.uint8).view(
+        'S{}'.format(width)).reshape(len(text))
+
+
+def _add_columns_to_source_list_chunked(source_file, target_cats, output_file,
+                                        new_columns, default_values,
+                                        max_memory_mb=1024, match_radius=None,
+                                        match_epoch=None):
+    # The same as add_columns_to_source_list but streaming the source list a
+    # chunk of rows at a time, with only the (much smaller) target catalogues
+    # in memory. Each chunk is matched on its own, so a target can match a
+    # source in more than one chunk (by ID or by position).
+    from astropy.io import fits
+
+    from swgworkflow import fits_stream
+
+    with instrumentation.phase('read'):
+        target_lists = [load_target_catalogue(target_cat, new_columns,
+                                              positions=match_radius is not None,
+                                              match_epoch=match_epoch)
+                        for target_cat in target_cats]
+    match_counts = [{} for _ in target_lists]
+    position_stats = [{} for _ in target_lists]
+
+    reader = fits_stream.TableReader(source_file)
+    columns = reader.columns + fits.ColDefs(
+        [fits.Column(column, _fits_format(default))
+         for column, default in zip(new_columns, default_values)])
+    with fits_stream.atomic_output(output_file) as tmp_file, \
+            fits_stream.TableWriter(tmp_file, columns, reader.n_rows,
+                                    header=reader.header,
+                                    primary_header=reader.primary_header) as writer:
+        n_rows = fits_stream.chunk_rows(writer.dtype.itemsize, max_memory_mb)
+        for _, chunk in reader.iter_chunks(n_rows):
+            with instrumentation.phase('read'):
+                records = writer.empty(len(chunk))
+                for name in chunk.dtype.names:
+                    records[name] = chunk[name]
+                for column, default in zip(new_columns, default_values):
+                    if isinstance(default, str):
+                        default = _fits_text([default], default)[0]
+                    records[column] = default
+                source_columns = {}
+                for _, column in MATCH_KEYS:
+                    mask = fits_stream.null_mask(reader.columns, chunk, column)
+                    values = fits_stream.column_values(reader.columns, chunk,
+                                                       column)
+                    source_columns[column] = (np.where(mask, 0, values), mask)
+                gaia_rev_id = fits_stream.column_values(reader.columns, chunk,
+                                                        'GAIA_REV_ID')
+                gaia_rev_id = np.where(
+                    fits_stream.null_mask(reader.columns, chunk, 'GAIA_REV_ID'),
+                    0, gaia_rev_id)
+                source_ra = source_dec = None
+                if match_radius is not None:
+                    source_ra, source_dec = [
+                        fits_stream.column_values(reader.columns, chunk, column)
+                        for column in POSITION_COLUMNS]
+
+            with instrumentation.phase('match'):
+                index = source_key_index(source_columns,
+                                         _source_key_masks(gaia_rev_id))
+                matches = match_to_catalogues(index, target_lists, len(chunk),
+                                              source_ra, source_dec,
+                                              match_radius)
+            for target, counts, stats, (target_ind, source_ind, chunk_counts,
+                                        chunk_stats) in zip(
+                    target_lists, match_counts, position_stats, matches):
+                _add_counts(counts, chunk_counts)
+                if chunk_stats is not None:
+                    _add_counts(stats, chunk_stats)
+
+                for column, default in zip(new_columns, default_values):
+                    values = np.asarray(target.table[column][target_ind])
+                    if isinstance(default, str):
+                        values = _fits_text(values.astype(str), default)
+                        default = _fits_text([default], default)[0]
+                    if np.any(records[column][source_ind] != default):
+                        msg = "Found ambiguous matches from catalogue {} to " \
+                              "source list {}. This may happen if two surveys " \
+                              "target the same object.".format(target.name,
+                                                               source_file)
+                        logging.warning(msg)
+                    records[column][source_ind] = values
+
+            with instrumentation.phase('write'):
+                writer.write(records)
+
+    for target, counts in zip(target_lists, match_counts):
+        _log_match_counts(target.name, source_file, counts)
+    if match_radius is not None:
+        _write_match_stats(output_file, source_file, match_radius, match_epoch,
+                           target_lists, match_counts, position_stats)
+    return output_file
+
+
 def add_columns_to_source_list(source_file, target_cats, output_dir,
                                new_columns, default_values, suffix,
-                               overwrite=False):
+                               overwrite=False, max_memory_mb=None,
+                               match_radius=None, match_epoch=None):
+    """
+    Copy new_columns from the target catalogues to the sources of a source
+    list they match (see match_to_catalogues), and write the result to
+    output_dir.
+
+    With match_radius, the statistics of the matches are written to a
+    -match.json file next to the output.
+
+    :param source_file: the source list
+    :param target_cats: the target catalogues (filenames, tables or
+        TargetCatalogues)
+    :param max_memory_mb: stream the source list using about this much memory
+        rather than reading it whole
+    :param match_radius: also match the sources and targets left unmatched by
+        their IDs by position, within this radius [arcsec]
+    :param match_epoch: the epoch of the positions of the source list [yr]
+    :return: the output file, or None if it already existed
+    """
+    from astropy.table import Table
+
+    from swgworkflow import fits_stream
 
     output_file = _get_output_filename(source_file, output_dir, suffix=suffix)
 
@@ -86,37 +557,49 @@ def add_columns_to_source_list(source_file, target_cats, output_dir,
     if not _check_output_file(output_file, overwrite):
         return
 
+    # Source lists that may not fit in memory are streamed
+    if max_memory_mb is not None:
+        return _add_columns_to_source_list_chunked(
+            source_file, target_cats, output_file, new_columns,
+            default_values, max_memory_mb=max_memory_mb,
+            match_radius=match_radius, match_epoch=match_epoch)
+
     # Read the source list and add our new columns
-    source_list = Table.read(source_file)
+    with instrumentation.phase('read'):
+        source_list = Table.read(source_file)
     for column, default in zip(new_columns, default_values):
         source_list[column] = default
 
-    for target_cat in target_cats:
-        target_list = Table.read(target_cat)
-
-        # Check the requested columns actually exist in the target catalogue
-        for column in new_columns:
-            assert column in target_list.columns, \
-                "Didn't find {} in {}. ".format(column, target_cat)
-
-        # Get indexes of rows where GAIA_ID matches
-        # We need to match only the good, non-masked entries in the target list
-        target_column_name, source_column_name = 'GAIA_ID', 'SOURCE_ID'
-        source_list_mask = (source_list['GAIA_REV_ID'] != 0)
-        target_ind_gaia, source_ind_gaia = _match_source_to_target_lists(
-            target_list, target_column_name, source_list, source_column_name,
-            source_list_mask=source_list_mask)
-
-        # Append indexes of rows where there is no GAIA_ID in source list,
-        # but PS_ID matches a target in the target list
-        target_column_name, source_column_name = 'PS_ID', 'PS1_ID'
-        source_list_mask = (source_list['GAIA_REV_ID'] == 0)
-        target_ind_ps, source_ind_ps = _match_source_to_target_lists(
-            target_list, target_column_name, source_list, source_column_name,
-            source_list_mask=source_list_mask)
-
-        target_ind = np.append(target_ind_gaia, target_ind_ps)
-        source_ind = np.append(source_ind_gaia, source_ind_ps)
+    # The keys of the source list are sorted once for all the catalogues
+    with instrumentation.phase('match'):
+        index = source_key_index(
+            {column: _unmask_column(source_list, column)
+             for _, column in MATCH_KEYS},
+            _source_key_masks(source_list['GAIA_REV_ID']))
+    source_ra = source_dec = None
+    if match_radius is not None:
+        source_ra, source_dec = [_float_column(source_list, column)
+                                 for column in POSITION_COLUMNS]
+
+    with instrumentation.phase('read'):
+        target_lists = [load_target_catalogue(target_cat, new_columns,
+                                              positions=match_radius is not None,
+                                              match_epoch=match_epoch)
+                        for target_cat in target_cats]
+
+    # Match on the Gaia ID of the sources that have one and on the PS1 ID of
+    # the others, using only the good, non-masked entries of both lists, then
+    # optionally by position
+    with instrumentation.phase('match'):
+        matches = match_to_catalogues(index, target_lists, len(source_list),
+                                      source_ra, source_dec, match_radius)
+    match_counts = [counts for _, _, counts, _ in matches]
+    position_stats = [stats for _, _, _, stats in matches]
+
+    for target, (target_ind, source_ind, counts, _) in zip(target_lists,
+                                                           matches):
+        target_cat, target_list = target.name, target.table
+        _log_match_counts(target_cat, source_file, counts)
 
         # Assert that the source list has the default values and copy across
         for column, default in zip(new_columns, default_values):
@@ -128,11 +611,84 @@ def add_columns_to_source_list(source_file, target_cats, output_dir,
             source_list[column][source_ind] = target_list[column][
                 target_ind]
 
-    source_list.write(output_file)
+    with instrumentation.phase('write'), \
+            fits_stream.atomic_output(output_file) as tmp_file:
+        source_list.write(tmp_file, overwrite=True)
+    if match_radius is not None:
+        _write_match_stats(output_file, source_file, match_radius, match_epoch,
+                           target_lists, match_counts, position_stats)
 
     return output_file
 
 
+# The target catalogues of the worker processes of add_columns_to_source_lists
+_worker_target_cats = None
+
+
+def _init_worker(target_cats):
+    global _worker_target_cats
+    _worker_target_cats = target_cats
+
+
+def _add_columns_in_worker(kwargs):
+    return add_columns_to_source_list(target_cats=_worker_target_cats, **kwargs)
+
+
+def add_columns_to_source_lists(source_files, target_cats, output_dir,
+                                new_columns, default_values, suffix,
+                                overwrite=False, max_memory_mb=None,
+                                workers=1, match_radius=None,
+                                match_epoch=None):
+    """
+    Run add_columns_to_source_list on several source lists, several at once.
+
+    The target catalogues are read once here. The worker processes are
+    forked, so they share the catalogues copy-on-write rather than each
+    reading them again. Where fork isn't available they are sent to each
+    worker once. The largest source lists are started first, so the run
+    takes about as long as the largest of them.
+
+    :param source_files: the source lists
+    :param match_radius: see add_columns_to_source_list
+    :param match_epoch: see add_columns_to_source_list
+    :param workers: how many source lists to process at once (0 for the
+        number of CPUs)
+    :return: a list of the output files, in the order of source_files (None
+        for those that were skipped)
+    """
+    with instrumentation.phase('read'):
+        target_cats = [load_target_catalogue(target_cat, new_columns,
+                                             positions=match_radius is not None,
+                                             match_epoch=match_epoch)
+                       for target_cat in target_cats]
+
+    jobs = [dict(source_file=source_file, output_dir=output_dir,
+                 new_columns=new_columns, default_values=default_values,
+                 suffix=suffix, overwrite=overwrite,
+                 max_memory_mb=max_memory_mb, match_radius=match_radius,
+                 match_epoch=match_epoch)
+            for source_file in source_files]
+    if workers == 1 or len(jobs) < 2:
+        return [add_columns_to_source_list(target_cats=target_cats, **job)
+                for job in jobs]
+
+    order = sorted(range(len(jobs)),
+                   key=lambda i: -os.path.getsize(source_files[i]))
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = None
+    output_files = [None] * len(jobs)
+    with instrumentation.phase('annotate'), \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or None, mp_context=context,
+                initializer=_init_worker, initargs=(target_cats,)) as executor:
+        for i, output_file in zip(order, executor.map(
+                _add_columns_in_worker, [jobs[i] for i in order])):
+            output_files[i] = output_file
+    return output_files
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
@@ -155,28 +711,53 @@ if __name__ == '__main__':
     parser.add_argument('--overwrite', action='store_true',
                         help='overwrite the output files')
 
+    parser.add_argument('--max_memory', default=None, type=float,
+                        help='stream the source lists in chunks of rows '
+                             'using about this much memory [MB] rather than '
+                             'reading them whole')
+
+    parser.add_argument('--match_radius', default=None, type=float,
+                        help='also match the sources left unmatched by their '
+                             'IDs to the nearest target within this radius '
+                             '[arcsec], writing the statistics of the matches '
+                             'to a -match.json file next to each output')
+
+    parser.add_argument('--match_epoch', default=None, type=float,
+                        help='the epoch of the positions of the source lists, '
+                             'which the targets are moved to with their proper '
+                             'motions before the positional match')
+
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of source lists to process at once (0 '
+                             'for the number of CPUs)')
+
     parser.add_argument('--log_level', default='info',
                         choices=['debug', 'info', 'warning', 'error'],
                         help='the level for the logging messages')
 
+    instrumentation.add_metrics_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
+    metrics = instrumentation.start_stage('add-configured-to-source-lists',
+                                          args.metrics)
+
     if not os.path.exists(args.output_dir):
         logging.info('Creating the output directory')
         os.makedirs(args.output_dir, exist_ok=True)
 
-    new_columns = ('GA_TARGBITS', 'TARGPROG', 'TARGPRIO', 'CONFIGURED',
-                   'ASSIGNED')
-    default_values = (0, 40*' ', 0.0, 0, 0)
-
-    for source_file in args.source_file:
-        # Clean after adding the last catalogue if we were asked to
-        add_columns_to_source_list(source_file=source_file,
-                                   target_cats=args.catalogues,
-                                   new_columns=new_columns,
-                                   default_values=default_values,
-                                   suffix=args.suffix,
-                                   output_dir=args.output_dir,
-                                   overwrite=args.overwrite)
+    add_columns_to_source_lists(source_files=args.source_file,
+                                target_cats=args.catalogues,
+                                new_columns=NEW_COLUMNS,
+                                default_values=DEFAULT_VALUES,
+                                suffix=args.suffix,
+                                output_dir=args.output_dir,
+                                overwrite=args.overwrite,
+                                max_memory_mb=args.max_memory,
+                                workers=args.workers,
+                                match_radius=args.match_radius,
+                                match_epoch=args.match_epoch)
+
+    metrics.finish()
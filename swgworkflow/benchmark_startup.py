@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPTS = ('add_configured_to_catalogues', 'add_configured_to_source_lists',
+           'clean_xml_targets', 'compare_submissions', 'configure_ensemble',
+           'configure_queue', 'configure_simulator', 'configurefields',
+           'configureplots', 'downsample_SVexp2', 'make_field_files',
+           'oversubscription', 'parameter_sweep', 'partition_catalogues',
+           'pipeline', 'target_ledger', 'validate_configured',
+           'watch_configured')
+
+
+def _time_command(command, repeats=5, env=None):
+    """Run command repeats times and return the wall times in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _import_time(module, env=None):
+    """Total self import time in seconds of module according to python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, check=False)
+    total_us = 0
+    for line in result.stderr.decode('utf-8').splitlines():
+        match = re.match(r'import time:\s+(\d+)\s+\|', line)
+        if match:
+            total_us += int(match.group(1))
+    return total_us / 1e6
+
+
+def benchmark_startup(script_dir, scripts=SCRIPTS, repeats=5):
+    """
+    Measure how long each swgworkflow script takes to print --help and to import.
+
+    :param script_dir: the directory containing the swgworkflow scripts
+    :param scripts: the names of the scripts (without .py) to time
+    :param repeats: how many times to time each --help call
+    :return: a dictionary from script name to its timings in seconds
+    """
+    env = dict(os.environ)
+    repo_dir = os.path.dirname(os.path.abspath(script_dir))
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    results = {}
+    for script in scripts:
+        script_file = os.path.join(script_dir, script + '.py')
+        help_times = _time_command([sys.executable, script_file, '--help'],
+                                   repeats=repeats, env=env)
+        results[script] = {'help_min': min(help_times),
+                           'help_median': statistics.median(help_times),
+                           'import': _import_time(f'swgworkflow.{script}', env=env)}
+        logging.info(f'{script}: --help {results[script]["help_median"]:.3f}s, '
+                     f'import {results[script]["import"]:.3f}s')
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Time the start-up of the swgworkflow scripts')
+
+    parser.add_argument('--output', default='output/benchmarks/startup.json',
+                        help="""Where to write the timings (json)""")
+
+    parser.add_argument('--repeats', default=5, type=int,
+                        help="""How many times to time each script""")
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    output_directory = os.path.dirname(args.output)
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+
+    timings = benchmark_startup(os.path.dirname(os.path.abspath(__file__)),
+                                repeats=args.repeats)
+
+    with open(args.output, 'w') as fd:
+        json.dump(timings, fd, indent=2, sort_keys=True)
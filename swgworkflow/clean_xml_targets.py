@@ -3,11 +3,8 @@
 import argparse
 import logging
 import os
-import numpy as np
-from astropy.table import Table
-from astropy.coordinates import SkyCoord
 
-from ifu.workflow.utils.classes import OBXML
+from swgworkflow import instrumentation, xmlio
 
 
 def clean_xml_targets(ob_xml):
@@ -18,7 +15,9 @@ def clean_xml_targets(ob_xml):
                 field.removeChild(target)
 
 
-def clean_targets(xml_file_list, output_dir, overwrite=False):
+def clean_targets(xml_file_list, output_dir, overwrite=False, compression=None):
+    from ifu.workflow.utils.classes import OBXML
+
     output_file_list = []
 
     for xml_file in xml_file_list:
@@ -31,8 +30,7 @@ def clean_targets(xml_file_list, output_dir, overwrite=False):
 
             # Choose the output filename depedending on the input filename
 
-            input_basename_wo_ext = \
-                os.path.splitext(os.path.basename(xml_file))[0]
+            input_basename_wo_ext = xmlio.xml_basename_wo_ext(xml_file)
 
             if (input_basename_wo_ext.endswith('-c') or
                     input_basename_wo_ext.endswith('-')):
@@ -41,7 +39,8 @@ def clean_targets(xml_file_list, output_dir, overwrite=False):
                 output_basename_wo_ext = input_basename_wo_ext + '-c'
 
             output_file = os.path.join(output_dir,
-                                       output_basename_wo_ext + '.xml')
+                                       output_basename_wo_ext +
+                                       xmlio.xml_extension(compression))
 
             # Save the output filename for the result
 
@@ -61,11 +60,17 @@ def clean_targets(xml_file_list, output_dir, overwrite=False):
                             xml_file, output_file))
                     continue
 
-            ob_xml = OBXML(xml_file)
+            # OBXML only reads and writes plain xml
+            with instrumentation.phase('read'):
+                with xmlio.uncompressed(xml_file, tmp_dir=output_dir) as plain_xml_file:
+                    ob_xml = OBXML(plain_xml_file)
 
-            clean_xml_targets(ob_xml)
+            with instrumentation.phase('clean'):
+                clean_xml_targets(ob_xml)
 
-            ob_xml.write_xml(output_file)
+            with instrumentation.phase('write'):
+                with xmlio.compressed_output(output_file) as plain_output_file:
+                    ob_xml.write_xml(plain_output_file)
 
         return output_file_list
 
@@ -89,14 +94,25 @@ if __name__ == '__main__':
                         choices=['debug', 'info', 'warning', 'error'],
                         help='the level for the logging messages')
 
+    parser.add_argument('--compression', default='none',
+                        choices=['none', 'gz', 'zst'],
+                        help='compression of the output XML files')
+
+    instrumentation.add_metrics_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
+    metrics = instrumentation.start_stage('clean-xmls', args.metrics)
+
     if not os.path.exists(args.output_dir):
         logging.info('Creating the output directory')
         os.mkdir(args.output_dir)
 
     clean_targets(xml_file_list=args.xml_file,
                   output_dir=args.output_dir,
-                  overwrite=args.overwrite)
+                  overwrite=args.overwrite,
+                  compression=args.compression)
+
+    metrics.finish()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+
+from swgworkflow import instrumentation
+from swgworkflow.add_configured_to_catalogues import KEY_COLUMNS
+
+# The columns of the configured catalogues compared between submissions
+TARGET_COLUMNS = ('TARGUSE', 'TARGPRIO', 'TARGPROG', 'FIELD_NAME', 'CONFIGURED', 'ASSIGNED')
+# The columns the targets are grouped on when comparing their assignment
+GROUPINGS = ('TARGPRIO', 'TARGPROG')
+
+
+def submission_name(submission_dir):
+    """The name of a submission from its output directory i.e. <key> of output/<key>."""
+    return os.path.basename(os.path.normpath(submission_dir))
+
+
+def _column_values(column):
+    # Masked values become 0 or empty. FITS columns are big endian, which
+    # pandas can't index.
+    values = np.ma.filled(np.ma.asarray(column), b'' if column.dtype.kind == 'S' else 0)
+    return values.astype(values.dtype.newbyteorder('='))
+
+
+def read_submission(submission_dir, targuse='T'):
+    """
+    Read the configured catalogues of a submission (output/<key>/catalogs-configured).
+
+    The text columns are kept as the bytes they are stored as, so that even catalogues of millions of rows are only
+    ever handled as numpy arrays.
+
+    :param submission_dir: the output directory of the submission
+    :param targuse: only keep the targets with this TARGUSE (None for all of them)
+    :return: an astropy Table with KEY_COLUMNS and TARGET_COLUMNS
+    """
+    from astropy.table import Table, vstack
+
+    catalogue_files = sorted(glob.glob(os.path.join(submission_dir, 'catalogs-configured', '*.fits')))
+    assert len(catalogue_files) > 0, 'No configured catalogues in {}'.format(submission_dir)
+    tables = []
+    for catalogue_file in catalogue_files:
+        catalogue = Table.read(catalogue_file, memmap=True)
+        tables.append(Table({column: _column_values(catalogue[column]) for column in KEY_COLUMNS + TARGET_COLUMNS}))
+        del catalogue
+    targets = vstack(tables) if len(tables) > 1 else tables[0]
+    if targuse is not None:
+        targets = targets[np.char.strip(np.asarray(targets['TARGUSE'])) == targuse.encode()]
+    return targets
+
+
+def _factorize_bytes(values):
+    # pandas.factorize for fixed width text, which it would otherwise convert
+    # to python objects: the text is hashed 8 bytes at a time as integers,
+    # with trailing spaces made padding like trailing NULs
+    import pandas as pd
+
+    width = values.dtype.itemsize
+    matrix = np.zeros((len(values), -(-width // 8) * 8), dtype=np.uint8)
+    matrix[:, :width] = np.ascontiguousarray(values).view(np.uint8).reshape(len(values), width)
+    padding = (matrix == ord(' ')) | (matrix == 0)
+    matrix[np.logical_and.accumulate(padding[:, ::-1], axis=1)[:, ::-1]] = 0
+    codes = np.zeros(len(values), dtype=np.int64)
+    for word in matrix.view(np.uint64).T:
+        word_codes, word_uniques = pd.factorize(word)
+        codes, _ = pd.factorize(codes * len(word_uniques) + word_codes)
+    # The text of each code from its first row
+    first = np.empty(codes.max(initial=-1) + 1, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    return codes, np.char.rstrip(values[first]).astype(str)
+
+
+def _codes(arrays):
+    """
+    Integer codes of the values of several arrays, equal for equal values (ignoring trailing spaces in text), found
+    by hashing rather than sorting the values.
+
+    :param arrays: a list of arrays
+    :return: a tuple of the codes of each array and the (sorted) values of each code, decoded to str for text
+    """
+    import pandas as pd
+
+    values = np.concatenate(arrays)
+    if values.dtype.kind == 'S':
+        codes, uniques = _factorize_bytes(values)
+    else:
+        codes, uniques = pd.factorize(values)
+    # Number the values in order, which only needs the (few) distinct values sorting
+    order = np.argsort(uniques, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    split = np.cumsum([len(array) for array in arrays])[:-1]
+    return np.split(rank[codes], split), np.asarray(uniques)[order]
+
+
+def _key_codes(submissions):
+    # An integer for the KEY_COLUMNS of each target of each submission, equal
+    # for the same key, from the codes of each column
+    keys = [np.zeros(len(targets), dtype=np.int64) for targets in submissions.values()]
+    for column in KEY_COLUMNS:
+        codes, uniques = _codes([np.asarray(targets[column]) for targets in submissions.values()])
+        if (max(np.max(key, initial=0) for key in keys) + 1) * len(uniques) >= 2 ** 62:
+            # Renumber the keys so far before they overflow
+            keys, _ = _codes(keys)
+        keys = [key * len(uniques) + code for key, code in zip(keys, codes)]
+    return keys
+
+
+def align_submissions(submissions):
+    """
+    Align the targets of several submissions with a hash join on KEY_COLUMNS.
+
+    Each key is first turned into a single integer (see _key_codes) and the targets are joined by hashing these
+    integers with pandas.factorize, so the join is linear in the number of targets.
+
+    :param submissions: a dictionary from the name of each submission to its targets from read_submission
+    :return: a pandas dataframe with a row for each target of any of the submissions, with TARGPRIO and TARGPROG
+        (from the first submission that has the target), and in_<name>, configured_<name> and assigned_<name>
+        (booleans) for each submission. Targets that are repeated in a submission count once, as configured or
+        assigned if any of their rows is.
+    """
+    import pandas as pd
+
+    keys = _key_codes(submissions)
+    targets, _ = pd.factorize(np.concatenate(keys))
+    rows = np.split(targets, np.cumsum([len(key) for key in keys])[:-1])
+    n_targets = targets.max(initial=-1) + 1
+
+    # The TARGPRIO and TARGPROG of each target from the first submission that has it (going through the submissions
+    # in reverse so that it is set last)
+    targprog_codes, targprog = _codes([np.asarray(submission['TARGPROG']) for submission in submissions.values()])
+    aligned = {'TARGPRIO': np.zeros(n_targets), 'TARGPROG': np.zeros(n_targets, dtype=int)}
+    for submission, target_rows, codes in reversed(list(zip(submissions.values(), rows, targprog_codes))):
+        aligned['TARGPRIO'][target_rows] = submission['TARGPRIO']
+        aligned['TARGPROG'][target_rows] = codes
+    aligned['TARGPROG'] = pd.Categorical.from_codes(aligned['TARGPROG'], categories=targprog)
+
+    for (name, submission), target_rows in zip(submissions.items(), rows):
+        for column, values in (('in_', np.ones(len(target_rows), dtype=bool)),
+                               ('configured_', np.asarray(submission['CONFIGURED']) > 0),
+                               ('assigned_', np.asarray(submission['ASSIGNED']) > 0)):
+            # Only setting the true values, so repeated targets are or-ed together
+            aligned[column + name] = np.zeros(n_targets, dtype=bool)
+            aligned[column + name][target_rows[values]] = True
+    return pd.DataFrame(aligned)
+
+
+def _group_sums(groups, columns):
+    # The sum of each of columns in each group, with np.bincount
+    import pandas as pd
+
+    codes, uniques = pd.factorize(groups, sort=True)
+    return pd.DataFrame({name: np.bincount(codes, weights=values, minlength=len(uniques)).astype(int)
+                         for name, values in columns.items()}, index=uniques)
+
+
+def compare_assignments(aligned, names, by, baseline=None):
+    """
+    Compare the assignment of each submission to that of a baseline, in groups of targets.
+
+    :param aligned: the targets from align_submissions
+    :param names: the names of the submissions
+    :param by: the column to group the targets on e.g. TARGPRIO
+    :param baseline: the submission the others are compared to. Defaults to the first.
+    :return: a pandas dataframe with a row per (by, submission) and columns targets (in the submission), configured,
+        assigned, fraction (of the targets assigned), gained and lost (assigned in the submission but not in the
+        baseline and the other way around, counting only the targets in both) and delta (the change in assigned)
+    """
+    import pandas as pd
+
+    baseline = names[0] if baseline is None else baseline
+    in_baseline = aligned['in_' + baseline].to_numpy()
+    assigned_baseline = aligned['assigned_' + baseline].to_numpy()
+    tables = []
+    for name in names:
+        in_both = aligned['in_' + name].to_numpy() & in_baseline
+        assigned = aligned['assigned_' + name].to_numpy()
+        table = _group_sums(aligned[by], {'targets': aligned['in_' + name].to_numpy(),
+                                          'configured': aligned['configured_' + name].to_numpy(),
+                                          'assigned': assigned,
+                                          'gained': in_both & assigned & ~assigned_baseline,
+                                          'lost': in_both & ~assigned & assigned_baseline})
+        tables.append(table.rename_axis(by).reset_index().assign(submission=name))
+    baseline_assigned = tables[names.index(baseline)]['assigned'].to_numpy()
+    for table in tables:
+        table['fraction'] = table['assigned'] / table['targets'].where(table['targets'] > 0)
+        table['delta'] = table['assigned'] - baseline_assigned
+    table = pd.concat(tables).sort_values(by, kind='stable')
+    return table[[by, 'submission', 'targets', 'configured', 'assigned', 'fraction', 'gained', 'lost', 'delta']]
+
+
+def compare_fields(submissions, baseline=None):
+    """
+    Compare the assignment in each field of several submissions (with the same fields).
+
+    A target configured in several fields counts in each of them, and as assigned in each if it was assigned in any
+    (the catalogues don't say in which).
+
+    :param submissions: a dictionary from the name of each submission to its targets from read_submission
+    :param baseline: the submission the others are compared to. Defaults to the first.
+    :return: a pandas dataframe with a row per field and configured_<name>, assigned_<name> and fraction_<name> for
+        each submission, and delta_<name> (the change in assigned) for those that aren't the baseline
+    """
+    import pandas as pd
+
+    names = list(submissions)
+    baseline = names[0] if baseline is None else baseline
+    configured = [np.asarray(targets['CONFIGURED']) > 0 for targets in submissions.values()]
+    codes, field_names = _codes([np.asarray(targets['FIELD_NAME'])[rows]
+                                 for targets, rows in zip(submissions.values(), configured)])
+    # Only the distinct FIELD_NAMEs need splitting into their fields
+    fields = sorted({field for field_name in field_names for field in field_name.split('|') if field})
+    field_index = {field: i for i, field in enumerate(fields)}
+    table = {}
+    for name, targets, rows, field_name_codes in zip(names, submissions.values(), configured, codes):
+        assigned = np.asarray(targets['ASSIGNED'])[rows] > 0
+        counts = np.bincount(field_name_codes, minlength=len(field_names))
+        assigned_counts = np.bincount(field_name_codes, weights=assigned, minlength=len(field_names))
+        table['configured_' + name] = np.zeros(len(fields), dtype=int)
+        table['assigned_' + name] = np.zeros(len(fields), dtype=int)
+        for field_name, n, n_assigned in zip(field_names, counts, assigned_counts):
+            for field in field_name.split('|'):
+                if field:
+                    table['configured_' + name][field_index[field]] += n
+                    table['assigned_' + name][field_index[field]] += n_assigned
+    table = pd.DataFrame(table, index=pd.Index(fields, name='FIELD_NAME'))
+    for name in names:
+        table['fraction_' + name] = table['assigned_' + name] / table['configured_' + name].where(
+            table['configured_' + name] > 0)
+    for name in names:
+        if name != baseline:
+            table['delta_' + name] = table['assigned_' + name] - table['assigned_' + baseline]
+    return table.reset_index()
+
+
+def summarise(aligned, names, baseline=None):
+    """
+    The overall comparison of each submission with the baseline.
+
+    :param aligned: the targets from align_submissions
+    :param names: the names of the submissions
+    :param baseline: the submission the others are compared to. Defaults to the first.
+    :return: a pandas dataframe with a row per submission and columns targets, configured, assigned, fraction,
+        gained, lost, delta, only_here (targets not in the baseline) and missing (targets of the baseline not in the
+        submission)
+    """
+    baseline = names[0] if baseline is None else baseline
+    table = compare_assignments(aligned.assign(_all=0), names, by='_all', baseline=baseline).drop(columns='_all')
+    in_baseline = aligned['in_' + baseline].to_numpy()
+    table['only_here'] = [int(np.sum(aligned['in_' + name].to_numpy() & ~in_baseline)) for name in table['submission']]
+    table['missing'] = [int(np.sum(~aligned['in_' + name].to_numpy() & in_baseline)) for name in table['submission']]
+    return table.reset_index(drop=True)
+
+
+def plot_assigned_fraction(table, by, figsize=(8, 4)):
+    """The fraction of targets assigned in each group of by (e.g. TARGPRIO) for each submission."""
+    import matplotlib.pyplot as plt
+
+    fractions = table.pivot(index=by, columns='submission', values='fraction')
+    fractions = fractions[list(dict.fromkeys(table['submission']))]
+    fig, ax = plt.subplots(figsize=figsize)
+    fractions.plot.bar(ax=ax, alpha=0.7)
+    ax.set_ylabel('Fraction of targets assigned')
+    ax.set_ylim(0, 1)
+    fig.tight_layout()
+    return fig
+
+
+def plot_gained_lost(table, by, baseline, figsize=(8, 4)):
+    """The targets each submission assigned that the baseline didn't (up) and the other way around (down)."""
+    import matplotlib.pyplot as plt
+
+    others = [name for name in dict.fromkeys(table['submission']) if name != baseline]
+    gained = table.pivot(index=by, columns='submission', values='gained')[others]
+    lost = table.pivot(index=by, columns='submission', values='lost')[others]
+    x = np.arange(len(gained))
+    width = 0.8 / max(1, len(others))
+    fig, ax = plt.subplots(figsize=figsize)
+    for i, name in enumerate(others):
+        ax.bar(x + i * width, gained[name], width, color='C{}'.format(i), label=name)
+        ax.bar(x + i * width, -lost[name], width, color='C{}'.format(i), alpha=0.5)
+    ax.axhline(0, color='k', linewidth=0.5)
+    ax.set_xticks(x + width * (len(others) - 1) / 2)
+    ax.set_xticklabels(gained.index, rotation=90)
+    ax.set_xlabel(by)
+    ax.set_ylabel('Gained (+) and lost (-) against {}'.format(baseline))
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def plot_field_deltas(table, figsize=(10, 4)):
+    """The change in the number of targets assigned in each field against the baseline."""
+    import matplotlib.pyplot as plt
+
+    columns = [column for column in table if column.startswith('delta_')]
+    fig, ax = plt.subplots(figsize=figsize)
+    x = np.arange(len(table))
+    width = 0.8 / max(1, len(columns))
+    for i, column in enumerate(columns):
+        ax.bar(x + i * width, table[column], width, label=column[len('delta_'):])
+    ax.axhline(0, color='k', linewidth=0.5)
+    ax.set_xticks(x + width * (len(columns) - 1) / 2)
+    ax.set_xticklabels(table['FIELD_NAME'], rotation=90)
+    ax.set_ylabel('Change in assigned targets')
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Compare the fibre assignment of two or more submissions')
+
+    parser.add_argument('submission_dir', nargs='+',
+                        help="""The output directories of the submissions i.e.
+                        output/<key>. The first is the baseline.""")
+
+    parser.add_argument('--outdir', dest='output_dir', default='output/comparison',
+                        help="""name of the directory which will contain the
+                        comparison tables""")
+
+    parser.add_argument('--targuse', default='T',
+                        help='Only compare targets of this TARGUSE ("all" for '
+                             'all of them)')
+
+    parser.add_argument('--plot_dir', default=None,
+                        help='Directory to write the comparison plots to')
+
+    parser.add_argument('--file_format', default='png',
+                        help='File format of the plots')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    assert len(args.submission_dir) >= 2, 'Give at least two submissions to compare'
+    names = [submission_name(submission_dir) for submission_dir in args.submission_dir]
+    assert len(set(names)) == len(names), 'The submissions need different names: {}'.format(names)
+
+    metrics = instrumentation.start_stage('compare-submissions', args.metrics)
+
+    with instrumentation.phase('read'):
+        submissions = {name: read_submission(submission_dir, targuse=None if args.targuse == 'all' else args.targuse)
+                       for name, submission_dir in zip(names, args.submission_dir)}
+    with instrumentation.phase('join'):
+        aligned = align_submissions(submissions)
+    with instrumentation.phase('compare'):
+        summary = summarise(aligned, names)
+        tables = {by: compare_assignments(aligned, names, by) for by in GROUPINGS}
+        fields = compare_fields(submissions)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary.to_csv(os.path.join(args.output_dir, 'summary.csv'), index=False)
+    for by, table in tables.items():
+        table.to_csv(os.path.join(args.output_dir, 'by_{}.csv'.format(by.lower())), index=False)
+    fields.to_csv(os.path.join(args.output_dir, 'by_field.csv'), index=False)
+    logging.info('Assignment against {}:\n{}'.format(names[0], summary.to_string(index=False)))
+
+    if args.plot_dir is not None:
+        with instrumentation.phase('plot'):
+            os.makedirs(args.plot_dir, exist_ok=True)
+            figures = {'field_deltas': plot_field_deltas(fields)}
+            for by, table in tables.items():
+                figures['assigned_fraction_{}'.format(by.lower())] = plot_assigned_fraction(table, by)
+                figures['gained_lost_{}'.format(by.lower())] = plot_gained_lost(table, by, names[0])
+            for name, fig in figures.items():
+                fig.savefig(os.path.join(args.plot_dir, '{}.{}'.format(name, args.file_format)))
+
+    metrics.finish()
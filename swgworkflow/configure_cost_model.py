@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+# The resources every qsub job used to request, used when there is no model to do better
+DEFAULT_WALLTIME_HOURS, DEFAULT_PMEM_GB = 12.0, 16.0
+
+
+def _log_features(record, features):
+    return [np.log(max(float(record.get(feature, 0) or 0), 1.0)) for feature in features]
+
+
+def _fit_log_linear(records, target, features):
+    """Least squares fit of log(target) against the log of each feature, dropping features that don't vary."""
+    records = [record for record in records if (record.get(target) or 0) > 0]
+    if len(records) < 2:
+        return None, ()
+    x = np.array([_log_features(record, features) for record in records]).reshape(len(records), len(features))
+    varying = [i for i in range(len(features)) if np.ptp(x[:, i]) > 0]
+    if len(varying) == 0:
+        return None, ()
+    design = np.column_stack([np.ones(len(records))] + [x[:, i] for i in varying])
+    y = np.log([record[target] for record in records])
+    coefficients, _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    return coefficients, tuple(features[i] for i in varying)
+
+
+def _format_walltime(hours):
+    seconds = int(np.ceil(hours * 3600))
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+class ConfigureCostModel:
+    """
+    Predict how long configure will take on a field, and how much memory it needs, from cheap features of the
+    input xml (see configure_telemetry.make_record) using a power law fitted to earlier runs.
+
+    :param records: telemetry records of earlier successful configure runs
+    :param features: the record entries the predictions depend on
+    """
+
+    def __init__(self, records, features=('n_targets', 'threads')):
+        records = [record for record in records if record.get('exit_status') == 0]
+        self.n_runs = len(records)
+        self.runtime_coefficients, self.runtime_features = _fit_log_linear(records, 'runtime', features)
+        self.memory_coefficients, self.memory_features = _fit_log_linear(records, 'peak_rss_mb', features)
+
+    @classmethod
+    def from_history(cls, history_file, **kwargs):
+        """Fit the model to a configure history file (returns None if there isn't one)."""
+        if history_file is None or not os.path.exists(history_file):
+            return None
+        with open(history_file) as fd:
+            records = [json.loads(line) for line in fd if line.strip()]
+        model = cls(records, **kwargs)
+        logging.info('Fitted configure cost model to {} runs in {}'.format(model.n_runs, history_file))
+        return model
+
+    @staticmethod
+    def _predict(coefficients, features, record):
+        if coefficients is None:
+            return None
+        return float(np.exp(coefficients[0] + np.dot(coefficients[1:], _log_features(record, features))))
+
+    def predict_runtime(self, record):
+        """Predicted runtime [s] or None if there weren't enough runs to fit."""
+        return self._predict(self.runtime_coefficients, self.runtime_features, record)
+
+    def predict_memory(self, record):
+        """Predicted peak memory [MB] or None if there weren't enough runs with memory measurements to fit."""
+        return self._predict(self.memory_coefficients, self.memory_features, record)
+
+    def qsub_resources(self, record, safety=2.0, min_walltime_hours=1.0,
+                       max_walltime_hours=DEFAULT_WALLTIME_HOURS, min_pmem_gb=2.0,
+                       max_pmem_gb=DEFAULT_PMEM_GB):
+        """
+        The walltime and pmem to request for a field, with a safety factor on the predictions.
+
+        :return: a tuple of strings (walltime, pmem) as passed to qsub -l
+        """
+        runtime = self.predict_runtime(record)
+        if runtime is None:
+            hours = DEFAULT_WALLTIME_HOURS
+        else:
+            hours = float(np.clip(runtime * safety / 3600, min_walltime_hours, max_walltime_hours))
+        memory = self.predict_memory(record)
+        if memory is None:
+            pmem_gb = DEFAULT_PMEM_GB
+        else:
+            pmem_gb = float(np.clip(np.ceil(memory * safety / 1024), min_pmem_gb, max_pmem_gb))
+        return _format_walltime(hours), '{:g}gb'.format(pmem_gb)
+
+
+def order_longest_first(records, cost_model=None):
+    """
+    The order in which to run configure on the fields of records: longest predicted runtime first, so that
+    short fields fill in around the long ones. Without a model the number of targets is used as the proxy.
+
+    :return: a list of indices into records
+    """
+    if cost_model is not None and cost_model.runtime_coefficients is not None:
+        cost = [cost_model.predict_runtime(record) for record in records]
+    else:
+        cost = [record.get('n_targets', 0) for record in records]
+    return sorted(range(len(records)), key=lambda i: -cost[i])
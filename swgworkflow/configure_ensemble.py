@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import csv
+import logging
+import multiprocessing
+import os
+import shutil
+
+from swgworkflow import configure_telemetry, instrumentation, xmlio
+from swgworkflow.configurefields import (_get_output_filename, _is_tool, configure_fields,
+                                         configure_fields_multistage)
+
+SCORES_FILENAME = 'ensemble_scores.csv'
+SCORE_COLUMNS = ('field', 'seed', 'weighted_priority', 'assigned_science', 'parked', 'output_file', 'best')
+
+
+def score_configured_xml(xml_file):
+    """
+    Score the fibre assignment of a configured xml: the sum of the TARGPRIO of the science targets that were
+    assigned a fibre, and the number of parked fibres.
+
+    :param xml_file: the xml produced by configure
+    :return: a dictionary with weighted_priority, assigned_science and parked
+    """
+    from swgworkflow.xmlanalysis import parse_configured_xml
+
+    summary, targets = parse_configured_xml(xml_file)
+    science = targets[(targets['targuse'] == 'T') & targets['assigned']]
+    return {'weighted_priority': float(science['targprio'].sum()),
+            'assigned_science': len(science),
+            'parked': int(summary['parked'].iloc[0])}
+
+
+def _rank(score):
+    # Most priority assigned first and, between equals, the fewest parked fibres
+    return score['weighted_priority'], -score['parked']
+
+
+def _seed_dir(output_dir, seed):
+    return os.path.join(output_dir, 'seed-{}'.format(seed))
+
+
+def configure_fields_ensemble(xml_file_list, output_dir, seeds, multistage=None,
+                              workers=None, **kwargs):
+    """
+    Configure every field once per seed and keep the best assignment of each.
+
+    The seeds are run in parallel, each into output_dir/seed-<seed>, with
+    configure_fields (or configure_fields_multistage if multistage is given).
+    With qsub the jobs of all the seeds are in the queue at the same time and
+    this waits for them to finish. Each output is scored with
+    score_configured_xml and the one with the highest weighted priority
+    (fewest parked fibres between equals) is copied to output_dir. The score
+    of every seed is written to output_dir/ensemble_scores.csv.
+
+    Parameters
+    ----------
+    xml_file_list : list of str
+        A list of input OB XML files.
+    output_dir : str
+        Name of the directory which will contain the best output XML files.
+    seeds : list of int
+        The random seeds to run configure with.
+    multistage : list of float, optional
+        The targprio boundaries for a multistage configure of each seed.
+    workers : int, optional
+        How many seeds to run at once. Defaults to all of them.
+    **kwargs
+        Passed on to configure_fields. sync is always True.
+
+    Returns
+    -------
+    output_file_list : list of str
+        A list with the best output XML file of each field.
+    """
+
+    kwargs['sync'] = True
+    kwargs.pop('seed', None)
+    if kwargs.get('history_file') is None:
+        kwargs['history_file'] = os.path.join(output_dir, configure_telemetry.HISTORY_FILENAME)
+
+    def run_seed(seed):
+        seed_dir = _seed_dir(output_dir, seed)
+        os.makedirs(seed_dir, exist_ok=True)
+        try:
+            if multistage is None:
+                return configure_fields(xml_file_list, seed_dir, seed=seed, **kwargs)
+            return configure_fields_multistage(xml_file_list, seed_dir, multistage, seed=seed, **kwargs)
+        except Exception as e:
+            # The other seeds are still scored, as are the fields this seed
+            # configured before it failed
+            logging.error('Configuring seed {} failed: {}'.format(seed, e))
+            return [_get_output_filename(xml_file, seed_dir) for xml_file in xml_file_list]
+
+    with instrumentation.phase('configure'):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or len(seeds)) as executor:
+            seed_output_lists = list(executor.map(run_seed, seeds))
+
+    output_file_list = []
+    rows = []
+    with instrumentation.phase('score'):
+        for i, xml_file in enumerate(xml_file_list):
+            field = xmlio.xml_basename_wo_ext(xml_file)
+            scores = []
+            for seed, seed_output_list in zip(seeds, seed_output_lists):
+                seed_output = seed_output_list[i]
+                if not os.path.exists(seed_output):
+                    logging.warning('Seed {} of {} has no output: {}'.format(seed, field, seed_output))
+                    continue
+                score = score_configured_xml(seed_output)
+                score.update({'field': field, 'seed': seed, 'output_file': seed_output, 'best': False})
+                scores.append(score)
+
+            output_file = os.path.join(output_dir, os.path.basename(seed_output_lists[0][i]))
+            output_file_list.append(output_file)
+            if len(scores) == 0:
+                logging.error('No seed configured {}'.format(xml_file))
+                continue
+
+            best = max(scores, key=_rank)
+            best['best'] = True
+            shutil.copyfile(best['output_file'], output_file)
+            logging.info('Best of {} seeds for {} is seed {} (weighted priority {:g}, {} parked)'.format(
+                len(scores), field, best['seed'], best['weighted_priority'], best['parked']))
+            rows += scores
+
+    with open(os.path.join(output_dir, SCORES_FILENAME), 'w', newline='') as fd:
+        writer = csv.DictWriter(fd, fieldnames=SCORE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return output_file_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Configure each field with several seeds and keep the best')
+
+    parser.add_argument('--xml_file_list', nargs='+',
+                        help="""The list of xml files""")
+
+    parser.add_argument('--configure_path',
+                        default='/soft/configure/configure',
+                        help="""Path to configure executable""")
+
+    parser.add_argument('--outdir', dest='output_dir', default='output',
+                        help="""name of the directory which will contain the
+                        output XML files""")
+
+    parser.add_argument('--epoch', default='2021.5',
+                        help='Epoch of observation')
+
+    parser.add_argument('--seeds', default=[42, 43, 44, 45], nargs='+', type=int,
+                        help='The random seeds passed to configure')
+
+    parser.add_argument('--workers', default=0, type=int,
+                        help='Number of seeds to run at once. By default all '
+                             'of them.')
+
+    parser.add_argument('--threads', default=0, type=int,
+                        help='Number of threads to run each configure with. '
+                             'By default the available cores are shared '
+                             'between the seeds run at once.')
+
+    parser.add_argument('--extra_configure_options', default='',
+                        help='extra command line options to be passed to '
+                             'configure (enclose in quotes)')
+
+    parser.add_argument('--qsub', default='auto',
+                        choices=['auto', 'yes', 'no'],
+                        help='Submit jobs using qsub')
+
+    parser.add_argument('--overwrite', dest='overwrite', action='store_true',
+                        help='overwrite the output files')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    parser.add_argument('--multistage', default=[-1], nargs='+', type=float,
+                        help='The targprio boundaries of a multistage '
+                             'configure (see configurefields.py)')
+
+    parser.add_argument('--history', dest='history_file', default=None,
+                        help='json lines file to append the telemetry of each '
+                             'configure run to. Defaults to '
+                             'configure_history.jsonl in the output directory')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('configure-ensemble', args.metrics)
+
+    if not os.path.exists(args.output_dir):
+        logging.info('Creating the output directory')
+        os.makedirs(args.output_dir)
+
+    if args.qsub == 'auto':
+        qsub = _is_tool('qsub')
+    else:
+        qsub = args.qsub == 'yes'
+
+    workers = args.workers or len(args.seeds)
+    if args.threads == 0:
+        if qsub:
+            threads = 8  # default of 8 threads on herts cluster
+        else:
+            threads = max(1, multiprocessing.cpu_count() // workers)
+    else:
+        threads = args.threads
+
+    configure_fields_ensemble(args.xml_file_list, args.output_dir, args.seeds,
+                              multistage=args.multistage if args.multistage[0] > 0 else None,
+                              workers=workers,
+                              epoch=args.epoch,
+                              qsub=qsub,
+                              configure_path=args.configure_path,
+                              overwrite=args.overwrite,
+                              threads=threads,
+                              extra_configure_options=args.extra_configure_options,
+                              history_file=args.history_file)
+
+    metrics.finish()
@@ -0,0 +1,77 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+MANIFEST_FILENAME = 'multistage_manifest.json'
+
+
+def file_hash(filename, block_size=1 << 20):
+    """The sha256 of a file."""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for block in iter(lambda: fd.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class MultistageManifest:
+    """
+    The status of each field and stage of a multistage configure run, kept in a json file so that an
+    interrupted run can carry on where it stopped.
+
+    A stage of a field is complete when its output exists and neither its pre-configure input nor its output have
+    changed (by sha256) since configure produced them.
+
+    :param manifest_file: the json file
+    :param settings: the options of the run. If they differ from those of the manifest on disk, the manifest is
+        started again from scratch and settings_changed is set.
+    """
+
+    def __init__(self, manifest_file, settings):
+        self.manifest_file = manifest_file
+        self.settings = settings
+        self.fields = {}
+        # Whether there was a manifest on disk, and whether it was for other settings
+        self.existed = os.path.exists(manifest_file)
+        self.settings_changed = False
+        if self.existed:
+            with open(manifest_file) as fd:
+                manifest = json.load(fd)
+            if manifest.get('settings') == settings:
+                self.fields = manifest['fields']
+            else:
+                self.settings_changed = True
+                logging.info('The options of the run have changed since {} was written, starting again'.format(
+                    manifest_file))
+
+    def _entry(self, field, stage):
+        return self.fields.get(field, {}).get(str(stage))
+
+    def is_complete(self, field, stage, input_file, output_file):
+        """Whether configure has already produced output_file from (the current) input_file."""
+        entry = self._entry(field, stage)
+        if entry is None or entry['status'] != 'done' or not os.path.exists(output_file):
+            return False
+        return (entry['input_hash'] == file_hash(input_file) and
+                entry['output_file'] == os.path.abspath(output_file) and
+                entry['output_hash'] == file_hash(output_file))
+
+    def record(self, field, stage, input_file, output_file):
+        """Record the status of a field and stage after configure has run on it."""
+        done = os.path.exists(output_file)
+        self.fields.setdefault(field, {})[str(stage)] = {
+            'status': 'done' if done else 'failed',
+            'input_file': os.path.abspath(input_file),
+            'input_hash': file_hash(input_file),
+            'output_file': os.path.abspath(output_file),
+            'output_hash': file_hash(output_file) if done else None,
+            'updated': datetime.datetime.now().isoformat(timespec='seconds')}
+
+    def save(self):
+        """Write the manifest (atomically, so that an interruption can't leave it half written)."""
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fd:
+            json.dump({'settings': self.settings, 'fields': self.fields}, fd, indent=1)
+        os.replace(tmp_file, self.manifest_file)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from swgworkflow import configure_telemetry, instrumentation, xmlio
+from swgworkflow.configurefields import _configure_command, _get_output_filename
+
+# The queue directory has a json file per job in one of these subdirectories. Jobs move between them with
+# os.rename, which is atomic (also on NFS), so only one worker can claim a job. A claimed job is leased: its
+# worker keeps touching the claimed file while configure runs, and a claimed file that hasn't been touched for
+# longer than the lease timeout belongs to a worker that has died, so it is put back in pending.
+QUEUE_STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+def _state_dir(queue_dir, state):
+    return os.path.join(queue_dir, state)
+
+
+def _write_json(data, filename):
+    # Written to a temporary file and renamed so other workers never see part of a job
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as fd:
+        json.dump(data, fd)
+    os.replace(tmp_filename, filename)
+
+
+def _read_json(filename):
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def _worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def enqueue(xml_file_list, queue_dir, output_dir, epoch='2021.5', seed=42,
+            extra_configure_options='', overwrite=False):
+    """
+    Add a job to configure each field to the queue.
+
+    :param xml_file_list: the input OB xmls
+    :param queue_dir: the shared queue directory
+    :param output_dir: the directory for the configured xmls
+    :return: the list of output xmls (in the order of xml_file_list)
+    """
+    for state in QUEUE_STATES:
+        os.makedirs(_state_dir(queue_dir, state), exist_ok=True)
+
+    output_file_list = []
+    for xml_file in xml_file_list:
+        assert os.path.isfile(xml_file)
+        output_file = _get_output_filename(xml_file, output_dir)
+        output_file_list.append(output_file)
+        if os.path.exists(output_file) and not overwrite:
+            logging.info('Skipping file {} as its output already exists: {}'.format(xml_file, output_file))
+            continue
+        job_name = os.path.splitext(os.path.basename(output_file))[0]
+        if any(os.path.exists(os.path.join(_state_dir(queue_dir, state), job_name + '.json'))
+               for state in ('pending', 'claimed')):
+            logging.info('Skipping file {} as it is already in the queue'.format(xml_file))
+            continue
+        job = {'name': job_name,
+               'xml_file': os.path.abspath(xml_file),
+               'output_file': os.path.abspath(output_file),
+               'epoch': epoch,
+               'seed': seed,
+               'extra_configure_options': extra_configure_options,
+               'attempts': 0}
+        _write_json(job, os.path.join(_state_dir(queue_dir, 'pending'), job_name + '.json'))
+        logging.info('Queued {}'.format(job_name))
+    return output_file_list
+
+
+def claim(queue_dir, worker_id):
+    """
+    Claim the next pending job.
+
+    :return: a tuple (job, claimed_file), or (None, None) if no job is pending
+    """
+    for pending_file in sorted(glob.glob(os.path.join(_state_dir(queue_dir, 'pending'), '*.json'))):
+        claimed_file = os.path.join(_state_dir(queue_dir, 'claimed'), os.path.basename(pending_file))
+        try:
+            # Start the lease before the rename so a fresh claim never looks stale
+            os.utime(pending_file)
+            os.rename(pending_file, claimed_file)
+        except FileNotFoundError:
+            continue  # another worker got there first
+        job = _read_json(claimed_file)
+        job['worker'] = worker_id
+        _write_json(job, claimed_file)
+        return job, claimed_file
+    return None, None
+
+
+def requeue_stale(queue_dir, lease_timeout=300, max_attempts=3):
+    """
+    Put the claimed jobs whose lease has expired back in the queue, or in failed once they have been tried
+    max_attempts times.
+
+    :return: the number of jobs requeued
+    """
+    n_requeued = 0
+    now = time.time()
+    for claimed_file in glob.glob(os.path.join(_state_dir(queue_dir, 'claimed'), '*.json')):
+        try:
+            if now - os.path.getmtime(claimed_file) < lease_timeout:
+                continue
+            job = _read_json(claimed_file)
+        except (FileNotFoundError, ValueError):
+            continue  # just finished, or being rewritten by its worker
+        # Take the job out of claimed under a name private to this process, so that only one process requeues it
+        # and nobody can claim it before it has been updated
+        requeue_file = '{}.{}.requeue'.format(claimed_file, _worker_id())
+        try:
+            os.rename(claimed_file, requeue_file)
+        except FileNotFoundError:
+            continue  # another worker requeued it first
+        job['attempts'] += 1
+        state = 'pending' if job['attempts'] < max_attempts else 'failed'
+        logging.warning('Lease of {} held by {} expired, moving it to {}'.format(
+            job['name'], job.get('worker'), state))
+        _write_json(job, requeue_file)
+        os.rename(requeue_file, os.path.join(_state_dir(queue_dir, state), os.path.basename(claimed_file)))
+        n_requeued += 1
+    return n_requeued
+
+
+class _Lease:
+    """Keep renewing the lease of a claimed job in a background thread until the job is finished."""
+
+    def __init__(self, claimed_file, interval):
+        self.claimed_file = claimed_file
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.claimed_file)
+            except FileNotFoundError:
+                logging.warning('Lost the lease of {}'.format(self.claimed_file))
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_job(job, configure_path, threads, stdout_file, stderr_file):
+    """
+    Run configure for a job, publishing the output xml atomically.
+
+    :return: the telemetry record of the run
+    """
+    # Configure writes to a private file so a requeued duplicate of the job can't interleave with this one
+    tmp_output_file = '{}.{}.tmp.xml'.format(os.path.splitext(job['output_file'])[0], _worker_id())
+    record = configure_telemetry.make_record(
+        job['xml_file'], job['output_file'], backend='queue', threads=threads, seed=job['seed'],
+        epoch=job['epoch'], extra_configure_options=job['extra_configure_options'])
+    with xmlio.uncompressed(job['xml_file'], tmp_dir=os.path.dirname(job['output_file'])) as xml_file:
+        command = _configure_command(configure_path, xml_file, tmp_output_file, job['epoch'], job['seed'],
+                                     threads, job['extra_configure_options'])
+        logging.info('Running command: {}'.format(command))
+        exit_status = configure_telemetry.run_local(command, record, stdout_file, stderr_file)
+    if exit_status == 0:
+        os.replace(tmp_output_file, job['output_file'])
+    elif os.path.exists(tmp_output_file):
+        os.remove(tmp_output_file)
+    return record
+
+
+def run_worker(queue_dir, configure_path='/soft/configure/configure', threads=8, lease_timeout=300,
+               poll_interval=10, max_attempts=3, wait=False):
+    """
+    Configure jobs from the queue until it is empty.
+
+    :param queue_dir: the shared queue directory
+    :param configure_path: the configure executable on this machine
+    :param threads: the number of threads to run configure with
+    :param lease_timeout: seconds after which the claim of a worker that stopped renewing it expires [s]
+    :param poll_interval: how often to look for new or stale jobs while waiting [s]
+    :param max_attempts: how many times a job is tried before it is failed
+    :param wait: keep waiting for new jobs when the queue is empty rather than returning
+    :return: the number of jobs this worker ran
+    """
+    worker_id = _worker_id()
+    n_jobs = 0
+    while True:
+        requeue_stale(queue_dir, lease_timeout=lease_timeout, max_attempts=max_attempts)
+        job, claimed_file = claim(queue_dir, worker_id)
+        if job is None:
+            if not wait and len(glob.glob(os.path.join(_state_dir(queue_dir, 'claimed'), '*.json'))) == 0:
+                logging.info('Worker {} finished after {} jobs'.format(worker_id, n_jobs))
+                return n_jobs
+            time.sleep(poll_interval)
+            continue
+
+        logging.info('Worker {} claimed {}'.format(worker_id, job['name']))
+        log_prefix = os.path.splitext(job['output_file'])[0]
+        with _Lease(claimed_file, lease_timeout / 3) as lease:
+            with instrumentation.phase('configure'):
+                record = run_job(job, configure_path, threads, log_prefix + '.stdout', log_prefix + '.stderr')
+        n_jobs += 1
+        record['worker'] = worker_id
+        if lease.lost:
+            # The job was requeued while we were running it, so whoever has it now reports it
+            continue
+        job['record'] = record
+        state = 'done' if record['exit_status'] == 0 else 'failed'
+        _write_json(job, claimed_file)
+        os.rename(claimed_file, os.path.join(_state_dir(queue_dir, state), os.path.basename(claimed_file)))
+
+
+def queue_status(queue_dir):
+    """The number of jobs in each state of the queue."""
+    return {state: len(glob.glob(os.path.join(_state_dir(queue_dir, state), '*.json')))
+            for state in QUEUE_STATES}
+
+
+def collect(queue_dir, history_file):
+    """
+    Move the telemetry of the finished jobs to the configure history and remove them from the queue.
+
+    :return: the list of jobs that failed
+    """
+    records = []
+    failed_jobs = []
+    for state in ('done', 'failed'):
+        for job_file in sorted(glob.glob(os.path.join(_state_dir(queue_dir, state), '*.json'))):
+            job = _read_json(job_file)
+            if 'record' in job:
+                records.append(job['record'])
+            if state == 'failed':
+                failed_jobs.append(job)
+                logging.error('Configure failed for {}'.format(job['xml_file']))
+            os.remove(job_file)
+    configure_telemetry.append_history(history_file, records)
+    return failed_jobs
+
+
+def wait_for_queue(queue_dir, lease_timeout=300, poll_interval=10, max_attempts=3):
+    """Wait until every job in the queue has finished, requeuing the jobs of dead workers meanwhile."""
+    while True:
+        status = queue_status(queue_dir)
+        if status['pending'] == 0 and status['claimed'] == 0:
+            return status
+        logging.debug(status)
+        requeue_stale(queue_dir, lease_timeout=lease_timeout, max_attempts=max_attempts)
+        time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Distribute configure jobs through a queue on a shared directory')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='add fields to the queue')
+    enqueue_parser.add_argument('--xml_file_list', nargs='+', required=True,
+                                help="""The list of xml files""")
+    enqueue_parser.add_argument('--outdir', dest='output_dir', default='output',
+                                help="""name of the directory which will
+                                contain the output XML files""")
+    enqueue_parser.add_argument('--epoch', default='2021.5',
+                                help='Epoch of observation')
+    enqueue_parser.add_argument('--seed', default=42, type=int,
+                                help='Random seed passed to configure')
+    enqueue_parser.add_argument('--extra_configure_options', default='',
+                                help='extra command line options to be passed '
+                                     'to configure (enclose in quotes)')
+    enqueue_parser.add_argument('--overwrite', action='store_true',
+                                help='overwrite the output files')
+    enqueue_parser.add_argument('--wait', action='store_true',
+                                help='wait for the jobs to finish and add '
+                                     'their telemetry to the history')
+    enqueue_parser.add_argument('--history', dest='history_file', default=None,
+                                help='json lines file to append the telemetry '
+                                     'of each configure run to. Defaults to '
+                                     'configure_history.jsonl in the output '
+                                     'directory')
+
+    worker_parser = subparsers.add_parser('worker', help='configure fields from the queue')
+    worker_parser.add_argument('--configure_path',
+                               default='/soft/configure/configure',
+                               help="""Path to configure executable""")
+    worker_parser.add_argument('--threads', default=0, type=int,
+                               help='Number of threads to run configure with. '
+                                    'By default will use all available cores.')
+    worker_parser.add_argument('--keep_waiting', action='store_true',
+                               help='wait for new jobs when the queue is empty')
+
+    for subparser in (enqueue_parser, worker_parser):
+        subparser.add_argument('--queue', dest='queue_dir', required=True,
+                               help='the queue directory (on a filesystem '
+                                    'shared by the workers)')
+        subparser.add_argument('--lease_timeout', default=300, type=float,
+                               help='seconds after which the job of a worker '
+                                    'that stopped renewing its lease is requeued')
+        subparser.add_argument('--poll_interval', default=10, type=float,
+                               help='seconds between checks of the queue')
+        subparser.add_argument('--max_attempts', default=3, type=int,
+                               help='number of times a job is tried')
+        subparser.add_argument('--log_level', default='info',
+                               choices=['debug', 'info', 'warning', 'error'],
+                               help='the level for the logging messages')
+        instrumentation.add_metrics_argument(subparser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s %(levelname)s:%(process)d:%(message)s')
+
+    metrics = instrumentation.start_stage('configure-queue-' + args.command, args.metrics)
+
+    failed_jobs = []
+    if args.command == 'enqueue':
+        os.makedirs(args.output_dir, exist_ok=True)
+        enqueue(args.xml_file_list, args.queue_dir, args.output_dir,
+                epoch=args.epoch, seed=args.seed,
+                extra_configure_options=args.extra_configure_options,
+                overwrite=args.overwrite)
+        if args.wait:
+            with instrumentation.phase('wait'):
+                wait_for_queue(args.queue_dir, lease_timeout=args.lease_timeout,
+                               poll_interval=args.poll_interval,
+                               max_attempts=args.max_attempts)
+            history_file = args.history_file
+            if history_file is None:
+                history_file = os.path.join(args.output_dir, configure_telemetry.HISTORY_FILENAME)
+            failed_jobs = collect(args.queue_dir, history_file)
+    else:
+        threads = args.threads if args.threads > 0 else multiprocessing.cpu_count()
+        run_worker(args.queue_dir, configure_path=args.configure_path,
+                   threads=threads, lease_timeout=args.lease_timeout,
+                   poll_interval=args.poll_interval,
+                   max_attempts=args.max_attempts, wait=args.keep_waiting)
+
+    metrics.finish()
+
+    if len(failed_jobs) > 0:
+        raise SystemExit('{} fields failed to configure'.format(len(failed_jobs)))
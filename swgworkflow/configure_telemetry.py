@@ -0,0 +1,145 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import socket
+import subprocess
+import time
+
+from swgworkflow import xmlio
+
+HISTORY_FILENAME = 'configure_history.jsonl'
+
+
+def count_targets_by_targprio(xml_file):
+    """
+    Count the targets in an OB xml for each TARGPRIO without building the whole tree.
+
+    :param xml_file: the (possibly compressed) xml file
+    :return: a dictionary from targprio (as a string) to the number of targets
+    """
+    counts = {}
+    for _, element in xmlio.iterparse(xml_file):
+        if element.tag == 'target':
+            targprio = element.get('targprio', 'none')
+            counts[targprio] = counts.get(targprio, 0) + 1
+        element.clear()
+    return counts
+
+
+def make_record(xml_file, output_file, backend, threads, seed, epoch,
+                extra_configure_options):
+    """The part of the telemetry record of a configure run that is known before it starts."""
+    targprio_counts = count_targets_by_targprio(xml_file)
+    return {'field': xmlio.xml_basename_wo_ext(xml_file),
+            'input_file': os.path.abspath(xml_file),
+            'output_file': os.path.abspath(output_file),
+            'submitted': datetime.datetime.now().isoformat(timespec='seconds'),
+            'backend': backend,
+            'threads': threads,
+            'seed': seed,
+            'epoch': epoch,
+            'configure_options': extra_configure_options.strip(),
+            'n_targets': sum(targprio_counts.values()),
+            'targprio_counts': targprio_counts}
+
+
+def append_history(history_file, records):
+    """Append telemetry records to a json lines history file."""
+    if len(records) == 0:
+        return
+    history_directory = os.path.dirname(history_file)
+    if history_directory:
+        os.makedirs(history_directory, exist_ok=True)
+    with open(history_file, 'a') as fd:
+        for record in records:
+            fd.write(json.dumps(record) + '\n')
+
+
+def read_history(history_file):
+    """
+    Read a configure history into a pandas DataFrame with a targprio_<prio> column for each TARGPRIO.
+
+    :param history_file: the json lines history file
+    :return: a pandas DataFrame with a row per configure run
+    """
+    import pandas as pd
+
+    with open(history_file) as fd:
+        records = [json.loads(line) for line in fd if line.strip()]
+    df = pd.DataFrame(records)
+    if 'targprio_counts' in df:
+        counts = pd.DataFrame(list(df['targprio_counts'])).fillna(0).astype(int)
+        counts.columns = ['targprio_' + str(column) for column in counts.columns]
+        df = pd.concat([df.drop(columns=['targprio_counts']), counts], axis='columns')
+    return df
+
+
+def run_local(command, record, stdout_file, stderr_file):
+    """
+    Run configure locally, keeping its output in stdout_file/stderr_file and adding the runtime, peak memory and
+    exit status to the record.
+
+    :return: the exit status of the command
+    """
+    start = time.perf_counter()
+    with open(stdout_file, 'w') as stdout, open(stderr_file, 'w') as stderr:
+        process = subprocess.Popen(command, shell=True, stdout=stdout, stderr=stderr)
+        # wait4 gives the resource usage of this child alone
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    record.update({'runtime': time.perf_counter() - start,
+                   'exit_status': process.returncode,
+                   'peak_rss_mb': rusage.ru_maxrss / 1024,
+                   'host': socket.gethostname()})
+    return process.returncode
+
+
+def job_script(command, status_file, cleanup_files=()):
+    """
+    A batch job script that runs command and writes its start/end time, exit status and host to status_file,
+    removing cleanup_files afterwards.
+    """
+    return '\n'.join(['start=$(date +%s.%N)',
+                      command,
+                      'status=$?',
+                      'end=$(date +%s.%N)'] +
+                     ['rm -f {}'.format(filename) for filename in cleanup_files] +
+                     ['echo "$start $end $status $(hostname)" > {}'.format(status_file),
+                      'exit $status', ''])
+
+
+def write_pending(record, pending_file):
+    """Save the record of a submitted job until it finishes."""
+    with open(pending_file, 'w') as fd:
+        json.dump(record, fd)
+
+
+def collect_pending(output_dir, history_file):
+    """
+    Move the records of finished batch jobs in output_dir to the history.
+
+    Jobs that haven't finished yet (no status file) are left to be collected later.
+
+    :return: the list of records that were collected
+    """
+    records = []
+    for pending_file in sorted(glob.glob(os.path.join(output_dir, '*.telemetry.json'))):
+        status_file = pending_file[:-len('.telemetry.json')] + '.status'
+        if not os.path.exists(status_file):
+            continue
+        with open(pending_file) as fd:
+            record = json.load(fd)
+        with open(status_file) as fd:
+            start, end, exit_status, host = fd.read().split()
+        record.update({'runtime': float(end) - float(start),
+                       'exit_status': int(exit_status),
+                       'host': host})
+        records.append(record)
+        os.remove(pending_file)
+        os.remove(status_file)
+    append_history(history_file, records)
+    if len(records) > 0:
+        logging.info('Added {} configure runs to {}'.format(len(records), history_file))
+    return records
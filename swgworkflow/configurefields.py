@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import logging
 import multiprocessing
 import os.path
 import subprocess
 import tempfile
 import time
+import xml.etree.ElementTree as ET
+
+from swgworkflow import configure_telemetry, instrumentation, xmlio
+from swgworkflow.configure_manifest import MANIFEST_FILENAME, MultistageManifest
+from swgworkflow.configure_cost_model import ConfigureCostModel, order_longest_first
 
 
 def _is_tool(name):
@@ -14,40 +20,80 @@ def _is_tool(name):
     return which(name) is not None
 
 
-def _run_command(command):
-    return subprocess.check_output(command, shell=True).decode("utf-8").strip()
-
-
-def _copy_empty_xmls(xml_file_list, output_dir):
-    import xml.etree.ElementTree as ET
-    output_file_list = []
-    for xml_file in xml_file_list:
-        output_file = os.path.join(output_dir, os.path.basename(xml_file))
-        # read xml
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        field_list = root.findall('.//field')
-        assert len(field_list) == 1, "Only a single field is allowed in MOS configurations"
-        field = root.find('.//field')
-        # delete targets
-        for target in list(field)[::-1]:
-            field.remove(target)
-        # write to file
-        tree.write(output_file)
-        output_file_list.append(output_file)
-    return output_file_list
+def _run_command(command, input=None):
+    if input is not None:
+        input = input.encode("utf-8")
+    return subprocess.check_output(command, shell=True, input=input).decode("utf-8").strip()
 
 
-def _filter_xmls_by_targprio(xml_file_list, intermediate_files, output_dir, targprio_boundary=-1):
-    import xml.etree.ElementTree as ET
+def _get_output_filename(xml_file, output_dir):
+    """The name of the xml configure writes for xml_file in output_dir."""
+    input_basename_wo_ext = xmlio.xml_basename_wo_ext(xml_file)
 
+    if (input_basename_wo_ext.endswith('-configured') or
+            input_basename_wo_ext.endswith('-')):
+        output_basename_wo_ext = input_basename_wo_ext + 'configured'
+    else:
+        output_basename_wo_ext = input_basename_wo_ext + '-configured'
+
+    return os.path.join(output_dir, output_basename_wo_ext + '.xml')
+
+
+def _configure_command(configure_path, xml_file, output_file, epoch, seed,
+                       threads, extra_configure_options=''):
+    command = '{} --gui 0 '.format(configure_path)
+    command += '--epoch {} '.format(epoch)
+    command += '--seed {} '.format(seed)
+    command += '--threads {} '.format(threads)
+    command += '--field {} '.format(os.path.abspath(xml_file))
+    command += '--output {} '.format(os.path.abspath(output_file))
+    command += extra_configure_options
+    return command
+
+
+def _copy_empty_xml(xml_file, output_file):
+    # Copy an xml without the targets of its field. The targets are dropped
+    # as soon as they have been parsed, so only one of them is in memory at a
+    # time whatever the size of the field
+    root = None
+    open_elements = []
+    num_fields = 0
+    for event, element in xmlio.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            elif element.tag == 'field':
+                num_fields += 1
+            open_elements.append(element)
+        else:
+            open_elements.pop()
+            if len(open_elements) > 0 and open_elements[-1].tag == 'field':
+                open_elements[-1].remove(element)
+    assert num_fields == 1, "Only a single field is allowed in MOS configurations"
+    xmlio.write(ET.ElementTree(root), output_file)
+    return output_file
+
+
+def _copy_empty_xmls(xml_file_list, output_dir, compression=None, workers=None):
+    output_file_list = [os.path.join(output_dir, xmlio.xml_basename_wo_ext(xml_file) + xmlio.xml_extension(compression))
+                        for xml_file in xml_file_list]
+    if workers == 1 or len(xml_file_list) < 2:
+        return [_copy_empty_xml(xml_file, output_file)
+                for xml_file, output_file in zip(xml_file_list, output_file_list)]
+    # Parsing is CPU bound so the files are shared between processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_copy_empty_xml, xml_file_list, output_file_list))
+
+
+def _filter_xmls_by_targprio(xml_file_list, intermediate_files, output_dir, targprio_boundary=-1,
+                             compression=None):
     output_file_list = []
 
     assert len(intermediate_files) == len(xml_file_list)
 
     for xml_file, intermediate_file in zip(xml_file_list, intermediate_files):
         # read intermediate xml
-        intermediate_tree = ET.parse(intermediate_file)
+        intermediate_tree = xmlio.parse(intermediate_file)
         intermediate_root = intermediate_tree.getroot()
         intermediate_field = intermediate_root.find('.//field')
         num_initial_targets = len(intermediate_root.findall('.//target'))
@@ -61,10 +107,10 @@ def _filter_xmls_by_targprio(xml_file_list, intermediate_files, output_dir, targ
         intermediate_targets = set()
         for target in intermediate_root.findall('.//target'):
             intermediate_targets.add(targ_uid(target))
-        print(intermediate_targets)
+        logging.debug(intermediate_targets)
 
         # read input xml
-        input_root = ET.parse(xml_file).getroot()
+        input_root = xmlio.parse(xml_file).getroot()
         # find targets > targprio_boundary and add them
         for target in input_root.findall('.//target'):
             if float(target.get('targprio', default='-inf')) > targprio_boundary and \
@@ -72,8 +118,9 @@ def _filter_xmls_by_targprio(xml_file_list, intermediate_files, output_dir, targ
                 intermediate_field.append(target)
 
         # write intermediate xml to output_dir
-        output_file = os.path.join(output_dir, os.path.basename(xml_file))
-        intermediate_tree.write(output_file)
+        output_file = os.path.join(output_dir,
+                                   xmlio.xml_basename_wo_ext(xml_file) + xmlio.xml_extension(compression))
+        xmlio.write(intermediate_tree, output_file)
         output_file_list.append(output_file)
         num_final_targets = len(intermediate_root.findall('.//target'))
         num_total_targets = len(input_root.findall('.//target'))
@@ -89,14 +136,16 @@ def configure_fields(xml_file_list, output_dir,
                      overwrite=False, threads=8,
                      extra_configure_options='',
                      extra_qsub_options='',
-                     epoch='2021.5', seed=42):
+                     epoch='2021.5', seed=42, history_file=None,
+                     cost_model='auto'):
     """
     Run xml files through configure tool to place fibres
 
     Parameters
     ----------
     xml_file_list : list of str
-        A list of input OB XML files.
+        A list of input OB XML files. They can be compressed (.xml.gz or
+        .xml.zst), in which case configure is given an uncompressed copy.
     output_dir : str
         Name of the directory which will contains the output XML files.
     qsub : bool, optional
@@ -110,6 +159,17 @@ def configure_fields(xml_file_list, output_dir,
         Extra options to be passed to qsub on herts cluster.
     overwrite : bool, optional
         Overwrite the output xml file.
+    history_file : str, optional
+        The json lines file to which the telemetry of each configure run
+        (runtime, threads, targets per targprio, options and exit status) is
+        appended. Defaults to configure_history.jsonl in output_dir. The
+        output of configure is kept in <output>.stdout and <output>.stderr.
+    cost_model : ConfigureCostModel, 'auto' or None, optional
+        The model predicting the runtime and memory of configure on each
+        field. The fields are configured longest first and, with qsub, each
+        job requests the walltime and memory predicted for it. With 'auto'
+        the model is fitted to history_file, and with None the fields are
+        ordered by their number of targets and request the default resources.
 
     Returns
     -------
@@ -117,8 +177,14 @@ def configure_fields(xml_file_list, output_dir,
         A list with the output XML files.
     """
 
+    if history_file is None:
+        history_file = os.path.join(output_dir, configure_telemetry.HISTORY_FILENAME)
+
+    if isinstance(cost_model, str) and cost_model == 'auto':
+        cost_model = ConfigureCostModel.from_history(history_file)
+
     output_file_list = []
-    job_id_list = []
+    job_list = []
     for xml_file in xml_file_list:
 
         # Check that the input XML exists and is a file
@@ -127,15 +193,7 @@ def configure_fields(xml_file_list, output_dir,
 
         # Choose the output filename depending on the input filename
 
-        input_basename_wo_ext = os.path.splitext(os.path.basename(xml_file))[0]
-
-        if (input_basename_wo_ext.endswith('-configured') or
-                input_basename_wo_ext.endswith('-')):
-            output_basename_wo_ext = input_basename_wo_ext + 'configured'
-        else:
-            output_basename_wo_ext = input_basename_wo_ext + '-configured'
-
-        output_file = os.path.join(output_dir, output_basename_wo_ext + '.xml')
+        output_file = _get_output_filename(xml_file, output_dir)
 
         # Save the output filename for the result
 
@@ -154,48 +212,210 @@ def configure_fields(xml_file_list, output_dir,
                         xml_file, output_file))
                 continue
 
-        command = '{} --gui 0 '.format(configure_path)
-        command += '--epoch {} '.format(epoch)
-        command += '--seed {} '.format(seed)
-        command += '--threads {} '.format(threads)
-        command += '--field {} '.format(os.path.abspath(xml_file))
-        command += '--output {} '.format(os.path.abspath(output_file))
-        command += extra_configure_options
+        job_list.append((xml_file, output_file))
+
+    # Run the longest fields first so the short ones fill in around them
+    records = [configure_telemetry.make_record(
+        xml_file, output_file, backend='qsub' if qsub else 'local',
+        threads=threads, seed=seed, epoch=epoch,
+        extra_configure_options=extra_configure_options)
+        for xml_file, output_file in job_list]
+
+    job_id_list = []
+    for i in order_longest_first(records, cost_model):
+        xml_file, output_file = job_list[i]
+        record = records[i]
+        input_basename_wo_ext = xmlio.xml_basename_wo_ext(xml_file)
+        output_prefix = os.path.splitext(output_file)[0]
+
+        # configure can only read plain xml
+        if xmlio.is_compressed(xml_file):
+            configure_input = output_prefix + '.input.xml'
+            xmlio.copy(xml_file, configure_input)
+            cleanup_files = [configure_input]
+        else:
+            configure_input = xml_file
+            cleanup_files = []
+
+        if cost_model is not None:
+            walltime, pmem = cost_model.qsub_resources(record)
+            record['predicted_runtime'] = cost_model.predict_runtime(record)
+        else:
+            walltime, pmem = '12:00:00', '16gb'
+
+        command = _configure_command(configure_path, configure_input, output_file,
+                                     epoch, seed, threads,
+                                     extra_configure_options)
 
         if qsub:
-            # Construct qsub command to submit job
+            # Construct qsub command to submit job. The job script also
+            # records how long configure took and its exit status
             job_name = input_basename_wo_ext
-            command = 'echo "{}" | qsub -l pmem=16gb -l '.format(command)
-            command += 'walltime=12:00:00 -l nodes=1:ppn={} '.format(threads)
-            command += '-o {}/{}.stdout '.format(output_dir,
-                                                 output_basename_wo_ext)
-            command += '-e {}/{}.stderr '.format(output_dir,
-                                                 output_basename_wo_ext)
+            script = configure_telemetry.job_script(
+                command, os.path.abspath(output_prefix + '.status'),
+                cleanup_files=[os.path.abspath(filename) for filename in cleanup_files])
+            logging.info('Submitting command: {}'.format(command))
+            command = 'qsub -l pmem={} -l '.format(pmem)
+            command += 'walltime={} -l nodes=1:ppn={} '.format(walltime, threads)
+            command += '-o {}.stdout '.format(output_prefix)
+            command += '-e {}.stderr '.format(output_prefix)
             command += '-N {} {} -'.format(job_name, extra_qsub_options)
             logging.info('Running command: {}'.format(command))
-            job_id = _run_command(command)
+            with instrumentation.phase('submit'):
+                job_id = _run_command(command, input=script)
             job_id_list.append(job_id)
+            configure_telemetry.write_pending(record, output_prefix + '.telemetry.json')
 
         else:
             logging.info('Running command: {}'.format(command))
-            _run_command(command)
+            with instrumentation.phase('configure'):
+                exit_status = configure_telemetry.run_local(
+                    command, record, output_prefix + '.stdout',
+                    output_prefix + '.stderr')
+            for filename in cleanup_files:
+                os.remove(filename)
+            configure_telemetry.append_history(history_file, [record])
+            if exit_status != 0:
+                raise subprocess.CalledProcessError(exit_status, command)
 
     if sync and qsub and len(job_id_list) > 0:
-        jobs_names = ':'.join(job_id_list)
-        command = 'echo "echo Done" | qsub  -W depend=afterany:{} '.format(jobs_names)
-        command += '-o /dev/null -e /dev/null'
-        logging.info('Running command: {}'.format(command))
-        sync_job = subprocess.check_output(command, shell=True).decode(
-            "utf-8").strip()
-        command = 'qstat -f {} | grep job_state'.format(sync_job)
-        state = _run_command(command)
-        while 'H' in state:
-            time.sleep(10)
+        with instrumentation.phase('sync'):
+            jobs_names = ':'.join(job_id_list)
+            command = 'echo "echo Done" | qsub  -W depend=afterany:{} '.format(jobs_names)
+            command += '-o /dev/null -e /dev/null'
+            logging.info('Running command: {}'.format(command))
+            sync_job = subprocess.check_output(command, shell=True).decode(
+                "utf-8").strip()
+            command = 'qstat -f {} | grep job_state'.format(sync_job)
             state = _run_command(command)
+            while 'H' in state:
+                time.sleep(10)
+                state = _run_command(command)
+
+    # Add the telemetry of any finished qsub jobs to the history
+    configure_telemetry.collect_pending(output_dir, history_file)
 
     return output_file_list
 
 
+def configure_fields_multistage(xml_file_list, output_dir, multistage,
+                                extra_configure_options='', compression=None,
+                                **kwargs):
+    """
+    Run configure several times, each time freezing the previously allocated
+    fibres and adding the targets down to the next targprio boundary.
+
+    Parameters
+    ----------
+    xml_file_list : list of str
+        A list of input OB XML files.
+    output_dir : str
+        Name of the directory which will contains the output XML files. The
+        intermediate stages are written to subdirectories of it.
+    multistage : list of float
+        The targprio boundaries of each stage (all > 0).
+    extra_configure_options : str, optional
+        Extra options to be passed to configure.
+    compression : str, optional
+        Compress the intermediate empty and pre-configure XML files ('gz' or
+        'zst').
+    overwrite : bool, optional
+        Configure every field and stage again rather than resuming.
+    **kwargs
+        Passed on to configure_fields.
+
+    The status of each field and stage is kept in multistage_manifest.json in
+    output_dir, so a run that was interrupted or had failures only
+    configures again the fields and stages that didn't finish, or whose input
+    has changed since they were configured.
+
+    Returns
+    -------
+    output_file_list : list of str
+        A list with the output XML files of the final stage.
+    """
+
+    assert all(prio > 0 for prio in multistage), \
+        'All your multistage targprio boundaries should be > 0'
+
+    overwrite = kwargs.pop('overwrite', False)
+    manifest = MultistageManifest(os.path.join(output_dir, MANIFEST_FILENAME),
+                                  settings={'multistage': list(multistage),
+                                            'extra_configure_options': extra_configure_options,
+                                            'epoch': kwargs.get('epoch'),
+                                            'seed': kwargs.get('seed')})
+    # The outputs of a run with other settings are stale, so they are all
+    # configured again
+    overwrite = overwrite or manifest.settings_changed
+    if overwrite:
+        manifest.fields = {}
+
+    # Keep the telemetry of all the stages together
+    if kwargs.get('history_file') is None:
+        kwargs['history_file'] = os.path.join(output_dir, configure_telemetry.HISTORY_FILENAME)
+
+    targ_prio_boundaries = list(multistage) + [-1]  # We give the last stage a negative targprio so nothing gets filtered
+
+    base_configure_options = extra_configure_options
+    # for the first run we use --sky_search=0
+    extra_configure_options = base_configure_options + ' --sky_search=0'
+
+    intermediate_post_configure_dir = os.path.join(output_dir, 'stage-0-empty')
+    os.makedirs(intermediate_post_configure_dir, exist_ok=True)
+    with instrumentation.phase('copy-empty'):
+        intermediate_post_configured_files = _copy_empty_xmls(xml_file_list, intermediate_post_configure_dir,
+                                                              compression=compression)
+
+    for stage, targprio_boundary in enumerate(targ_prio_boundaries):
+        intermediate_pre_configure_dir = os.path.join(output_dir, 'stage-{}-pre-configure'.format(stage))
+        os.makedirs(intermediate_pre_configure_dir, exist_ok=True)
+
+        with instrumentation.phase('filter'):
+            intermediate_pre_configure_files = _filter_xmls_by_targprio(xml_file_list,
+                                                                        intermediate_post_configured_files,
+                                                                        intermediate_pre_configure_dir,
+                                                                        targprio_boundary,
+                                                                        compression=compression)
+        logging.debug(intermediate_post_configured_files)
+        logging.debug(intermediate_pre_configure_files)
+
+        if targprio_boundary < 0:
+            # Final configuration
+            stage_output_dir = output_dir
+        else:
+            stage_output_dir = os.path.join(output_dir, 'stage-{}-post-configure'.format(stage))
+            os.makedirs(stage_output_dir, exist_ok=True)
+
+        intermediate_post_configured_files = [_get_output_filename(xml_file, stage_output_dir)
+                                              for xml_file in intermediate_pre_configure_files]
+        fields = [os.path.basename(xml_file) for xml_file in xml_file_list]
+        stage_files = list(zip(fields, intermediate_pre_configure_files, intermediate_post_configured_files))
+
+        todo = []
+        for field, pre_configure_file, post_configure_file in stage_files:
+            if manifest.is_complete(field, stage, pre_configure_file, post_configure_file):
+                logging.info('Stage {} of {} is already complete'.format(stage, field))
+            elif not overwrite and not manifest.existed and os.path.exists(post_configure_file):
+                # Output from before there was a manifest
+                logging.info('Using existing file {}'.format(post_configure_file))
+                manifest.record(field, stage, pre_configure_file, post_configure_file)
+            else:
+                todo.append((field, pre_configure_file, post_configure_file))
+
+        try:
+            configure_fields([pre_configure_file for _, pre_configure_file, _ in todo], stage_output_dir,
+                             extra_configure_options=base_configure_options, overwrite=True,
+                             **kwargs)
+        finally:
+            for field, pre_configure_file, post_configure_file in todo:
+                manifest.record(field, stage, pre_configure_file, post_configure_file)
+            manifest.save()
+        # for all apart from the first run we use --preallocate-guide=0
+        extra_configure_options = base_configure_options + ' --preallocate-guide=0'
+
+    return intermediate_post_configured_files
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
@@ -252,10 +472,33 @@ if __name__ == '__main__':
                              'be run a second time allocating spare fibres to targprio>=2, '
                              'and a final time for any remaining fibres.')
 
+    parser.add_argument('--history', dest='history_file', default=None,
+                        help='json lines file to append the telemetry of each '
+                             'configure run to. Defaults to '
+                             'configure_history.jsonl in the output directory')
+
+    parser.add_argument('--cost_model', default='auto',
+                        choices=['auto', 'none'],
+                        help='With auto, predict the runtime and memory of '
+                             'each field from the configure history to run '
+                             'the longest fields first and request per job '
+                             'qsub resources. With none, order the fields by '
+                             'their number of targets and request the default '
+                             'resources')
+
+    parser.add_argument('--compression', default='none',
+                        choices=['none', 'gz', 'zst'],
+                        help='compression of the intermediate XML files of a '
+                             'multistage configure')
+
+    instrumentation.add_metrics_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
+    metrics = instrumentation.start_stage('configure', args.metrics)
+
     if not os.path.exists(args.output_dir):
         logging.info('Creating the output directory')
         os.makedirs(args.output_dir)
@@ -275,7 +518,9 @@ if __name__ == '__main__':
     else:
         threads = args.threads
 
-    print(args.multistage)
+    logging.debug(args.multistage)
+
+    cost_model = 'auto' if args.cost_model == 'auto' else None
 
     if args.multistage[0] <= 0:
         # Single stage configure
@@ -287,49 +532,22 @@ if __name__ == '__main__':
                          overwrite=args.overwrite,
                          seed=args.seed,
                          threads=threads,
-                         extra_configure_options=args.extra_configure_options)
+                         extra_configure_options=args.extra_configure_options,
+                         history_file=args.history_file,
+                         cost_model=cost_model)
     else:
-        # multistage stage configure
-
-        assert all(prio > 0 for prio in args.multistage), \
-            'All your multistage targprio boundaries should be > 0'
-
-        targ_prio_boundaries = args.multistage + [-1]  # We give the last stage a negative targprio so nothing gets filtered
-
-        # for the first run we use --sky_search=0
-        extra_configure_options = args.extra_configure_options + ' --sky_search=0'
-        output_dir = args.output_dir
-
-        intermediate_post_configure_dir = os.path.join(args.output_dir, 'stage-0-empty')
-        os.makedirs(intermediate_post_configure_dir, exist_ok=True)
-        intermediate_post_configured_files = _copy_empty_xmls(args.xml_file_list, intermediate_post_configure_dir)
-
-        for stage, targprio_boundary in enumerate(targ_prio_boundaries):
-            intermediate_pre_configure_dir = os.path.join(args.output_dir, 'stage-{}-pre-configure'.format(stage))
-            os.makedirs(intermediate_pre_configure_dir, exist_ok=True)
-
-            intermediate_pre_configure_files = _filter_xmls_by_targprio(args.xml_file_list,
-                                                                     intermediate_post_configured_files,
-                                                                     intermediate_pre_configure_dir,
-                                                                     targprio_boundary)
-            print(intermediate_post_configured_files)
-            print(intermediate_pre_configure_files)
-
-            if targprio_boundary < 0:
-                # Final configuration
-                output_dir = args.output_dir
-            else:
-                output_dir = os.path.join(args.output_dir, 'stage-{}-post-configure'.format(stage))
-                os.makedirs(output_dir, exist_ok=True)
-
-            intermediate_post_configured_files = configure_fields(intermediate_pre_configure_files, output_dir,
-                                                             epoch=args.epoch,
-                                                             sync=args.sync,
-                                                             qsub=qsub,
-                                                             configure_path=args.configure_path,
-                                                             overwrite=args.overwrite,
-                                                             seed=args.seed,
-                                                             threads=threads,
-                                                             extra_configure_options=args.extra_configure_options)
-            # for all apart from the first run we use --preallocate-guide=0
-            extra_configure_options = args.extra_configure_options + ' --preallocate-guide=0'
+        configure_fields_multistage(args.xml_file_list, args.output_dir,
+                                    args.multistage,
+                                    compression=args.compression,
+                                    epoch=args.epoch,
+                                    sync=args.sync,
+                                    qsub=qsub,
+                                    configure_path=args.configure_path,
+                                    overwrite=args.overwrite,
+                                    seed=args.seed,
+                                    threads=threads,
+                                    extra_configure_options=args.extra_configure_options,
+                                    history_file=args.history_file,
+                                    cost_model=cost_model)
+
+    metrics.finish()
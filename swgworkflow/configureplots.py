@@ -5,16 +5,13 @@ import logging
 import os
 import os.path
 
-import dataframe_image as dfi
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
-from astropy.table import Table
-
-from swgworkflow.xmlanalysis import parse_configured_xmls
+# The plotting and table libraries are slow to import so are imported where they are needed. This keeps --help and
+# argument checking fast when dvc launches this script.
 
 
 def plot_assignment(configured_table, x='GAIA_RA', y='GAIA_DEC', figsize=(12, 7), flipy=False):
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(1, 2, figsize=figsize)
     idx = (configured_table['ASSIGNED'] == False)
     ax[0].plot(configured_table[x][idx],
@@ -54,6 +51,9 @@ def plot_assignment(configured_table, x='GAIA_RA', y='GAIA_DEC', figsize=(12, 7)
 
 
 def assignment_vs_targprio(targets, figsize=(5, 8)):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, ax = plt.subplots(2, 1, sharex='all', figsize=figsize)
     sns.barplot(
         data=targets,
@@ -93,6 +93,9 @@ def add_distance_to_field_center(df, summaries, radius_boundaries=(0.0, 0.1, 0.2
 
 def plot_assigned_vs_distance_to_field_center(targets, summaries,
                                               radius_boundaries=(0.0, 0.1, 0.2, 0.4, 1.0)):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     targets = targets.copy()
     print()
 
@@ -131,6 +134,9 @@ def plot_assigned_vs_distance_to_field_center(targets, summaries,
 
 
 def summary_by_source_list(files):
+    import pandas as pd
+    from astropy.table import Table
+
     data = []
     for file in files:
         basename = os.path.basename(file)
@@ -156,6 +162,8 @@ def extract_targprogs(targets):
 
 
 def targprog_confusion(targets):
+    import pandas as pd
+
     targprogs = extract_targprogs(targets)
     confusion = []
     for class_one in targprogs:
@@ -170,6 +178,7 @@ def targprog_confusion(targets):
 
 
 def plot_confusion(df, title=None, **kwargs):
+    import seaborn as sns
     from matplotlib.colors import LogNorm
 
     numbers = targprog_confusion(df)
@@ -180,6 +189,8 @@ def plot_confusion(df, title=None, **kwargs):
 
 
 def summary_by_targprog(targets):
+    import pandas as pd
+
     targprogs = extract_targprogs(targets)
     table = []
     for this_class in targprogs:
@@ -266,6 +277,14 @@ if __name__ == '__main__':
     elif args.plot == 'source_list':
         plot_targprio_by_sourcelist = True
 
+    import dataframe_image as dfi
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    from astropy.table import Table
+
+    from swgworkflow.xmlanalysis import parse_configured_xmls
+
     plot_format = args.file_format
     plot_prefix = os.path.join(args.output_dir, args.prefix)
     os.makedirs(args.output_dir, exist_ok=True)
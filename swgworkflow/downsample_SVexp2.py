@@ -4,14 +4,25 @@ import argparse
 import copy
 import logging
 
-import astropy.table
 import numpy as np
-from astropy.table import Table
+
+# How the targprios of the SV Exp2 catalogue are changed
+TARGPRIO_MAP = ((10.0, 10.0), (9.0, 8.0), (8.0, 2.0),
+                (6.0, 3.0), (4.0, 2.0), (2.0, 1.0))
+
+
+def make_targprio_map(only_prio=0.0):
+    """TARGPRIO_MAP with the targprios below only_prio mapped to zero, which drops those targets."""
+    return [(old_targprio, 0.0 if old_targprio < only_prio else new_targprio)
+            for old_targprio, new_targprio in TARGPRIO_MAP]
 
 
 def alter_catalogue(input_file, output_file, downsample_low_prio=1.0,
                     sky_downsample=0.6,
                     overwrite=False, seed=None, targprio_map=None):
+    import astropy.table
+    from astropy.table import Table
+
     if seed is not None:
         np.random.seed(seed)
     source_catalogue = Table.read(input_file)
@@ -84,13 +95,7 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
-    targprio_map = [(10.0, 10.0), (9.0, 8.0), (8.0, 2.0),
-                    (6.0, 3.0), (4.0, 2.0), (2.0, 1.0)]
-
-    # Make the targprio map to zero when we want to drop those targets
-    for idx, (old_targprio, new_targprio) in enumerate(targprio_map):
-        if old_targprio < args.only_prio:
-            targprio_map[idx] = (old_targprio, 0.0)
+    targprio_map = make_targprio_map(args.only_prio)
 
     alter_catalogue(args.input_catalogue, args.output_catalogue,
                     downsample_low_prio=args.downsample_low_prio,
@@ -0,0 +1,165 @@
+import contextlib
+import os
+
+import numpy as np
+
+# FITS files are made of blocks of this many bytes
+FITS_BLOCK = 2880
+
+
+def chunk_rows(row_bytes, max_memory_mb, overhead=4):
+    """
+    How many rows of a table to process at once to stay within max_memory_mb.
+
+    :param row_bytes: the size of an output row [bytes]
+    :param max_memory_mb: the memory ceiling [MB]
+    :param overhead: how many copies of a chunk are alive at once (input, output and temporaries)
+    """
+    return max(1, int(max_memory_mb * 1024 ** 2 // (row_bytes * overhead)))
+
+
+@contextlib.contextmanager
+def atomic_output(output_file):
+    """
+    Give a temporary file in the directory of output_file to write to, and move it into place once it's complete,
+    so an interrupted or failed write never leaves a partial output_file behind.
+
+    :param output_file: the file to write in the end
+    """
+    tmp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file) + '.tmp.fits')
+    try:
+        yield tmp_file
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _definitions(columns):
+    # Only the definitions of the columns, without any data they carry (which astropy would otherwise read)
+    from astropy.io import fits
+    from astropy.io.fits.column import KEYWORD_ATTRIBUTES
+
+    return fits.ColDefs([fits.Column(**{attribute: getattr(column, attribute) for attribute in KEYWORD_ATTRIBUTES})
+                         for column in columns])
+
+
+class TableReader:
+    """
+    Read a FITS binary table a chunk of rows at a time, so the whole table never has to be in memory.
+
+    The chunks are the rows as they are stored in the file (big endian, before any scaling). They are read
+    with plain file reads rather than a memory map, so the memory of a chunk is released once it is done with.
+
+    :param filename: the FITS file
+    :param hdu: the index of the table HDU
+    """
+
+    def __init__(self, filename, hdu=1):
+        from astropy.io import fits
+
+        self.filename = filename
+        with fits.open(filename, memmap=True) as hdul:
+            self.primary_header = hdul[0].header.copy()
+            self.header = hdul[hdu].header.copy()
+            self.columns = _definitions(hdul[hdu].columns)
+            self._offset = hdul.fileinfo(hdu)['datLoc']
+        for column in self.columns:
+            assert 'P' not in column.format and 'Q' not in column.format, \
+                'Variable length column {} in {} cannot be streamed'.format(column.name, filename)
+        self.n_rows = self.header['NAXIS2']
+        self.dtype = np.dtype([(column.name, column.dtype.newbyteorder('>')) for column in self.columns])
+        assert self.dtype.itemsize == self.header['NAXIS1'], 'Unexpected row size in {}'.format(filename)
+
+    def iter_chunks(self, n_rows):
+        """Yield (start, records) chunks of n_rows rows."""
+        with open(self.filename, 'rb') as fd:
+            fd.seek(self._offset)
+            for start in range(0, self.n_rows, n_rows):
+                yield start, np.fromfile(fd, dtype=self.dtype, count=min(n_rows, self.n_rows - start))
+
+
+def column_values(columns, records, name):
+    """The (scaled) values of a numerical column of raw records, as astropy would read them."""
+    values = records[name]
+    column = columns[name]
+    bscale = 1 if column.bscale is None else column.bscale
+    bzero = 0 if column.bzero is None else column.bzero
+    if bscale == 1 and bzero == 0:
+        return values.astype(values.dtype.newbyteorder('='))
+    if values.dtype.kind == 'i' and bscale == 1 and bzero == 2 ** (8 * values.itemsize - 1):
+        # The FITS convention for unsigned integers
+        return (values.astype(values.dtype.newbyteorder('=')).view('u{}'.format(values.itemsize)) ^
+                np.uint64(bzero).astype('u{}'.format(values.itemsize)))
+    return values * bscale + bzero
+
+
+def decoded_column(records, name):
+    """The values of a text column of raw records as str, without trailing spaces."""
+    values = records[name]
+    if values.dtype.kind == 'S':
+        values = np.char.decode(values, 'ascii')
+    return np.char.rstrip(values.astype(str))
+
+
+def null_mask(columns, records, name):
+    """Which values of an integer column of raw records are the column's TNULL (i.e. masked when read as a Table)."""
+    values = records[name]
+    null = columns[name].null
+    if null is None or values.dtype.kind not in 'iu':
+        return np.zeros(len(values), dtype=bool)
+    return values == null
+
+
+class TableWriter:
+    """
+    Write a FITS binary table a chunk of rows at a time, so the whole table never has to be in memory.
+
+    The headers are written straight away (the number of rows has to be known in advance) and the rows are
+    appended with write().
+
+    :param filename: the output file
+    :param columns: the astropy.io.fits ColDefs of the table
+    :param n_rows: the total number of rows that will be written
+    :param header: the header of an existing table to copy the other keywords from
+    :param primary_header: the header of the primary HDU
+    """
+
+    def __init__(self, filename, columns, n_rows, header=None, primary_header=None):
+        from astropy.io import fits
+
+        hdu = fits.BinTableHDU.from_columns(_definitions(columns), header=header, nrows=0)
+        hdu.header['NAXIS2'] = n_rows
+        # FITS tables are big endian whatever the machine
+        self.dtype = np.dtype([(name, hdu.data.dtype[name].newbyteorder('>')) for name in hdu.data.dtype.names])
+        self.n_rows = n_rows
+        self.rows_written = 0
+        self._fd = open(filename, 'wb')
+        self._fd.write(fits.PrimaryHDU(header=primary_header).header.tostring().encode('ascii'))
+        self._fd.write(hdu.header.tostring().encode('ascii'))
+
+    def empty(self, n):
+        """An array of n output rows to fill in and write."""
+        return np.zeros(n, dtype=self.dtype)
+
+    def write(self, records):
+        """Append rows (with the dtype of empty()) to the table."""
+        assert records.dtype == self.dtype
+        self._fd.write(records.tobytes())
+        self.rows_written += len(records)
+
+    def close(self):
+        assert self.rows_written == self.n_rows, \
+            'Wrote {} rows rather than {}'.format(self.rows_written, self.n_rows)
+        data_bytes = self.n_rows * self.dtype.itemsize
+        self._fd.write(b'\0' * (-data_bytes % FITS_BLOCK))
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fd.close()
@@ -0,0 +1,112 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+# The stage currently being recorded (if any). phase() is a no-op without one so library functions can always
+# mark their phases.
+_active_stage = None
+
+
+def _max_rss_mb(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return max_rss / 1024 ** 2
+    return max_rss / 1024
+
+
+class StageMetrics:
+    """
+    Wall time, cpu time, peak memory and per-phase timers of a pipeline stage.
+
+    :param stage: the name of the stage
+    :param metrics_file: where to write the metrics (json) when the stage finishes. A csv of the phase timings
+        for dvc plots is written alongside it. If None nothing is written.
+    """
+
+    def __init__(self, stage, metrics_file=None):
+        self.stage = stage
+        self.metrics_file = metrics_file
+        self.phases = {}
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._start_children = os.times()
+        self.result = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the stage. Repeated phases are summed."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def as_dict(self):
+        """The metrics recorded so far as a dictionary."""
+        children = os.times()
+        return {'stage': self.stage,
+                'wall_time': time.perf_counter() - self._start_wall,
+                'cpu_time': time.process_time() - self._start_cpu,
+                'children_cpu_time': (children.children_user - self._start_children.children_user +
+                                      children.children_system - self._start_children.children_system),
+                'peak_rss_mb': _max_rss_mb(resource.RUSAGE_SELF),
+                'children_peak_rss_mb': _max_rss_mb(resource.RUSAGE_CHILDREN),
+                'phases': dict(self.phases)}
+
+    def write(self, metrics_file):
+        """Write the metrics to metrics_file (json) and the phase timings to a csv with the same name."""
+        metrics = self.as_dict()
+        output_directory = os.path.dirname(metrics_file)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        with open(metrics_file, 'w') as fd:
+            json.dump(metrics, fd, indent=2)
+        with open(os.path.splitext(metrics_file)[0] + '.csv', 'w', newline='') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(['phase', 'seconds'])
+            for name, seconds in metrics['phases'].items():
+                writer.writerow([name, seconds])
+        return metrics
+
+    def finish(self):
+        """Stop recording, log a summary and write the metrics if a metrics_file was given."""
+        global _active_stage
+        if _active_stage is self:
+            _active_stage = None
+        self.result = self.as_dict()
+        logging.info('Stage {} took {:.1f}s (cpu {:.1f}s), peak memory {:.0f}MB'.format(
+            self.stage, self.result['wall_time'], self.result['cpu_time'], self.result['peak_rss_mb']))
+        if self.metrics_file is not None:
+            self.write(self.metrics_file)
+        return self.result
+
+
+def start_stage(stage, metrics_file=None):
+    """Start recording the metrics of a stage. Call finish() on the result when the stage is done."""
+    global _active_stage
+    _active_stage = StageMetrics(stage, metrics_file=metrics_file)
+    return _active_stage
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a phase of the stage currently being recorded (does nothing if no stage is being recorded)."""
+    if _active_stage is None:
+        yield
+    else:
+        with _active_stage.phase(name):
+            yield
+
+
+def add_metrics_argument(parser):
+    """Add the --metrics option shared by the swgworkflow scripts to an argparse parser."""
+    parser.add_argument('--metrics', default=None,
+                        help='write timing and memory metrics of this stage to '
+                             'this json file (and the phase timings to a csv '
+                             'with the same name)')
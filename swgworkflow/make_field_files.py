@@ -3,71 +3,159 @@
 import yaml
 import argparse
 import os
-import copy
-import astropy.table
+import numpy as np
 
-from weaveworkflow.mos.workflow.mos_stage1 import create_mos_field_cat
-from astropy.table import Table
+from swgworkflow import instrumentation
 
-params_file = "params.yaml"
 
-with open(params_file, 'r') as fd:
-    params = yaml.safe_load(fd)
+def load_params(params_file="params.yaml"):
+    with open(params_file, 'r') as fd:
+        params = yaml.safe_load(fd)
+    return params
 
 
-if __name__ == '__main__':
+def make_field_table(task, footprint_tables=None):
+    """
+    Build the table of fields expected by create_mos_field_cat from a
+    footprint entry in params.yaml, with one row per field per survey.
 
-    parser = argparse.ArgumentParser(
-        description='Makes fits files of fields from footprints.')
+    :param task: the footprint entry of a submission in params.yaml
+    :param footprint_tables: optional dictionary used to cache the footprint
+        tables by filename when building several submissions
+    :return: an astropy Table of fields
+    """
+    from astropy.table import Table
 
-    parser.add_argument('--output',
-                        help="""Where to place the output field file.""")
+    footprint_file = task['footprint_file']
+    if footprint_tables is None:
+        footprint_tables = {}
+    if footprint_file not in footprint_tables:
+        footprint_tables[footprint_file] = Table.read(footprint_file)
+    footprint = footprint_tables[footprint_file]
 
-    parser.add_argument('submission',
-                        help="""Which top level object in params.yaml to 
-                        process.""")
+    # Duplicate the fields for each survey (all the fields of the first
+    # survey, then all those of the second...) by indexing every column once
+    surveys = task['surveys']
+    targsrvys, max_fibres = surveys['targsrvys'], surveys['max_fibres']
+    assert len(targsrvys) == len(max_fibres), \
+        'Need a max_fibres for each of the targsrvys'
+    n_fields = len(footprint)
+    field_table = footprint[np.tile(np.arange(n_fields), len(targsrvys))]
 
-    args = parser.parse_args()
+    # Reformat fits table into expected form
+    field_table['PROGTEMP'] = task['progtemp']
+    field_table['OBSTEMP'] = task['obstemp']
+    field_table.rename_column('NAME', 'FIELD_NAME')
+    field_table.rename_column('RA', 'FIELD_RA')
+    field_table.rename_column('DEC', 'FIELD_DEC')
+    field_table['TARGSRVY'] = np.repeat(targsrvys, n_fields)
+    field_table['MAX_FIBRES'] = np.repeat(max_fibres, n_fields)
+    return field_table
 
-    assert args.submission in params['submission'], \
-        f"Didnt find {args.submission} in {params_file}"
 
+def make_field_file(params, submission, output_field_file,
+                    footprint_tables=None):
+    """
+    Write the field file of a submission in params.yaml.
 
-    mos_field_template = params['field_template']
+    :param params: the contents of params.yaml
+    :param submission: which submission in params.yaml to process
+    :param output_field_file: where to write the field file
+    :param footprint_tables: optional cache of footprint tables by filename
+    :return: the table of fields that was written
+    """
+    from weaveworkflow.mos.workflow.mos_stage1 import create_mos_field_cat
 
-    output_field_file = args.output
+    mos_field_template = params['field_template']
 
     output_directory = os.path.dirname(output_field_file)
     if not os.path.isdir(output_directory):
         os.makedirs(output_directory)
 
-    task = params['submission'][args.submission]['footprint']
-
-    # Reformat fits table into expected form
-    field_table = Table.read(task['footprint_file'])
-    field_table['PROGTEMP'] = task['progtemp']
-    field_table['OBSTEMP'] = task['obstemp']
-    field_table.rename_column('NAME', 'FIELD_NAME')
-    field_table.rename_column('RA', 'FIELD_RA')
-    field_table.rename_column('DEC', 'FIELD_DEC')
+    task = params['submission'][submission]['footprint']
 
-    # Duplicate table for each survey
-    surveys = task['surveys']
-    per_survey_tables = []
-    for targsrvy, max_fibres in zip(surveys['targsrvys'], surveys[
-        'max_fibres']):
-        field_table['TARGSRVY'] = targsrvy
-        field_table['MAX_FIBRES'] = max_fibres
-        per_survey_tables += [copy.deepcopy(field_table)]
-    field_table = astropy.table.vstack(per_survey_tables)
+    with instrumentation.phase('build'):
+        field_table = make_field_table(task, footprint_tables=footprint_tables)
 
     trimester = task['keywords']['trimester']
     report_verbosity = task['keywords']['report_verbosity']
     author = task['keywords']['author']
     cc_report = task['keywords']['cc_report']
 
+    with instrumentation.phase('write'):
+        create_mos_field_cat(mos_field_template, field_table, output_field_file,
+                             trimester, author,
+                             report_verbosity=report_verbosity,
+                             cc_report=cc_report)
+    return field_table
+
+
+def make_field_files(params, submissions, output_root='output'):
+    """
+    Write the field files of several submissions in params.yaml to
+    output_root/<submission>/fields.fits, reading each footprint only once.
+
+    :param params: the contents of params.yaml
+    :param submissions: which submissions in params.yaml to process
+    :param output_root: directory containing the output of each submission
+    :return: a list of the field files written
+    """
+    footprint_tables = {}
+    output_files = []
+    for submission in submissions:
+        output_field_file = os.path.join(output_root, submission, 'fields.fits')
+        make_field_file(params, submission, output_field_file,
+                        footprint_tables=footprint_tables)
+        output_files.append(output_field_file)
+    return output_files
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Makes fits files of fields from footprints.')
+
+    parser.add_argument('--output',
+                        help="""Where to place the output field file when
+                        processing a single submission.""")
+
+    parser.add_argument('--output_root', default='output',
+                        help="""When processing several submissions, the
+                        field files are placed in
+                        output_root/<submission>/fields.fits""")
+
+    parser.add_argument('--params', dest='params_file', default='params.yaml',
+                        help="""The params file describing the submissions.""")
+
+    parser.add_argument('--all', dest='all_submissions', action='store_true',
+                        help="""Process every submission in params.yaml""")
+
+    parser.add_argument('submission', nargs='*',
+                        help="""Which top level object(s) in params.yaml to
+                        process.""")
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    metrics = instrumentation.start_stage('make-field-files', args.metrics)
+
+    params = load_params(args.params_file)
+
+    if args.all_submissions:
+        submissions = list(params['submission'])
+    else:
+        submissions = args.submission
+    assert len(submissions) > 0, 'No submissions given'
+    for submission in submissions:
+        assert submission in params['submission'], \
+            f"Didnt find {submission} in {args.params_file}"
 
-    create_mos_field_cat(mos_field_template, field_table, output_field_file,
-                         trimester, author, report_verbosity=report_verbosity,
-                         cc_report=cc_report)
+    if args.output is not None:
+        assert len(submissions) == 1, \
+            '--output can only be used with a single submission'
+        make_field_file(params, submissions[0], args.output)
+    else:
+        make_field_files(params, submissions, output_root=args.output_root)
 
+    metrics.finish()
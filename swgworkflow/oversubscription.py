@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from swgworkflow import instrumentation, xmlio
+from swgworkflow.xmlio import PLATE_A_FIBRES, PLATE_B_FIBRES
+
+PLATE_FIBRES = {'PLATE_A': PLATE_A_FIBRES, 'PLATE_B': PLATE_B_FIBRES}
+# Annuli of the radial density profiles [deg]
+RADIUS_BOUNDARIES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+TARGET_ATTRIBUTES = ('targuse', 'targsrvy', 'targprio', 'targra', 'targdec')
+
+
+def _angular_distance(ra1, dec1, ra2, dec2):
+    """Angular distance between positions [deg] (haversine)."""
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(angle, dtype=float)) for angle in (ra1, dec1, ra2, dec2))
+    sin_ddec = np.sin((dec2 - dec1) / 2)
+    sin_dra = np.sin((ra2 - ra1) / 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(sin_ddec ** 2 + np.cos(dec1) * np.cos(dec2) * sin_dra ** 2)))
+
+
+def _read_xml_field(xml_file):
+    # The field and the attributes of its targets, streaming the xml
+    field = {}
+    targets = {attribute: [] for attribute in TARGET_ATTRIBUTES}
+    num_fields = 0
+    for _, element in xmlio.iterparse(xml_file):
+        if element.tag == 'target':
+            for attribute in TARGET_ATTRIBUTES:
+                targets[attribute].append(element.get(attribute))
+            element.clear()
+        elif element.tag == 'field':
+            num_fields += 1
+            field['ra'] = float(element.get('RA_d'))
+            field['dec'] = float(element.get('Dec_d'))
+            element.clear()
+        elif element.tag == 'configure':
+            field['plate'] = element.get('plate')
+            for attribute in ('max_sky', 'max_calibration', 'max_guide'):
+                field[attribute] = int(element.get(attribute, 0))
+        elif element.tag == 'survey':
+            field['max_' + element.get('name')] = int(element.get('max_fibres'))
+        elif element.tag == 'observation':
+            field['field_name'] = element.get('name')
+    assert num_fields == 1, "Only a single field is allowed in MOS configurations"
+    if field.get('field_name') is None:
+        field['field_name'] = xmlio.xml_basename_wo_ext(xml_file)
+    return field, targets
+
+
+def read_xml_fields(xml_file_list):
+    """
+    Read the fields and targets of OB xmls (e.g. from 04-cleaned). Each file is streamed and only the attributes
+    of the targets needed here are kept.
+
+    :param xml_file_list: the OB xmls
+    :return: a tuple of pandas dataframes (fields, targets). fields has a row per field with field_name, ra, dec,
+        plate, plate_fibres, max_sky, max_calibration, max_guide and a max_<survey> column per survey. targets has
+        field_name, targuse, targsrvy, targprio, targra and targdec.
+    """
+    import pandas as pd
+
+    fields = []
+    targets = []
+    for xml_file in xml_file_list:
+        field, field_targets = _read_xml_field(xml_file)
+        field_targets = pd.DataFrame(field_targets, columns=TARGET_ATTRIBUTES)
+        field_targets.insert(0, 'field_name', field['field_name'])
+        fields.append(field)
+        targets.append(field_targets)
+
+    fields = pd.DataFrame(fields)
+    assert fields['field_name'].is_unique, 'Field names are repeated in the xmls: {}'.format(
+        sorted(set(fields['field_name'][fields['field_name'].duplicated()])))
+    fields['plate_fibres'] = fields['plate'].map(PLATE_FIBRES)
+    targets = pd.concat(targets, ignore_index=True)
+    # Targets without a priority (e.g. automatic sky positions) get -1 like in xmlanalysis
+    targets['targprio'] = targets['targprio'].astype(float).fillna(-1)
+    for column in ('targra', 'targdec'):
+        targets[column] = targets[column].astype(float)
+    return fields, targets
+
+
+def read_catalogue_fields(field_file, catalogue_files, radius=1.0):
+    """
+    The fields of a field file (from make_field_files) and the catalogue targets that fall in each, for a look at
+    a submission before its xmls have been made.
+
+    :param field_file: the fields.fits of the submission (a row per field and survey)
+    :param catalogue_files: the target catalogues
+    :param radius: the field radius [deg]
+    :return: a tuple of pandas dataframes (fields, targets) like read_xml_fields. Sky, guide and calibration
+        targets are only added to the xmls later, so only the catalogue targets are counted and their quotas are
+        taken as zero. The plate is taken from a PLATE column if there is one, otherwise the smaller plate is
+        assumed.
+    """
+    import pandas as pd
+    from astropy.table import Table
+
+    from swgworkflow.partition_catalogues import partition_rows
+
+    field_table = Table.read(field_file)
+    fields = []
+    for name in dict.fromkeys(field_table['FIELD_NAME']):
+        rows = field_table[field_table['FIELD_NAME'] == name]
+        field = {'field_name': str(name).strip(), 'ra': float(rows['FIELD_RA'][0]), 'dec': float(rows['FIELD_DEC'][0]),
+                 'plate': str(rows['PLATE'][0]).strip() if 'PLATE' in rows.colnames else None,
+                 'max_sky': 0, 'max_calibration': 0, 'max_guide': 0}
+        for row in rows:
+            field['max_' + str(row['TARGSRVY']).strip()] = int(row['MAX_FIBRES'])
+        fields.append(field)
+    fields = pd.DataFrame(fields)
+    fields['plate_fibres'] = fields['plate'].map(PLATE_FIBRES).fillna(min(PLATE_FIBRES.values())).astype(int)
+
+    targets = []
+    for catalogue_file in catalogue_files:
+        catalogue = Table.read(catalogue_file)
+        field_rows = partition_rows(catalogue['GAIA_RA'], catalogue['GAIA_DEC'], fields['ra'], fields['dec'],
+                                    radius=radius)
+        for field_name, rows in zip(fields['field_name'], field_rows):
+            part = catalogue[rows]
+            targets.append(pd.DataFrame({
+                'field_name': field_name,
+                'targuse': np.char.strip(np.asarray(part['TARGUSE'], dtype=str)),
+                'targsrvy': np.char.strip(np.asarray(part['TARGSRVY'], dtype=str)),
+                'targprio': np.asarray(part['TARGPRIO'], dtype=float),
+                'targra': np.asarray(part['GAIA_RA'], dtype=float),
+                'targdec': np.asarray(part['GAIA_DEC'], dtype=float)}))
+    targets = pd.concat(targets, ignore_index=True) if targets else pd.DataFrame(
+        columns=['field_name'] + list(TARGET_ATTRIBUTES))
+    return fields, targets
+
+
+def oversubscription_table(fields, targets, radius_boundaries=RADIUS_BOUNDARIES):
+    """
+    How oversubscribed each field is, computed for all the fields at once.
+
+    The science fibre budget of a field is the fibres of its plate less those that will go to sky, guide and
+    calibration targets (their max_* quotas, or the number of such targets if fewer). The oversubscription is
+    the number of science targets (TARGUSE T) over this budget, and for each survey over the smaller of the
+    budget and the max_fibres of the survey.
+
+    :param fields: the fields from read_xml_fields or read_catalogue_fields
+    :param targets: the targets from read_xml_fields or read_catalogue_fields
+    :param radius_boundaries: the annuli of the radial density profiles [deg]
+    :return: a pandas dataframe with a row per field and the columns
+        - field_name, ra, dec, plate, plate_fibres, science_budget and oversubscription
+        - n_<targuse>: the number of targets of each TARGUSE
+        - n_prio_<targprio>: the number of science targets of each TARGPRIO
+        - oversubscription_<survey>: the oversubscription of each survey
+        - density_<r0>-<r1>: the density of science targets in each annulus [deg^-2]
+    """
+    import pandas as pd
+
+    table = fields.set_index('field_name')
+    table = table[[column for column in ('ra', 'dec', 'plate', 'plate_fibres') if column in table]]
+
+    counts = targets.groupby(['field_name', 'targuse']).size().unstack(fill_value=0)
+    counts.columns = ['n_' + str(targuse) for targuse in counts.columns]
+    table = table.join(counts).fillna({column: 0 for column in counts.columns})
+    for targuse in ('T', 'S', 'G', 'C'):
+        if 'n_' + targuse not in table:
+            table['n_' + targuse] = 0
+
+    science = targets[targets['targuse'] == 'T']
+    by_prio = science.groupby(['field_name', 'targprio']).size().unstack(fill_value=0)
+    by_prio.columns = ['n_prio_{:g}'.format(targprio) for targprio in by_prio.columns]
+    table = table.join(by_prio).fillna({column: 0 for column in by_prio.columns})
+
+    quotas = fields.set_index('field_name')
+    reserved = sum(np.minimum(quotas[quota], table[count])
+                   for quota, count in (('max_sky', 'n_S'), ('max_guide', 'n_G'), ('max_calibration', 'n_C')))
+    table['science_budget'] = table['plate_fibres'] - reserved
+    table['oversubscription'] = table['n_T'] / table['science_budget']
+
+    by_survey = science.groupby(['field_name', 'targsrvy']).size().unstack(fill_value=0)
+    for survey in by_survey.columns:
+        max_fibres = quotas['max_' + survey] if 'max_' + survey in quotas else np.nan
+        budget = np.minimum(max_fibres, table['science_budget'])
+        table['oversubscription_' + survey] = by_survey[survey].reindex(table.index, fill_value=0) / budget
+
+    # The radial profiles from the distance of every science target to its field centre at once
+    centres = quotas.loc[science['field_name'], ['ra', 'dec']].to_numpy()
+    distance = _angular_distance(centres[:, 0], centres[:, 1], science['targra'], science['targdec'])
+    annulus = pd.cut(distance, radius_boundaries, include_lowest=True, labels=False)
+    profile = science.assign(annulus=annulus).groupby(['field_name', 'annulus']).size().unstack(fill_value=0)
+    profile = profile.reindex(index=table.index, columns=range(len(radius_boundaries) - 1), fill_value=0)
+    # Area of each annulus on the sphere [deg^2]
+    boundaries = np.radians(radius_boundaries)
+    area = 2 * np.pi * (np.cos(boundaries[:-1]) - np.cos(boundaries[1:])) * np.degrees(1) ** 2
+    for i, (r0, r1) in enumerate(zip(radius_boundaries[:-1], radius_boundaries[1:])):
+        table['density_{:g}-{:g}'.format(r0, r1)] = profile[i] / area[i]
+
+    count_columns = [column for column in table if column.startswith('n_')]
+    table[count_columns] = table[count_columns].astype(int)
+    return table.reset_index()
+
+
+def plot_oversubscription(table, figsize=(10, 4)):
+    """Bar chart of the oversubscription of each field, most oversubscribed first."""
+    import matplotlib.pyplot as plt
+
+    table = table.sort_values('oversubscription', ascending=False)
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.bar(table['field_name'], table['oversubscription'], color='C0', alpha=0.7)
+    ax.axhline(1, color='k', linestyle='--', label='Fibres = targets')
+    ax.axhline(table['oversubscription'].median(), color='C1', linestyle=':', label='Median')
+    ax.set_ylabel('Science targets / science fibres')
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def plot_radial_profiles(table, figsize=(6, 4)):
+    """The density of science targets against distance from the field centre, a line per field."""
+    import matplotlib.pyplot as plt
+
+    columns = [column for column in table if column.startswith('density_')]
+    annuli = [[float(r) for r in column[len('density_'):].split('-')] for column in columns]
+    middle = [(r0 + r1) / 2 for r0, r1 in annuli]
+    fig, ax = plt.subplots(figsize=figsize)
+    for _, row in table.iterrows():
+        ax.plot(middle, row[columns].to_numpy(dtype=float), color='C0', alpha=0.3)
+    ax.plot(middle, table[columns].median().to_numpy(dtype=float), color='k', label='Median field')
+    ax.set_xlabel('Distance from field centre [deg]')
+    ax.set_ylabel('Science targets [deg$^{-2}$]')
+    ax.set_yscale('log')
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def plot_targprio_counts(table, figsize=(10, 4)):
+    """Stacked bar chart of the science targets of each TARGPRIO in each field."""
+    import matplotlib.pyplot as plt
+
+    columns = sorted([column for column in table if column.startswith('n_prio_')],
+                     key=lambda column: float(column[len('n_prio_'):]))
+    table = table.sort_values('oversubscription', ascending=False)
+    fig, ax = plt.subplots(figsize=figsize)
+    bottom = np.zeros(len(table))
+    for column in columns:
+        ax.bar(table['field_name'], table[column], bottom=bottom, label=column[len('n_prio_'):])
+        bottom += table[column].to_numpy()
+    ax.plot(table['field_name'], table['science_budget'], 'k_', markersize=12, label='Science fibres')
+    ax.set_ylabel('Science targets')
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.legend(title='TARGPRIO')
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Diagnose how oversubscribed each field is before running '
+                    'configure')
+
+    parser.add_argument('xml_file', nargs='*',
+                        help="""OB XML files e.g. from 04-cleaned""")
+
+    parser.add_argument('--fields', dest='field_file', default=None,
+                        help="""A field file from make_field_files, to use with
+                        --catalogues instead of xml files""")
+
+    parser.add_argument('--catalogues', nargs='+', default=[],
+                        help="""Catalogues containing targets (with --fields)""")
+
+    parser.add_argument('--radius', default=1.0, type=float,
+                        help='Radius of the fields [deg] (with --fields)')
+
+    parser.add_argument('--output', default='oversubscription.csv',
+                        help='The csv table of the fields')
+
+    parser.add_argument('--plot_dir', default=None,
+                        help='Directory to write the summary plots to')
+
+    parser.add_argument('--file_format', default='png',
+                        help='File format of the plots')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    assert (len(args.xml_file) > 0) != (args.field_file is not None), \
+        'Give either xml files or --fields and --catalogues'
+
+    metrics = instrumentation.start_stage('oversubscription', args.metrics)
+
+    with instrumentation.phase('read'):
+        if args.field_file is not None:
+            fields, targets = read_catalogue_fields(args.field_file, args.catalogues, radius=args.radius)
+        else:
+            fields, targets = read_xml_fields(args.xml_file)
+
+    with instrumentation.phase('analyse'):
+        table = oversubscription_table(fields, targets)
+    table.to_csv(args.output, index=False)
+
+    oversubscribed = table.sort_values('oversubscription', ascending=False)
+    logging.info('Oversubscription of the {} fields: median {:.2f}, min {:.2f} ({}), max {:.2f} ({})'.format(
+        len(table), table['oversubscription'].median(),
+        oversubscribed['oversubscription'].iloc[-1], oversubscribed['field_name'].iloc[-1],
+        oversubscribed['oversubscription'].iloc[0], oversubscribed['field_name'].iloc[0]))
+
+    if args.plot_dir is not None:
+        with instrumentation.phase('plot'):
+            os.makedirs(args.plot_dir, exist_ok=True)
+            for name, plot in (('oversubscription', plot_oversubscription),
+                               ('radial_profiles', plot_radial_profiles),
+                               ('targprio_counts', plot_targprio_counts)):
+                fig = plot(table)
+                fig.savefig(os.path.join(args.plot_dir, '{}.{}'.format(name, args.file_format)))
+
+    metrics.finish()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import copy
+import glob
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shlex
+
+from swgworkflow import instrumentation
+from swgworkflow.configure_manifest import file_hash
+from swgworkflow.configurefields import _is_tool
+from swgworkflow.make_field_files import load_params
+
+# The settings a sweep can vary: those that alter the catalogues (with
+# downsample_SVexp2.py, with the defaults of its command line) and those
+# passed to configure (as in params.yaml)
+CATALOGUE_SETTINGS = {'downsample_low_prio': 1.0, 'sky_downsample': 1.0, 'only_prio': 0.0, 'downsample_seed': 1}
+CONFIGURE_SETTINGS = ('multistage', 'configure_options', 'configure_epoch', 'configure_seed')
+# The stages that only depend on the catalogues, which are shared by the runs
+# that only differ in how they are configured
+PREPARE_STAGES = ('make-field-files', 'create-empty-xmls', 'partition-catalogues', 'add-targets',
+                  'add-guide-and-calib-stars', 'clean-xmls')
+PREPARED_FILENAME = 'prepared.json'
+RESULT_FILENAME = 'result.json'
+COMPARISON_FILENAME = 'comparison.csv'
+
+
+def parameter_hash(parameters):
+    """The sha256 of a json serialisable dictionary of parameters, which doesn't depend on the order of its keys."""
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+def _normalise(name, value):
+    # So that e.g. 0.5 and '0.5', or '""' and '' for configure_options, are the same run
+    if name in CATALOGUE_SETTINGS:
+        return type(CATALOGUE_SETTINGS[name])(value)
+    if name == 'configure_seed':
+        return int(value)
+    if name == 'multistage':
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(str(prio) for prio in value)
+        return ' '.join('{:g}'.format(float(prio)) for prio in str(value).split())
+    if name == 'configure_options':
+        return ' '.join(shlex.split(str(value)))
+    return str(value)
+
+
+def expand_grid(grid):
+    """
+    The runs of a grid of settings.
+
+    :param grid: a dictionary from each setting to a list of its values (or a single value), whose product is run,
+        or a list of such dictionaries whose runs are added together
+    :return: a list of dictionaries of the settings of each run, which may have repeats
+    """
+    if isinstance(grid, dict):
+        grid = [grid]
+    runs = []
+    for subgrid in grid:
+        unknown = set(subgrid) - set(CATALOGUE_SETTINGS) - set(CONFIGURE_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown settings {}, the sweep can only vary {}'.format(
+                sorted(unknown), list(CATALOGUE_SETTINGS) + list(CONFIGURE_SETTINGS)))
+        names = list(subgrid)
+        values = [subgrid[name] if isinstance(subgrid[name], list) else [subgrid[name]] for name in names]
+        runs += [dict(zip(names, combination)) for combination in itertools.product(*values)]
+    return runs
+
+
+def plan_sweep(params, submission, runs):
+    """
+    Work out what each run of a sweep over a submission of params.yaml does, and the hash of its parameters.
+
+    A run alters the catalogues of the submission with downsample_SVexp2.py if it sets any of
+    CATALOGUE_SETTINGS, and overrides the CONFIGURE_SETTINGS of the submission that it sets. The runs are
+    identified by two hashes: prepare_key, of everything the cleaned xmls depend on (the submission, the contents
+    of its footprint file and catalogues, and the CATALOGUE_SETTINGS), and run_key, of prepare_key and the
+    CONFIGURE_SETTINGS.
+
+    :param params: the contents of params.yaml
+    :param submission: the submission to vary
+    :param runs: the settings of each run, e.g. from expand_grid
+    :return: a list with a dictionary for each run with its settings, catalogue and configure parameters,
+        prepare_key and run_key
+    """
+    assert submission in params['submission'], f"Didnt find {submission} in the params"
+    item = params['submission'][submission]
+
+    # The output of a run doesn't depend on where its inputs are, only on what is in them
+    base = {name: value for name, value in item.items()
+            if name not in CONFIGURE_SETTINGS + ('catalogue_dir', 'external_cats', 'internal_cats')}
+    base['footprint_hash'] = file_hash(item['footprint']['footprint_file'])
+    base['catalogue_hashes'] = {os.path.basename(catalogue): file_hash(catalogue)
+                                for catalogue in sorted(glob.glob(os.path.join(item['catalogue_dir'], '*.fits')))}
+    base['field_template'] = params['field_template']
+    # configure's default seed for the submissions that don't set one
+    configure_defaults = dict(item)
+    configure_defaults.setdefault('configure_seed', 42)
+
+    planned = []
+    for settings in runs:
+        catalogue = {}
+        if any(name in settings for name in CATALOGUE_SETTINGS):
+            catalogue = {name: _normalise(name, settings.get(name, default))
+                         for name, default in CATALOGUE_SETTINGS.items()}
+        configure = {name: _normalise(name, settings.get(name, configure_defaults[name]))
+                     for name in CONFIGURE_SETTINGS}
+        prepare_key = parameter_hash({'submission': base, 'catalogue': catalogue})
+        planned.append({'settings': settings, 'catalogue': catalogue, 'configure': configure,
+                        'prepare_key': prepare_key,
+                        'run_key': parameter_hash({'prepare_key': prepare_key, 'configure': configure})})
+    return planned
+
+
+def _prepared_dir(sweep_dir, prepare_key):
+    return os.path.join(sweep_dir, 'prepared', prepare_key[:16])
+
+
+def _run_dir(sweep_dir, run_key):
+    return os.path.join(sweep_dir, 'runs', run_key[:16])
+
+
+def _write_json(data, filename):
+    with open(filename + '.tmp', 'w') as fd:
+        json.dump(data, fd, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def _submission_params(params, submission, output_dir, **changes):
+    # params with only the submission, renamed after the directory of its
+    # output so that SubmissionPipeline writes there
+    params = copy.deepcopy(params)
+    item = params['submission'][submission]
+    item.update(changes)
+    name = os.path.basename(output_dir)
+    params['submission'] = {name: item}
+    return params, name
+
+
+def prepare(params, submission, catalogue, output_dir, **pipeline_kwargs):
+    """
+    Run the PREPARE_STAGES of a submission, first altering its catalogues with alter_catalogue if catalogue has any
+    settings, unless output_dir was prepared before.
+
+    :param params: the contents of params.yaml
+    :param submission: the submission
+    :param catalogue: the CATALOGUE_SETTINGS to alter the catalogues with
+    :param output_dir: the output directory of the submission
+    :param pipeline_kwargs: passed on to SubmissionPipeline
+    """
+    from swgworkflow.downsample_SVexp2 import alter_catalogue, make_targprio_map
+    from swgworkflow.pipeline import SubmissionPipeline
+
+    prepared_file = os.path.join(output_dir, PREPARED_FILENAME)
+    if os.path.exists(prepared_file):
+        return
+    os.makedirs(output_dir, exist_ok=True)
+
+    changes = {}
+    if catalogue:
+        catalogue_dir = os.path.join(output_dir, 'catalogues')
+        os.makedirs(catalogue_dir, exist_ok=True)
+        for target_cat in sorted(glob.glob(os.path.join(params['submission'][submission]['catalogue_dir'],
+                                                        '*.fits'))):
+            alter_catalogue(target_cat, os.path.join(catalogue_dir, os.path.basename(target_cat)),
+                            downsample_low_prio=catalogue['downsample_low_prio'],
+                            sky_downsample=catalogue['sky_downsample'],
+                            seed=catalogue['downsample_seed'],
+                            targprio_map=make_targprio_map(catalogue['only_prio']),
+                            overwrite=True)
+        changes['catalogue_dir'] = catalogue_dir
+
+    params, name = _submission_params(params, submission, output_dir, **changes)
+    # Anything there is left over from an attempt that didn't finish
+    pipeline_kwargs['overwrite'] = True
+    SubmissionPipeline(params, name, output_root=os.path.dirname(output_dir), **pipeline_kwargs).run(PREPARE_STAGES)
+    _write_json({'catalogue': catalogue}, prepared_file)
+
+
+def summarise_run(xml_file_list):
+    """
+    The figures of merit of a configured submission: the number of fields, science targets and those assigned,
+    the fraction assigned (overall and of each targprio), the sum of the targprio of the assigned science targets
+    (as scored by configure_ensemble) and the number of parked fibres.
+
+    :param xml_file_list: the configured xmls
+    :return: a dictionary of the figures of merit
+    """
+    from swgworkflow.xmlanalysis import group_assign_df, parse_configured_xmls
+
+    if len(xml_file_list) == 0:
+        raise RuntimeError('No configured xmls to summarise')
+    summary, targets = parse_configured_xmls(xml_file_list)
+    science = targets[targets['targuse'] == 'T']
+    assigned = science[science['assigned']]
+    result = {'fields': len(summary), 'targets': len(science), 'assigned': len(assigned),
+              'fraction': len(assigned) / len(science) if len(science) > 0 else float('nan'),
+              'weighted_priority': float(assigned['targprio'].sum()),
+              'parked': int(summary['parked'].sum())}
+    by_targprio = group_assign_df(science, by=('targprio',), number=False)
+    for row in by_targprio[by_targprio['assigned']].itertuples():
+        result['fraction_targprio_{:g}'.format(float(row.targprio))] = row.fraction
+    return result
+
+
+def run_configure(params, submission, configure, prepared_dir, output_dir, **pipeline_kwargs):
+    """
+    Configure the cleaned xmls of a prepared submission with the CONFIGURE_SETTINGS configure and summarise the
+    result with summarise_run, unless output_dir has been configured before.
+
+    A run that was interrupted carries on where it stopped, as configurefields.py does.
+
+    :param params: the contents of params.yaml
+    :param submission: the submission
+    :param configure: the CONFIGURE_SETTINGS
+    :param prepared_dir: the output directory of prepare
+    :param output_dir: the output directory of the run
+    :param pipeline_kwargs: passed on to SubmissionPipeline
+    :return: a tuple of the result of summarise_run and whether it was cached
+    """
+    from swgworkflow.pipeline import SubmissionPipeline
+
+    result_file = os.path.join(output_dir, RESULT_FILENAME)
+    if os.path.exists(result_file):
+        with open(result_file) as fd:
+            return json.load(fd)['result'], True
+
+    os.makedirs(output_dir, exist_ok=True)
+    cleaned_dir = os.path.join(output_dir, '04-cleaned')
+    if not os.path.lexists(cleaned_dir):
+        os.symlink(os.path.relpath(os.path.join(prepared_dir, '04-cleaned'), output_dir), cleaned_dir)
+
+    params, name = _submission_params(params, submission, output_dir, **configure)
+    pipeline = SubmissionPipeline(params, name, output_root=os.path.dirname(output_dir), **pipeline_kwargs)
+    pipeline.run(['configure'])
+    result = summarise_run(sorted(glob.glob(os.path.join(output_dir, '05-configured', '*.xml'))))
+    _write_json({'configure': configure, 'prepared_dir': prepared_dir, 'result': result}, result_file)
+    return result, False
+
+
+def run_sweep(params, submission, runs, sweep_dir, workers=1, **pipeline_kwargs):
+    """
+    Run a sweep over the settings of a submission of params.yaml in parallel, caching each run by the hash of its
+    parameters (see plan_sweep).
+
+    The PREPARE_STAGES of each distinct catalogue are run once, into sweep_dir/prepared/<prepare_key>, and each
+    distinct run is then configured in sweep_dir/runs/<run_key> as soon as its catalogue has been prepared. Runs
+    and catalogues that were done by a previous sweep into sweep_dir, and repeated runs, aren't done again. A run
+    that fails is reported in the table and tried again by the next sweep.
+
+    :param params: the contents of params.yaml
+    :param submission: the submission to vary
+    :param runs: the settings of each run, e.g. from expand_grid
+    :param sweep_dir: the output directory of the sweep
+    :param workers: how many processes prepare and configure the runs at once
+    :param pipeline_kwargs: passed on to SubmissionPipeline
+    :return: a pandas dataframe with a row per run: its settings, run_key, status and the result of summarise_run
+    """
+    import pandas as pd
+
+    with instrumentation.phase('plan'):
+        planned = plan_sweep(params, submission, runs)
+    by_prepare_key = {}
+    for run in planned:
+        by_prepare_key.setdefault(run['prepare_key'], {})[run['run_key']] = run
+    logging.info('{} runs, of which {} are distinct, from {} catalogues'.format(
+        len(planned), sum(len(distinct) for distinct in by_prepare_key.values()), len(by_prepare_key)))
+
+    outcomes = {}
+    with instrumentation.phase('run'):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for prepare_key, distinct in by_prepare_key.items():
+                run = next(iter(distinct.values()))
+                future = executor.submit(prepare, params, submission, run['catalogue'],
+                                         _prepared_dir(sweep_dir, prepare_key), **pipeline_kwargs)
+                pending[future] = ('prepare', prepare_key)
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, key = pending.pop(future)
+                    error = future.exception()
+                    if kind == 'prepare':
+                        if error is not None:
+                            logging.error('Preparing {} failed: {}'.format(_prepared_dir(sweep_dir, key), error))
+                            for run_key in by_prepare_key[key]:
+                                outcomes[run_key] = ('failed: {}'.format(error), {})
+                            continue
+                        for run_key, run in by_prepare_key[key].items():
+                            future = executor.submit(run_configure, params, submission, run['configure'],
+                                                     _prepared_dir(sweep_dir, key), _run_dir(sweep_dir, run_key),
+                                                     **pipeline_kwargs)
+                            pending[future] = ('run', run_key)
+                    elif error is not None:
+                        logging.error('Run {} failed: {}'.format(_run_dir(sweep_dir, key), error))
+                        outcomes[key] = ('failed: {}'.format(error), {})
+                    else:
+                        result, cached = future.result()
+                        logging.info('Run {} {}'.format(_run_dir(sweep_dir, key), 'was cached' if cached else 'done'))
+                        outcomes[key] = ('cached' if cached else 'done', result)
+
+    setting_columns = []
+    for run in planned:
+        setting_columns += [name for name in run['settings'] if name not in setting_columns]
+    rows = []
+    for run in planned:
+        status, result = outcomes[run['run_key']]
+        row = dict(run['settings'])
+        row.update({'run_key': run['run_key'][:16], 'status': status})
+        row.update(result)
+        rows.append(row)
+    table = pd.DataFrame(rows)
+    first = setting_columns + ['run_key', 'status']
+    return table[first + [column for column in table if column not in first]]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Configure a submission over a grid of settings, in '
+                    'parallel, and compare the results')
+
+    parser.add_argument('sweep_file',
+                        help="""yaml file with the submission in params.yaml
+                        to vary and the grid of settings: a dictionary (or a
+                        list of dictionaries) from each setting to its values.
+                        The settings are {} (see downsample_SVexp2.py) and {}
+                        (see params.yaml)""".format(
+                            ', '.join(CATALOGUE_SETTINGS), ', '.join(CONFIGURE_SETTINGS)))
+
+    parser.add_argument('--outdir', dest='output_dir', default='output/sweep',
+                        help="""name of the directory which will contain the
+                        runs and the comparison table. Runs that are in it
+                        already aren't done again""")
+
+    parser.add_argument('--params', dest='params_file', default='params.yaml',
+                        help="""The params file describing the submissions.""")
+
+    parser.add_argument('--workers', default=0, type=int,
+                        help='Number of runs to do at once. By default all of '
+                             'them with qsub and one otherwise.')
+
+    parser.add_argument('--weaveworkflow', dest='weaveworkflow_dir',
+                        default='weaveworkflow',
+                        help="""Location of the weave workflow""")
+
+    parser.add_argument('--configure_path',
+                        default='/soft/configure/configure',
+                        help="""Path to configure executable""")
+
+    parser.add_argument('--qsub', default='auto',
+                        choices=['auto', 'yes', 'no'],
+                        help='Submit configure jobs using qsub')
+
+    parser.add_argument('--threads', default=0, type=int,
+                        help='Number of threads to run each configure with. '
+                             'By default the available cores are shared '
+                             'between the runs done at once.')
+
+    parser.add_argument('--compression', default='gz',
+                        choices=['none', 'gz', 'zst'],
+                        help='compression of the intermediate xml files')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('parameter-sweep', args.metrics)
+
+    import yaml
+
+    with open(args.sweep_file) as fd:
+        sweep = yaml.safe_load(fd)
+    runs = expand_grid(sweep['grid'])
+
+    if args.qsub == 'auto':
+        qsub = _is_tool('qsub')
+    else:
+        qsub = args.qsub == 'yes'
+
+    workers = args.workers or (len(runs) if qsub else 1)
+    if args.threads == 0:
+        if qsub:
+            threads = 8  # default of 8 threads on herts cluster
+        else:
+            threads = max(1, multiprocessing.cpu_count() // workers)
+    else:
+        threads = args.threads
+
+    table = run_sweep(load_params(args.params_file), sweep['submission'], runs, args.output_dir,
+                      workers=workers, weaveworkflow_dir=args.weaveworkflow_dir,
+                      configure_path=args.configure_path, qsub=qsub, threads=threads,
+                      compression=args.compression)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    table.to_csv(os.path.join(args.output_dir, COMPARISON_FILENAME), index=False)
+    logging.info('Wrote the comparison of {} runs to {}'.format(
+        len(table), os.path.join(args.output_dir, COMPARISON_FILENAME)))
+
+    metrics.finish()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from swgworkflow import instrumentation, xmlio
+
+
+def _unit_vectors(ra, dec):
+    """Cartesian unit vectors of positions given in degrees."""
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra),
+                            np.cos(dec) * np.sin(ra),
+                            np.sin(dec)])
+
+
+def _field_centre(xml_file):
+    root = xmlio.parse(xml_file).getroot()
+    field_list = root.findall('.//field')
+    assert len(field_list) == 1, "Only a single field is allowed in MOS configurations"
+    return float(field_list[0].get('RA_d')), float(field_list[0].get('Dec_d'))
+
+
+def field_shard_dir(shard_dir, xml_file):
+    """The directory containing the catalogue shards of the field in xml_file."""
+    return os.path.join(shard_dir, xmlio.xml_basename_wo_ext(xml_file))
+
+
+def partition_rows(ra, dec, field_ra, field_dec, radius=1.0):
+    """
+    Find the rows of a catalogue within radius of each field centre.
+
+    A KD-tree is built once on the unit vectors of the catalogue positions and
+    queried with every field centre, so the cost is close to linear in the
+    size of the catalogue rather than scaling with fields x catalogue.
+
+    :param ra: right ascension of the catalogue rows [deg]
+    :param dec: declination of the catalogue rows [deg]
+    :param field_ra: right ascension of the field centres [deg]
+    :param field_dec: declination of the field centres [deg]
+    :param radius: the radius around each field centre [deg]
+    :return: a list with the sorted row indices for each field
+    """
+    from scipy.spatial import cKDTree
+
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    good = np.nonzero(np.isfinite(ra) & np.isfinite(dec))[0]
+    tree = cKDTree(_unit_vectors(ra[good], dec[good]))
+    # chord length between two unit vectors separated by radius
+    chord = 2 * np.sin(np.radians(radius) / 2)
+    field_rows = tree.query_ball_point(_unit_vectors(field_ra, field_dec), chord)
+    return [np.sort(good[np.asarray(rows, dtype=int)]) for rows in field_rows]
+
+
+def partition_catalogues(xml_file_list, catalogue_files, output_dir,
+                         radius=1.0, margin=0.1, overwrite=False):
+    """
+    Write, for each field, the part of each catalogue that could fall in it.
+
+    The shards of a field are written to output_dir/<xml basename>/ with the
+    same filenames as the catalogues, so that the targets of a field can be
+    added using only its shards.
+
+    :param xml_file_list: the (empty) field xmls
+    :param catalogue_files: the target catalogues
+    :param output_dir: the directory which will contain the shards
+    :param radius: the field radius [deg]
+    :param margin: extra distance beyond the field radius to include [deg]
+    :param overwrite: overwrite existing shards
+    :return: a list of the shard directories of each field
+    """
+    from astropy.table import Table
+
+    centres = np.array([_field_centre(xml_file) for xml_file in xml_file_list]).reshape(-1, 2)
+    shard_dirs = [field_shard_dir(output_dir, xml_file) for xml_file in xml_file_list]
+    for shard_dir in shard_dirs:
+        os.makedirs(shard_dir, exist_ok=True)
+
+    for catalogue_file in catalogue_files:
+        with instrumentation.phase('read'):
+            catalogue = Table.read(catalogue_file)
+        with instrumentation.phase('index'):
+            field_rows = partition_rows(catalogue['GAIA_RA'], catalogue['GAIA_DEC'],
+                                        centres[:, 0], centres[:, 1],
+                                        radius=radius + margin)
+        for shard_dir, rows in zip(shard_dirs, field_rows):
+            output_file = os.path.join(shard_dir, os.path.basename(catalogue_file))
+            if os.path.exists(output_file) and not overwrite:
+                logging.info('Skipping {} as it already exists.'.format(output_file))
+                continue
+            with instrumentation.phase('write'):
+                catalogue[rows].write(output_file, overwrite=overwrite)
+        logging.info('Partitioned {} rows of {} into {} fields ({} rows in total).'.format(
+            len(catalogue), catalogue_file, len(shard_dirs), sum(len(rows) for rows in field_rows)))
+
+    return shard_dirs
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Split the catalogues into the targets near each field')
+
+    parser.add_argument('xml_file', nargs='+',
+                        help="""One or more empty OB XML files""")
+
+    parser.add_argument('--catalogues', nargs='+',
+                        help="""Catalogues containing targets""")
+
+    parser.add_argument('--outdir', dest='output_dir', default='output',
+                        help="""name of the directory which will contain a
+                        directory of catalogue shards for each field""")
+
+    parser.add_argument('--radius', default=1.0, type=float,
+                        help='Radius of the fields [deg]')
+
+    parser.add_argument('--margin', default=0.1, type=float,
+                        help='Extra distance beyond the field radius to '
+                             'include targets from [deg]')
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite the output files')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('partition-catalogues', args.metrics)
+
+    if not os.path.exists(args.output_dir):
+        logging.info('Creating the output directory')
+        os.makedirs(args.output_dir)
+
+    partition_catalogues(args.xml_file, args.catalogues, args.output_dir,
+                         radius=args.radius, margin=args.margin,
+                         overwrite=args.overwrite)
+
+    metrics.finish()
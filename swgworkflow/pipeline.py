@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import shlex
+import subprocess
+
+from swgworkflow import configure_telemetry, instrumentation
+from swgworkflow.make_field_files import load_params
+
+# The stages of dvc.yaml in the order they have to be run
+STAGES = ('make-field-files', 'create-empty-xmls', 'partition-catalogues',
+          'add-targets', 'add-guide-and-calib-stars', 'clean-xmls', 'configure',
+          'add-configured-to-catalogues',
+          'add-configured-to-external-source-lists',
+          'add-configured-to-internal-source-lists')
+
+
+def _run_script(command):
+    logging.info('Running command: {}'.format(' '.join(command)))
+    subprocess.check_call(command)
+
+
+class SubmissionPipeline:
+    """
+    Run the stages of a submission in params.yaml in a single process.
+
+    The intermediate xmls written by the swgworkflow stages are compressed
+    with compression, as in dvc.yaml.
+
+    The swgworkflow stages run in-process and hand what they produce (the
+    table of fields, the parsed configured xmls and the configured
+    catalogues) to the following stages in memory rather than re-reading it
+    from disk. The weave workflow stages are run as scripts. Every stage
+    writes exactly the outputs of the corresponding dvc stage, so stages can
+    also be run one at a time.
+    """
+
+    def __init__(self, params, submission, output_root='output',
+                 weaveworkflow_dir='weaveworkflow',
+                 configure_path='/soft/configure/configure', qsub=False,
+                 threads=0, overwrite=False, metrics=False, compression='gz'):
+        assert submission in params['submission'], \
+            f"Didnt find {submission} in the params"
+        self.params = params
+        self.submission = submission
+        self.item = params['submission'][submission]
+        self.output_dir = os.path.join(output_root, submission)
+        self.weaveworkflow_dir = weaveworkflow_dir
+        self.configure_path = configure_path
+        self.qsub = qsub
+        if threads == 0:
+            threads = 8 if qsub else multiprocessing.cpu_count()
+        self.threads = threads
+        self.overwrite = overwrite
+        self.metrics = metrics
+        self.compression = compression
+
+        # Products handed between stages in memory
+        self.field_table = None
+        self.configured_xmls = None
+        self.parsed_xmls = None
+        self.configured_catalogues = None
+
+    def _path(self, *names):
+        return os.path.join(self.output_dir, *names)
+
+    def _outdir(self, name):
+        output_dir = self._path(name)
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir
+
+    def _weave_script(self, *names):
+        return os.path.join(self.weaveworkflow_dir, 'mos', 'workflow', *names)
+
+    def make_field_files(self):
+        from swgworkflow.make_field_files import make_field_file
+
+        self.field_table = make_field_file(self.params, self.submission,
+                                           self._path('fields.fits'))
+
+    def create_empty_xmls(self):
+        _run_script([self._weave_script('mos_stage2', 'create_xml_files.py'),
+                     self._path('fields.fits'),
+                     '--outdir', self._outdir('01-empty')])
+
+    def partition_catalogues(self):
+        from swgworkflow.partition_catalogues import partition_catalogues
+
+        partition_catalogues(sorted(glob.glob(self._path('01-empty', '*.xml'))),
+                             sorted(glob.glob(os.path.join(self.item['catalogue_dir'], '*.fits'))),
+                             self._outdir('01-shards'), overwrite=self.overwrite)
+
+    def add_targets(self):
+        from swgworkflow.partition_catalogues import field_shard_dir
+
+        # Each field only needs the catalogue shards near it
+        output_dir = self._outdir('02-targets')
+        for xml_file in sorted(glob.glob(self._path('01-empty', '*.xml'))):
+            catalogues = sorted(glob.glob(os.path.join(field_shard_dir(self._path('01-shards'), xml_file), '*.fits')))
+            _run_script([self._weave_script('mos_stage3', 'add_targets_to_xmls.py'),
+                         '--catalogues'] + catalogues +
+                        ['--outdir', output_dir, xml_file])
+
+    def add_guide_and_calib_stars(self):
+        _run_script([self._weave_script('mos_stage4', 'add_guide_and_calib_stars.py'),
+                     '--outdir', self._outdir('03-guide-and-calib-stars')] +
+                    sorted(glob.glob(self._path('02-targets', '*.xml'))))
+
+    def clean_xmls(self):
+        from swgworkflow.clean_xml_targets import clean_targets
+
+        clean_targets(sorted(glob.glob(self._path('03-guide-and-calib-stars', '*.xml'))),
+                      self._outdir('04-cleaned'), overwrite=self.overwrite,
+                      compression=self.compression)
+
+    def configure(self):
+        from swgworkflow.configurefields import configure_fields, configure_fields_multistage
+
+        xml_file_list = sorted(glob.glob(self._path('04-cleaned', '*.xml*')))
+        output_dir = self._outdir('05-configured')
+        # configure_options are quoted in params.yaml for the shell
+        extra_configure_options = ' '.join(shlex.split(str(self.item['configure_options'])))
+        multistage = [float(prio) for prio in str(self.item['multistage']).split()]
+        # A submission can set configure_seed, otherwise configure's default is used
+        kwargs = dict(epoch=self.item['configure_epoch'], sync=True,
+                      seed=int(self.item.get('configure_seed', 42)),
+                      qsub=self.qsub, configure_path=self.configure_path,
+                      overwrite=self.overwrite, threads=self.threads,
+                      extra_configure_options=extra_configure_options,
+                      history_file=self._path(configure_telemetry.HISTORY_FILENAME))
+        if multistage[0] <= 0:
+            self.configured_xmls = configure_fields(xml_file_list, output_dir, **kwargs)
+        else:
+            self.configured_xmls = configure_fields_multistage(xml_file_list, output_dir, multistage,
+                                                               compression=self.compression, **kwargs)
+        self.parsed_xmls = None
+
+    def _get_parsed_xmls(self):
+        from swgworkflow.xmlanalysis import parse_configured_xmls
+
+        if self.parsed_xmls is None:
+            if self.configured_xmls is None:
+                self.configured_xmls = sorted(glob.glob(self._path('05-configured', '*.xml')))
+            self.parsed_xmls = parse_configured_xmls(self.configured_xmls)
+        return self.parsed_xmls
+
+    def add_configured_to_catalogues(self):
+        from astropy.table import Table
+        from swgworkflow.add_configured_to_catalogues import _get_output_filename, annotate_catalogue
+
+        output_dir = self._outdir('catalogs-configured')
+        summaries, xml_targets = self._get_parsed_xmls()
+        self.configured_catalogues = []
+        for target_cat in sorted(glob.glob(os.path.join(self.item['catalogue_dir'], '*.fits'))):
+            output_file = _get_output_filename(target_cat, output_dir)
+            if os.path.exists(output_file) and not self.overwrite:
+                logging.info('Using existing configured catalogue: {}'.format(output_file))
+                configured_catalogue = Table.read(output_file)
+            else:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                configured_catalogue = annotate_catalogue(Table.read(target_cat), summaries, xml_targets)
+                configured_catalogue.write(output_file)
+            configured_catalogue.meta['FILENAME'] = output_file
+            self.configured_catalogues.append(configured_catalogue)
+
+    def _get_configured_catalogues(self):
+        if self.configured_catalogues is None:
+            return sorted(glob.glob(self._path('catalogs-configured', '*.fits')))
+        return self.configured_catalogues
+
+    def _add_configured_to_source_lists(self, source_list_dir, output_name):
+        from swgworkflow.add_configured_to_source_lists import (DEFAULT_VALUES, NEW_COLUMNS,
+                                                                add_columns_to_source_lists)
+
+        output_dir = self._outdir(output_name)
+        target_cats = self._get_configured_catalogues()
+        add_columns_to_source_lists(source_files=sorted(glob.glob(os.path.join(source_list_dir, '*.fits'))),
+                                    target_cats=target_cats,
+                                    output_dir=output_dir,
+                                    new_columns=NEW_COLUMNS,
+                                    default_values=DEFAULT_VALUES,
+                                    suffix='-configured-{}'.format(self.submission),
+                                    overwrite=self.overwrite)
+
+    def add_configured_to_external_source_lists(self):
+        self._add_configured_to_source_lists(self.item['external_cats'], 'external-configured')
+
+    def add_configured_to_internal_source_lists(self):
+        self._add_configured_to_source_lists(self.item['internal_cats'], 'internal-configured')
+
+    def run(self, stages=STAGES):
+        """
+        Run the requested stages, always in the order of the pipeline.
+
+        :return: a dictionary of the metrics of each stage that was run
+        """
+        results = {}
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            logging.info('Running stage {} of {}'.format(stage, self.submission))
+            metrics_file = self._path('metrics', stage + '.json') if self.metrics else None
+            stage_metrics = instrumentation.start_stage(stage, metrics_file)
+            getattr(self, stage.replace('-', '_'))()
+            results[stage] = stage_metrics.finish()
+        return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run the stages of a submission in a single process')
+
+    parser.add_argument('submission',
+                        help="""Which top level object in params.yaml to
+                        process.""")
+
+    parser.add_argument('--stages', nargs='+', default=list(STAGES),
+                        choices=STAGES,
+                        help="""The stages to run. By default all of them.""")
+
+    parser.add_argument('--params', dest='params_file', default='params.yaml',
+                        help="""The params file describing the submissions.""")
+
+    parser.add_argument('--output_root', default='output',
+                        help="""Directory containing the output directory of
+                        each submission""")
+
+    parser.add_argument('--weaveworkflow', dest='weaveworkflow_dir',
+                        default='weaveworkflow',
+                        help="""Location of the weave workflow""")
+
+    parser.add_argument('--configure_path',
+                        default='/soft/configure/configure',
+                        help="""Path to configure executable""")
+
+    parser.add_argument('--qsub', default='auto',
+                        choices=['auto', 'yes', 'no'],
+                        help='Submit configure jobs using qsub')
+
+    parser.add_argument('--threads', default=0, type=int,
+                        help='Number of threads to run configure with. '
+                             'By default will use all available cores.')
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite the output files')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    parser.add_argument('--metrics', action='store_true',
+                        help='write the metrics of each stage to '
+                             'output_root/<submission>/metrics/<stage>.json')
+
+    parser.add_argument('--compression', default='gz',
+                        choices=['none', 'gz', 'zst'],
+                        help='compression of the intermediate xmls')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    params = load_params(args.params_file)
+
+    assert args.submission in params['submission'], \
+        f"Didnt find {args.submission} in {args.params_file}"
+
+    if args.qsub == 'auto':
+        from swgworkflow.configurefields import _is_tool
+        qsub = _is_tool('qsub')
+    else:
+        qsub = args.qsub == 'yes'
+
+    pipeline = SubmissionPipeline(params, args.submission,
+                                  output_root=args.output_root,
+                                  weaveworkflow_dir=args.weaveworkflow_dir,
+                                  configure_path=args.configure_path,
+                                  qsub=qsub, threads=args.threads,
+                                  overwrite=args.overwrite,
+                                  metrics=args.metrics,
+                                  compression=args.compression)
+    pipeline.run(args.stages)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from swgworkflow import instrumentation
+from swgworkflow.configure_manifest import file_hash
+
+# The ledger directory holds a part for each submission, the ledger merged
+# from them and the hashes of the catalogues each part was built from
+PARTS_DIR = 'parts'
+LEDGER_FILENAME = 'ledger.fits'
+STATE_FILENAME = 'state.json'
+
+# The columns read from the configured catalogues
+ID_COLUMNS = ('GAIA_ID', 'PS_ID')
+COUNT_COLUMNS = ('CONFIGURED', 'ASSIGNED')
+
+# Targets are identified by their Gaia ID and, if they have none, by their PS1
+# ID, so the key of a row is (GAIA_ID, PS_ID if GAIA_ID is 0 else 0)
+KEY_DTYPE = np.dtype([('GAIA_ID', 'i8'), ('PS_KEY', 'i8')])
+
+
+def submission_from_dir(catalogue_dir):
+    """The submission of a catalogs-configured directory of the pipeline i.e.
+    <key> in output/<key>/catalogs-configured."""
+    return os.path.basename(os.path.dirname(os.path.normpath(catalogue_dir)))
+
+
+def missing_stage_deps(dvc_file, params_file, stage='target-ledger'):
+    """
+    The submissions of params.yaml whose catalogs-configured directory isn't
+    a dependency of a stage of dvc.yaml. dvc can't derive the dependencies of
+    a stage from the keys of the params, so the target-ledger stage lists them
+    by hand and this checks that they are kept in step.
+
+    :param dvc_file: the dvc.yaml of the pipeline
+    :param params_file: the params.yaml of the pipeline
+    :param stage: the stage to check
+    :return: a list of the missing submissions
+    """
+    import yaml
+
+    with open(dvc_file) as fd:
+        deps = yaml.safe_load(fd)['stages'][stage].get('deps', [])
+    with open(params_file) as fd:
+        submissions = yaml.safe_load(fd)['submission']
+    deps = [os.path.normpath(dep) for dep in deps]
+    return [submission for submission in submissions
+            if os.path.join('output', submission, 'catalogs-configured') not in deps]
+
+
+def _filled(column):
+    return np.ma.filled(np.ma.asarray(column), 0)
+
+
+def _keys(gaia_id, ps_id):
+    keys = np.empty(len(gaia_id), dtype=KEY_DTYPE)
+    keys['GAIA_ID'] = gaia_id
+    keys['PS_KEY'] = np.where(gaia_id == 0, ps_id, 0)
+    return keys
+
+
+def _join_field_names(names):
+    # The distinct fields of a target in the order they are first met, from
+    # FIELD_NAMEs which may each be several fields joined with |
+    fields = []
+    for name in names:
+        for field in name.split('|'):
+            if field and field not in fields:
+                fields.append(field)
+    return '|'.join(fields)
+
+
+def submission_part(catalogue_files):
+    """
+    Combine the configured catalogues of a submission into one row for each
+    target, sorted by its key (see KEY_DTYPE). A target in several catalogues
+    (e.g. targeted by several surveys) has its CONFIGURED and ASSIGNED summed
+    and its fields joined.
+
+    :param catalogue_files: the catalogues of output/<key>/catalogs-configured
+    :return: an astropy Table with GAIA_ID, PS_ID, CONFIGURED, ASSIGNED and
+        FIELD_NAME
+    """
+    import pandas as pd
+    from astropy.table import Table
+
+    frames = []
+    for catalogue_file in catalogue_files:
+        with instrumentation.phase('read'):
+            catalogue = Table.read(catalogue_file, memmap=True)
+        frame = pd.DataFrame({column: _filled(catalogue[column]).astype(np.int64)
+                              for column in ID_COLUMNS + COUNT_COLUMNS})
+        if 'FIELD_NAME' in catalogue.columns:
+            frame['FIELD_NAME'] = np.char.strip(
+                np.ma.filled(np.ma.asarray(catalogue['FIELD_NAME']), '').astype(str))
+        else:
+            frame['FIELD_NAME'] = ''
+        frames.append(frame)
+        del catalogue
+
+    with instrumentation.phase('aggregate'):
+        targets = pd.concat(frames, ignore_index=True)
+        targets = targets[(targets['GAIA_ID'] != 0) | (targets['PS_ID'] != 0)]
+        targets['PS_KEY'] = np.where(targets['GAIA_ID'] == 0, targets['PS_ID'], 0)
+        grouped = targets.groupby(['GAIA_ID', 'PS_KEY'], sort=True)
+        part = grouped.agg(PS_ID=('PS_ID', 'max'), CONFIGURED=('CONFIGURED', 'sum'),
+                           ASSIGNED=('ASSIGNED', 'sum')).reset_index()
+        # Only the targets that were configured have fields, so only they need
+        # joining
+        named = targets[targets['FIELD_NAME'] != '']
+        field_names = named.groupby(['GAIA_ID', 'PS_KEY'])['FIELD_NAME'].agg(_join_field_names)
+        part['FIELD_NAME'] = field_names.reindex(
+            pd.MultiIndex.from_frame(part[['GAIA_ID', 'PS_KEY']])).fillna('').to_numpy()
+
+    table = Table()
+    for column in ID_COLUMNS + COUNT_COLUMNS:
+        table[column] = part[column].to_numpy(dtype=np.int64)
+    # A fixed width of at least one character, as FITS can't store empty text
+    # columns
+    field_name = part['FIELD_NAME'].to_numpy(dtype=str)
+    table['FIELD_NAME'] = field_name.astype('U{}'.format(max(1, field_name.dtype.itemsize // 4)))
+    return table
+
+
+def merge_parts(parts):
+    """
+    Merge the parts of each submission into the ledger: a row for each target
+    of any submission, sorted by key, with how many times it was configured and
+    assigned in each submission and in all of them.
+
+    :param parts: a dictionary from the submission keys to their parts
+    :return: an astropy Table with GAIA_ID, PS_ID, N_SUBMISSIONS (how many
+        submissions configured the target), CONFIGURED and ASSIGNED (the totals)
+        and CONFIGURED_<key> and ASSIGNED_<key> for each submission
+    """
+    from astropy.table import Table
+
+    part_keys = np.concatenate([_keys(_filled(part['GAIA_ID']), _filled(part['PS_ID']))
+                                for part in parts.values()])
+    # np.unique of the keys, but sorting the two columns with lexsort, which is
+    # much faster than sorting a structured array
+    order = np.lexsort((part_keys['PS_KEY'], part_keys['GAIA_ID']))
+    sorted_keys = part_keys[order]
+    first = np.ones(len(sorted_keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    keys = sorted_keys[first]
+    inverse = np.empty(len(part_keys), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    n_rows = len(keys)
+
+    ledger = Table()
+    ledger['GAIA_ID'] = keys['GAIA_ID'].astype(np.int64)
+    ps_id = keys['PS_KEY'].astype(np.int64)
+    n_submissions = np.zeros(n_rows, dtype=np.int16)
+    totals = {column: np.zeros(n_rows, dtype=np.int64) for column in COUNT_COLUMNS}
+    columns = {}
+    start = 0
+    for submission, part in parts.items():
+        rows = inverse[start:start + len(part)]
+        start += len(part)
+        # The PS1 ID of the targets with a Gaia ID, from any submission (each
+        # target is in a part once)
+        ps_id[rows] = np.maximum(ps_id[rows], np.asarray(part['PS_ID'], dtype=np.int64))
+        for column in COUNT_COLUMNS:
+            values = np.zeros(n_rows, dtype=np.int16)
+            values[rows] = part[column]
+            totals[column] += values
+            columns['{}_{}'.format(column, submission)] = values
+        n_submissions += columns['CONFIGURED_{}'.format(submission)] > 0
+    ledger['PS_ID'] = ps_id
+    ledger['N_SUBMISSIONS'] = n_submissions
+    for column in COUNT_COLUMNS:
+        ledger[column] = totals[column]
+    for name, values in columns.items():
+        ledger[name] = values
+    ledger.meta['SUBMISS'] = ','.join(parts)
+    return ledger
+
+
+def _submissions(ledger):
+    return [submission for submission in ledger.meta.get('SUBMISS', '').split(',') if submission]
+
+
+def _write_atomic(table, filename):
+    tmp_file = os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.tmp.fits')
+    table.write(tmp_file, overwrite=True)
+    os.replace(tmp_file, filename)
+
+
+def update_ledger(ledger_dir, submissions, rebuild=False):
+    """
+    Add submissions to the ledger, or update them, rebuilding only the parts
+    whose catalogues have changed (by sha256) since they were added. The parts
+    of submissions added earlier but not given here are kept, and the ledger
+    is merged again if any part changed.
+
+    :param ledger_dir: the ledger directory
+    :param submissions: a dictionary from submission keys to their configured
+        catalogues
+    :param rebuild: rebuild the given parts even if their catalogues haven't
+        changed
+    :return: the ledger file
+    """
+    from astropy.table import Table
+
+    parts_dir = os.path.join(ledger_dir, PARTS_DIR)
+    os.makedirs(parts_dir, exist_ok=True)
+    ledger_file = os.path.join(ledger_dir, LEDGER_FILENAME)
+    state_file = os.path.join(ledger_dir, STATE_FILENAME)
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as fd:
+            state = json.load(fd)
+
+    changed = not os.path.exists(ledger_file)
+    for submission, catalogue_files in submissions.items():
+        assert ',' not in submission, 'Submission keys cannot contain commas: {}'.format(submission)
+        part_file = os.path.join(parts_dir, submission + '.fits')
+        with instrumentation.phase('hash'):
+            hashes = [[os.path.basename(catalogue_file), file_hash(catalogue_file)]
+                      for catalogue_file in sorted(catalogue_files)]
+        if not rebuild and state.get(submission) == hashes and os.path.exists(part_file):
+            logging.info('{} is up to date in the ledger'.format(submission))
+            continue
+        logging.info('Adding {} ({} catalogues) to the ledger'.format(submission, len(hashes)))
+        part = submission_part(sorted(catalogue_files))
+        with instrumentation.phase('write'):
+            _write_atomic(part, part_file)
+        state[submission] = hashes
+        changed = True
+
+    # The state is only updated once the parts it describes are written
+    with open(state_file + '.tmp', 'w') as fd:
+        json.dump(state, fd, indent=1)
+    os.replace(state_file + '.tmp', state_file)
+
+    if changed:
+        with instrumentation.phase('read'):
+            parts = {submission: Table.read(os.path.join(parts_dir, submission + '.fits'))
+                     for submission in sorted(state)}
+        with instrumentation.phase('merge'):
+            ledger = merge_parts(parts)
+        with instrumentation.phase('write'):
+            _write_atomic(ledger, ledger_file)
+        logging.info('The ledger has {} targets from {} submissions'.format(len(ledger), len(parts)))
+    return ledger_file
+
+
+def read_ledger(ledger_dir):
+    """Read the ledger of ledger_dir (memory mapped, so only the columns used
+    are read)."""
+    from astropy.table import Table
+
+    return Table.read(os.path.join(ledger_dir, LEDGER_FILENAME), memmap=True)
+
+
+def _find(sorted_values, values):
+    # The rows of sorted_values equal to values, or -1 where there are none
+    if len(sorted_values) == 0:
+        return np.full(len(values), -1)
+    position = np.searchsorted(sorted_values, values)
+    position = np.minimum(position, len(sorted_values) - 1)
+    return np.where(sorted_values[position] == values, position, -1)
+
+
+def lookup(ledger_dir, gaia_ids=(), ps_ids=()):
+    """
+    Look up targets in the ledger by Gaia ID and/or PS1 ID, with the fields
+    they were configured in by each submission.
+
+    Gaia IDs are found by binary search as the ledger is sorted by them. PS1
+    IDs are found among the targets without a Gaia ID the same way, and among
+    the others with a scan of PS_ID.
+
+    :param ledger_dir: the ledger directory
+    :param gaia_ids: the Gaia IDs to look up
+    :param ps_ids: the PS1 IDs to look up
+    :return: an astropy Table of the rows of the ledger of the IDs that were
+        found, with FIELD_NAME_<key> for each submission
+    """
+    from astropy.table import Table
+
+    ledger = read_ledger(ledger_dir)
+    gaia_column = np.asarray(ledger['GAIA_ID'])
+    ps_column = np.asarray(ledger['PS_ID'])
+    gaia_ids = np.asarray(gaia_ids, dtype=np.int64)
+    ps_ids = np.asarray(ps_ids, dtype=np.int64)
+
+    rows = [_find(gaia_column, gaia_ids[gaia_ids != 0])]
+    if len(ps_ids) > 0:
+        # The targets without a Gaia ID come first, sorted by PS_ID
+        n_without_gaia = np.searchsorted(gaia_column, 0, side='right')
+        rows.append(_find(ps_column[:n_without_gaia], ps_ids))
+        rows.append(n_without_gaia + np.nonzero(np.isin(ps_column[n_without_gaia:], ps_ids))[0])
+    rows = np.unique(np.concatenate(rows).astype(int))
+    result = Table(ledger[rows[rows >= 0]], copy=True)
+
+    keys = _keys(np.asarray(result['GAIA_ID']), np.asarray(result['PS_ID']))
+    for submission in _submissions(ledger):
+        part = Table.read(os.path.join(ledger_dir, PARTS_DIR, submission + '.fits'), memmap=True)
+        part_rows = _find(_keys(np.asarray(part['GAIA_ID']), np.asarray(part['PS_ID'])), keys)
+        field_name = np.full(len(result), '', dtype=np.asarray(part['FIELD_NAME']).dtype)
+        field_name[part_rows >= 0] = np.asarray(part['FIELD_NAME'])[part_rows[part_rows >= 0]]
+        result['FIELD_NAME_{}'.format(submission)] = np.char.strip(field_name)
+    return result
+
+
+def summarise_ledger(ledger):
+    """
+    Survey-wide statistics of the ledger: for each submission, how many
+    targets it configured and assigned, and how many of those were also
+    configured by another submission. The last row is the same across all the
+    submissions.
+
+    :param ledger: the ledger e.g. from read_ledger
+    :return: a pandas DataFrame
+    """
+    import pandas as pd
+
+    n_submissions = np.asarray(ledger['N_SUBMISSIONS'])
+    rows = []
+    for submission in _submissions(ledger):
+        configured = np.asarray(ledger['CONFIGURED_{}'.format(submission)]) > 0
+        assigned = np.asarray(ledger['ASSIGNED_{}'.format(submission)]) > 0
+        rows.append({'submission': submission,
+                     'configured': int(configured.sum()),
+                     'assigned': int(assigned.sum()),
+                     'configured_elsewhere': int(np.sum(configured & (n_submissions > 1)))})
+    configured = np.asarray(ledger['CONFIGURED']) > 0
+    rows.append({'submission': 'all',
+                 'configured': int(configured.sum()),
+                 'assigned': int(np.sum(np.asarray(ledger['ASSIGNED']) > 0)),
+                 'configured_elsewhere': int(np.sum(n_submissions > 1))})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Keep a ledger of how often each target has been '
+                    'configured and assigned across the submissions')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser(
+        'update', help='add submissions to the ledger or update them')
+    update_parser.add_argument('catalogue_dir', nargs='+',
+                               help='the catalogs-configured directories of '
+                                    'the submissions i.e. '
+                                    'output/<key>/catalogs-configured')
+    update_parser.add_argument('--rebuild', action='store_true',
+                               help='rebuild the parts of the submissions even '
+                                    'if their catalogues have not changed')
+    update_parser.add_argument('--params', default=None,
+                               help='params.yaml of the pipeline, to check that '
+                                    'the target-ledger stage of --dvc_file '
+                                    'depends on all its submissions')
+    update_parser.add_argument('--dvc_file', default='dvc.yaml',
+                               help='dvc.yaml of the pipeline (see --params)')
+
+    lookup_parser = subparsers.add_parser(
+        'lookup', help='print the ledger entries of some targets')
+    lookup_parser.add_argument('--gaia_id', nargs='+', type=int, default=[],
+                               help='Gaia IDs to look up')
+    lookup_parser.add_argument('--ps_id', nargs='+', type=int, default=[],
+                               help='PS1 IDs to look up')
+
+    summary_parser = subparsers.add_parser(
+        'summary', help='print the survey-wide statistics of the ledger')
+    summary_parser.add_argument('--output', default=None,
+                                help='csv file to also write them to')
+
+    for subparser in (update_parser, lookup_parser, summary_parser):
+        subparser.add_argument('--ledger_dir', default='output/ledger',
+                               help='the directory of the ledger')
+        subparser.add_argument('--log_level', default='info',
+                               choices=['debug', 'info', 'warning', 'error'],
+                               help='the level for the logging messages')
+        instrumentation.add_metrics_argument(subparser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('target-ledger-{}'.format(args.command), args.metrics)
+
+    if args.command == 'update':
+        import glob
+
+        if args.params is not None:
+            missing = missing_stage_deps(args.dvc_file, args.params)
+            if missing:
+                parser.error('The target-ledger stage of {} does not depend on '
+                             'the catalogs-configured of {} in {}'.format(
+                                 args.dvc_file, ', '.join(missing), args.params))
+        update_ledger(args.ledger_dir,
+                      {submission_from_dir(catalogue_dir):
+                       glob.glob(os.path.join(catalogue_dir, '*.fits'))
+                       for catalogue_dir in args.catalogue_dir},
+                      rebuild=args.rebuild)
+    elif args.command == 'lookup':
+        lookup(args.ledger_dir, gaia_ids=args.gaia_id, ps_ids=args.ps_id).pprint_all()
+    else:
+        summary = summarise_ledger(read_ledger(args.ledger_dir))
+        print(summary.to_string(index=False))
+        if args.output is not None:
+            summary.to_csv(args.output, index=False)
+
+    metrics.finish()
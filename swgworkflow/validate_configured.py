@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+
+from swgworkflow import instrumentation, xmlio
+from swgworkflow.configurefields import _get_output_filename
+
+# The quotas of the configure element, which aren't surveys
+CONFIGURE_QUOTAS = ('max_sky', 'max_calibration', 'max_guide')
+# How many of the violations of each check are listed in the report
+MAX_REPORTED = 100
+
+
+def _parse(xml_file):
+    from swgworkflow.xmlanalysis import parse_configured_xml
+
+    try:
+        summary, targets = parse_configured_xml(xml_file)
+    except Exception as e:
+        return xml_file, None, None, '{}: {}'.format(type(e).__name__, e)
+    # The fields are told apart by their file, in case two have the same name
+    summary['xml_file'] = xml_file
+    targets['xml_file'] = xml_file
+    return xml_file, summary, targets, None
+
+
+def parse_fields(xml_file_list, workers=None):
+    """
+    Parse configured xmls in parallel.
+
+    :param xml_file_list: the configured xmls
+    :param workers: the number of processes. Defaults to the number of CPUs.
+    :return: a tuple of the summaries and targets of the fields (pandas dataframes from parse_configured_xml, with
+        an xml_file column) and a dictionary of the xmls that couldn't be parsed and why
+    """
+    import pandas as pd
+
+    summaries, targets, failed = [], [], {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for xml_file, summary, field_targets, error in executor.map(_parse, xml_file_list, chunksize=4):
+            if error is not None:
+                failed[xml_file] = error
+                continue
+            summaries.append(summary)
+            targets.append(field_targets)
+    if len(summaries) == 0:
+        return pd.DataFrame(columns=['xml_file', 'field_name']), pd.DataFrame(
+            columns=['xml_file', 'field_name', 'targsrvy', 'targid', 'targuse', 'fibreid', 'assigned']), failed
+    return pd.concat(summaries, ignore_index=True), pd.concat(targets, ignore_index=True), failed
+
+
+def duplicate_fibres(targets):
+    """The fibres given to more than one target of a field, with how many targets each was given to."""
+    assigned = targets[targets['assigned']]
+    duplicated = assigned[assigned.duplicated(['xml_file', 'fibreid'], keep=False)]
+    return duplicated.groupby(['xml_file', 'field_name', 'fibreid']).size().reset_index(name='targets')
+
+
+def repeated_targets(summary, targets):
+    """The science targets assigned in more than one field with the same PROGTEMP and OBSTEMP, with the fields."""
+    keys = ['targsrvy', 'targid', 'progtemp', 'obstemp']
+    assigned = targets[targets['assigned'] & (targets['targuse'] == 'T')]
+    assigned = assigned.merge(summary[['xml_file', 'progtemp', 'obstemp']], on='xml_file', how='left')
+    assigned = assigned.drop_duplicates(keys + ['xml_file'])
+    repeated = assigned[assigned.duplicated(keys, keep=False)]
+    return repeated.groupby(keys)['field_name'].agg(fields='size', field_names='|'.join).reset_index()
+
+
+def missing_fields(xml_file_list, cleaned_file_list):
+    """The fields of 04-cleaned that have no configured xml."""
+    import pandas as pd
+
+    configured = {xmlio.xml_basename_wo_ext(xml_file) for xml_file in xml_file_list}
+    missing = [cleaned_file for cleaned_file in cleaned_file_list
+               if xmlio.xml_basename_wo_ext(_get_output_filename(cleaned_file, '')) not in configured]
+    return pd.DataFrame({'cleaned_file': missing})
+
+
+def over_quota(summary, targets):
+    """The surveys that were assigned more fibres than their max_fibres in a field."""
+    import pandas as pd
+
+    quota_columns = [column for column in summary if column.startswith('max_') and column not in CONFIGURE_QUOTAS]
+    quotas = summary.melt(id_vars=['xml_file'], value_vars=quota_columns, var_name='targsrvy',
+                          value_name='max_fibres').dropna(subset=['max_fibres'])
+    quotas['targsrvy'] = quotas['targsrvy'].str[len('max_'):]
+    quotas['max_fibres'] = pd.to_numeric(quotas['max_fibres'])
+    assigned = targets[targets['assigned'] & (targets['targuse'] == 'T')]
+    counts = assigned.groupby(['xml_file', 'field_name', 'targsrvy']).size().reset_index(name='assigned')
+    counts = counts.merge(quotas, on=['xml_file', 'targsrvy'], how='inner')
+    return counts[counts['assigned'] > counts['max_fibres']].reset_index(drop=True)
+
+
+def validate_configured(xml_file_list, cleaned_file_list=None, workers=None):
+    """
+    Check the output of configure for a whole submission:
+
+    - unreadable: xmls that couldn't be parsed
+    - duplicate_fibres: a fibre given to more than one target of a field
+    - repeated_targets: a science target assigned in more than one field with the same PROGTEMP and OBSTEMP
+    - missing_fields: fields of 04-cleaned without a configured xml (only with cleaned_file_list)
+    - over_quota: a survey assigned more fibres in a field than its max_fibres
+
+    Every check is a groupby or duplicated over the targets of all the fields at once.
+
+    :param xml_file_list: the configured xmls
+    :param cleaned_file_list: the xmls they were configured from
+    :param workers: the number of processes to parse the xmls with. Defaults to the number of CPUs.
+    :return: a dictionary from the name of each check to a pandas dataframe of its violations, and the number of
+        fields and targets checked
+    """
+    import pandas as pd
+
+    with instrumentation.phase('parse'):
+        summary, targets, failed = parse_fields(xml_file_list, workers=workers)
+    with instrumentation.phase('check'):
+        checks = {'unreadable': pd.DataFrame({'xml_file': list(failed), 'error': list(failed.values())}),
+                  'duplicate_fibres': duplicate_fibres(targets),
+                  'repeated_targets': repeated_targets(summary, targets),
+                  'over_quota': over_quota(summary, targets)}
+        if cleaned_file_list is not None:
+            checks['missing_fields'] = missing_fields(xml_file_list, cleaned_file_list)
+    return checks, len(summary), len(targets)
+
+
+def validation_report(checks, n_fields, n_targets, max_reported=MAX_REPORTED):
+    """The result of validate_configured as a json serialisable dictionary, listing the first max_reported
+    violations of each check."""
+    return {'ok': all(len(violations) == 0 for violations in checks.values()),
+            'fields': n_fields,
+            'targets': n_targets,
+            'checks': {name: {'violations': len(violations),
+                              'rows': json.loads(violations.head(max_reported).to_json(orient='records'))}
+                       for name, violations in checks.items()}}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Check the configured xmls of a submission, exiting with '
+                    'an error if any check fails')
+
+    parser.add_argument('xml_file', nargs='*',
+                        help="""The configured OB XML files""")
+
+    parser.add_argument('--cleaned', nargs='*', default=None,
+                        help="""The xml files the fields were configured from
+                        (e.g. 04-cleaned), to check none are missing""")
+
+    parser.add_argument('--report', default=None,
+                        help='json file to write the report to')
+
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of processes to parse the xmls with. By '
+                             'default the number of CPUs')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('validate-configured', args.metrics)
+
+    checks, n_fields, n_targets = validate_configured(args.xml_file, cleaned_file_list=args.cleaned,
+                                                      workers=args.workers)
+    report = validation_report(checks, n_fields, n_targets)
+    if args.report is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, 'w') as fd:
+            json.dump(report, fd, indent=1)
+
+    for name, violations in checks.items():
+        if len(violations) > 0:
+            logging.error('{}: {} violations, e.g.\n{}'.format(name, len(violations),
+                                                                violations.head(10).to_string(index=False)))
+    logging.info('Checked {} targets in {} fields: {}'.format(
+        n_targets, n_fields, 'OK' if report['ok'] else 'FAILED'))
+
+    metrics.finish()
+
+    if not report['ok']:
+        sys.exit(1)
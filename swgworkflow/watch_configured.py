@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import glob
+import json
+import logging
+import os
+import select
+import struct
+import time
+
+from swgworkflow import instrumentation, xmlio
+from swgworkflow.add_configured_to_catalogues import (_contribution_file, _write_contribution,
+                                                      field_contribution)
+from swgworkflow.configure_manifest import file_hash
+from swgworkflow.configurefields import _get_output_filename
+
+# The inotify events (see inotify(7)) of an xml being written, moved in,
+# moved out or deleted, and the flags of inotify_init1
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_DELETE = 0x8, 0x40, 0x80, 0x200
+IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, 0o2000000
+# The header of each struct inotify_event: wd, mask, cookie and len
+INOTIFY_EVENT = struct.Struct('iIII')
+# The columns identifying a target and the groupings of the running summaries
+KEY_COLUMNS = ['targsrvy', 'targid', 'progtemp', 'obstemp']
+SUMMARY_GROUPINGS = (('targsrvy',), ('targprio',), ('targsrvy', 'targprio'))
+
+
+def is_configured_xml(filename):
+    """Whether filename is an xml written by configure (and not e.g. the uncompressed copy of its input)."""
+    name, extension = xmlio.split_xml_ext(os.path.basename(filename))
+    return extension in xmlio.XML_EXTENSIONS and name.endswith('configured')
+
+
+class _Inotify:
+    """A minimal inotify watch of a directory, through libc."""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, 'inotify_add_watch failed for {}'.format(directory))
+
+    def read(self, timeout):
+        """The (name, removed) of the files changed in the next timeout seconds."""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            buffer = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        changes, offset = [], 0
+        while offset < len(buffer):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            changes.append((name, bool(mask & (IN_MOVED_FROM | IN_DELETE))))
+        return changes
+
+    def close(self):
+        os.close(self._fd)
+
+
+def inotify_changes(directory, timeout=5.0):
+    """
+    Watch a directory with inotify for configured xmls being written, moved in or removed.
+
+    The xmls already in the directory are reported first. A file is reported when it is closed after writing, so
+    each xml configure finishes is reported once.
+
+    :param directory: the directory to watch
+    :param timeout: how long to wait for changes [s] before yielding an empty list
+    :return: a generator of lists of (xml file, removed)
+    """
+    # Start watching before listing the directory so no xml is missed, and
+    # straight away so that a failure is raised here
+    return _inotify_changes(_Inotify(directory), directory, timeout)
+
+
+def _inotify_changes(watch, directory, timeout):
+    try:
+        yield [(xml_file, False) for xml_file in sorted(glob.glob(os.path.join(directory, '*.xml*')))
+               if is_configured_xml(xml_file)]
+        while True:
+            changes = collections.OrderedDict()
+            for name, removed in watch.read(timeout):
+                if is_configured_xml(name):
+                    changes[os.path.join(directory, name)] = removed
+            yield list(changes.items())
+    finally:
+        watch.close()
+
+
+def poll_changes(directory, interval=30.0):
+    """
+    Watch a directory for configured xmls being written or removed by listing it every interval.
+
+    A file is reported once its size and modification time are the same in two listings in a row, so that an xml
+    configure is still writing isn't read. This works where inotify doesn't, such as on a network file system
+    written to by the nodes of a cluster.
+
+    :param directory: the directory to watch
+    :param interval: the time between listings [s]
+    :return: a generator of lists of (xml file, removed)
+    """
+    reported, previous = {}, {}
+    while True:
+        current = {}
+        for xml_file in sorted(glob.glob(os.path.join(directory, '*.xml*'))):
+            if not is_configured_xml(xml_file):
+                continue
+            try:
+                stat = os.stat(xml_file)
+            except FileNotFoundError:
+                continue
+            current[xml_file] = (stat.st_size, stat.st_mtime_ns)
+        changes = [(xml_file, False) for xml_file, stat in current.items()
+                   if previous.get(xml_file) == stat and reported.get(xml_file) != stat]
+        changes += [(xml_file, True) for xml_file in reported if xml_file not in current]
+        for xml_file, removed in changes:
+            if removed:
+                del reported[xml_file]
+            else:
+                reported[xml_file] = current[xml_file]
+        previous = current
+        yield changes
+        time.sleep(interval)
+
+
+def watch_changes(directory, poll_interval=None, timeout=5.0):
+    """The changes of inotify_changes, or of poll_changes every poll_interval if inotify isn't available or
+    poll_interval is given."""
+    if poll_interval is None:
+        try:
+            return inotify_changes(directory, timeout=timeout)
+        except (OSError, AttributeError, TypeError) as e:
+            logging.warning('inotify is not available ({}), polling {} every 30s instead'.format(e, directory))
+            poll_interval = 30.0
+    return poll_changes(directory, interval=poll_interval)
+
+
+class LiveAnalysis:
+    """
+    The analysis of a set of configured xmls that is updated one xml at a time, as configure jobs finish.
+
+    Each xml is parsed once, when it appears or changes, into:
+
+    - the counts of its science targets by targsrvy and targprio, from which the running summaries of
+      SUMMARY_GROUPINGS are summed
+    - its row of the field table
+    - its duplicate_fibres and over_quota violations (see validate_configured)
+    - its assigned science targets, which are kept in an index of the fields each target is assigned in to find
+      the targets assigned in more than one field
+    - its contribution to the annotated catalogues, written to contributions_dir if given so that
+      add_configured_to_catalogues.py --incremental doesn't have to parse it again
+    """
+
+    def __init__(self, contributions_dir=None):
+        self.contributions_dir = contributions_dir
+        self.hashes = {}
+        self.failed = {}
+        self._fields = collections.OrderedDict()
+        self._index = collections.defaultdict(set)
+
+    def update(self, xml_file):
+        """
+        Fold a new or changed xml into the analysis.
+
+        :param xml_file: the configured xml
+        :return: whether the xml was new or changed
+        """
+        from swgworkflow.validate_configured import duplicate_fibres, over_quota
+        from swgworkflow.xmlanalysis import _assign_counts, parse_configured_xml
+
+        xml_hash = file_hash(xml_file)
+        if self.hashes.get(xml_file) == xml_hash:
+            return False
+        self.remove(xml_file)
+        self.hashes[xml_file] = xml_hash
+        try:
+            summary, targets = parse_configured_xml(xml_file)
+        except Exception as e:
+            # Probably a job that failed half way through writing its xml
+            self.failed[xml_file] = '{}: {}'.format(type(e).__name__, e)
+            logging.warning('Could not read {}: {}'.format(xml_file, self.failed[xml_file]))
+            return True
+
+        if self.contributions_dir is not None:
+            contribution_file = _contribution_file(xml_file, xml_hash, self.contributions_dir)
+            if not os.path.exists(contribution_file):
+                os.makedirs(self.contributions_dir, exist_ok=True)
+                _write_contribution(field_contribution(summary, targets), contribution_file)
+
+        summary['xml_file'] = xml_file
+        targets['xml_file'] = xml_file
+        science = targets[targets['targuse'] == 'T']
+        assigned = science[science['assigned']].merge(summary[['xml_file', 'progtemp', 'obstemp']],
+                                                      on='xml_file', how='left')
+        keys = set(assigned[KEY_COLUMNS].itertuples(index=False, name=None))
+        for key in keys:
+            self._index[key].add(xml_file)
+
+        all_columns = []
+        for by in SUMMARY_GROUPINGS:
+            all_columns += [column for column in by if column not in all_columns]
+        first = summary.iloc[0]
+        self._fields[xml_file] = {
+            'row': {'xml_file': xml_file, 'field_name': first['field_name'], 'progtemp': first['progtemp'],
+                    'obstemp': first['obstemp'], 'targets': len(science), 'assigned': len(assigned),
+                    'processed': datetime.datetime.now().isoformat(timespec='seconds')},
+            'counts': _assign_counts(science, all_columns),
+            'keys': keys,
+            'n_targets': len(targets),
+            'duplicate_fibres': duplicate_fibres(targets),
+            'over_quota': over_quota(summary, targets)}
+        return True
+
+    def remove(self, xml_file):
+        """Take an xml that has been removed (or is about to be updated) out of the analysis."""
+        self.hashes.pop(xml_file, None)
+        self.failed.pop(xml_file, None)
+        field = self._fields.pop(xml_file, None)
+        if field is None:
+            return
+        for key in field['keys']:
+            self._index[key].discard(xml_file)
+            if len(self._index[key]) == 0:
+                del self._index[key]
+
+    @property
+    def xml_files(self):
+        """The xmls that have been read."""
+        return list(self._fields)
+
+    def _repeated(self):
+        return {key: xml_files for key, xml_files in self._index.items() if len(xml_files) > 1}
+
+    def field_table(self):
+        """A pandas dataframe with a row per field: what was assigned, when it was read and how many problems each
+        check found in it."""
+        import pandas as pd
+
+        repeated = collections.Counter(xml_file for xml_files in self._repeated().values()
+                                       for xml_file in xml_files)
+        rows = []
+        for xml_file, field in self._fields.items():
+            row = dict(field['row'])
+            row['fraction'] = row['assigned'] / row['targets'] if row['targets'] > 0 else float('nan')
+            row['duplicate_fibres'] = len(field['duplicate_fibres'])
+            row['over_quota'] = len(field['over_quota'])
+            row['repeated_targets'] = repeated[xml_file]
+            rows.append(row)
+        return pd.DataFrame(rows, columns=['xml_file', 'field_name', 'progtemp', 'obstemp', 'targets', 'assigned',
+                                           'fraction', 'duplicate_fibres', 'over_quota', 'repeated_targets',
+                                           'processed'])
+
+    def summaries(self):
+        """The running summaries of the science targets assigned, as a dictionary from each of SUMMARY_GROUPINGS
+        to a group_assign_df style dataframe."""
+        import pandas as pd
+
+        from swgworkflow.xmlanalysis import _finish_assign_df
+
+        if len(self._fields) == 0:
+            return {}
+        counts = pd.concat([field['counts'] for field in self._fields.values()], ignore_index=True)
+        return {by: _finish_assign_df(counts, by) for by in SUMMARY_GROUPINGS}
+
+    def checks(self, cleaned_file_list=None):
+        """The violations of the checks of validate_configured for the xmls read so far. The missing_fields check
+        lists the xmls of cleaned_file_list whose configured xml hasn't been read yet."""
+        import pandas as pd
+
+        def concat(name, columns):
+            frames = [field[name] for field in self._fields.values() if len(field[name]) > 0]
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+        # The fields of a repeated target are listed in the order they were read
+        order = {xml_file: i for i, xml_file in enumerate(self._fields)}
+        repeated = sorted(self._repeated().items())
+        checks = {
+            'unreadable': pd.DataFrame({'xml_file': list(self.failed), 'error': list(self.failed.values())}),
+            'duplicate_fibres': concat('duplicate_fibres', ['xml_file', 'field_name', 'fibreid', 'targets']),
+            'repeated_targets': pd.DataFrame(
+                [key + (len(xml_files), '|'.join(self._fields[xml_file]['row']['field_name']
+                                                 for xml_file in sorted(xml_files, key=order.get)))
+                 for key, xml_files in repeated],
+                columns=KEY_COLUMNS + ['fields', 'field_names']),
+            'over_quota': concat('over_quota', ['xml_file', 'field_name', 'targsrvy', 'assigned', 'max_fibres'])}
+        if cleaned_file_list is not None:
+            read = {xmlio.xml_basename_wo_ext(xml_file) for xml_file in list(self._fields) + list(self.failed)}
+            checks['missing_fields'] = pd.DataFrame(
+                {'cleaned_file': [cleaned_file for cleaned_file in cleaned_file_list
+                                  if xmlio.xml_basename_wo_ext(_get_output_filename(cleaned_file, '')) not in read]})
+        return checks
+
+    def write(self, output_dir, cleaned_file_list=None):
+        """
+        Write the state of the analysis to output_dir, replacing each file at once so it can be read at any time:
+
+        - fields.csv: the field_table
+        - assigned_by_<grouping>.csv: the running summaries
+        - validation.json: the report of the checks, as written by validate_configured.py
+
+        :return: the report of the checks
+        """
+        from swgworkflow.validate_configured import validation_report
+
+        os.makedirs(output_dir, exist_ok=True)
+        tables = {'fields.csv': self.field_table()}
+        for by, df in self.summaries().items():
+            tables['assigned_by_{}.csv'.format('_'.join(by))] = df
+        for filename, df in tables.items():
+            output_file = os.path.join(output_dir, filename)
+            df.to_csv(output_file + '.tmp', index=False)
+            os.replace(output_file + '.tmp', output_file)
+
+        checks = self.checks(cleaned_file_list)
+        n_targets = sum(field['n_targets'] for field in self._fields.values())
+        report = validation_report(checks, len(self._fields), n_targets)
+        output_file = os.path.join(output_dir, 'validation.json')
+        with open(output_file + '.tmp', 'w') as fd:
+            json.dump(report, fd, indent=1)
+        os.replace(output_file + '.tmp', output_file)
+        return report
+
+
+def _log_problems(report, previous_report):
+    # Only log the checks whose number of violations has changed
+    for name, check in report['checks'].items():
+        previous = previous_report['checks'].get(name, {}).get('violations', 0) if previous_report else 0
+        if name == 'missing_fields' or check['violations'] == previous:
+            continue
+        if check['violations'] == 0:
+            logging.info('{}: no more violations'.format(name))
+        else:
+            logging.warning('{}: {} violations, e.g. {}'.format(name, check['violations'], check['rows'][:3]))
+
+
+def watch_configured(configured_dir, output_dir, cleaned_file_list=None, contributions_dir=None,
+                     poll_interval=None, idle_timeout=None, changes=None):
+    """
+    Keep the analysis of the configured xmls of a submission up to date while configure is running, parsing each
+    xml as it appears in configured_dir (see LiveAnalysis) and rewriting the outputs of LiveAnalysis.write in
+    output_dir after each change.
+
+    :param configured_dir: the output directory of configure e.g. 05-configured
+    :param output_dir: the directory for the live analysis
+    :param cleaned_file_list: the xmls being configured. If given, stop once all of them have been configured.
+    :param contributions_dir: where to keep the contributions of the fields to the annotated catalogues
+    :param poll_interval: poll configured_dir every poll_interval seconds rather than watching it with inotify
+    :param idle_timeout: stop after this many seconds without changes
+    :param changes: the changes to the directory, by default from watch_changes
+    :return: the LiveAnalysis
+    """
+    if changes is None:
+        changes = watch_changes(configured_dir, poll_interval=poll_interval)
+
+    analysis = LiveAnalysis(contributions_dir=contributions_dir)
+    report = None
+    last_change = time.monotonic()
+    for batch in changes:
+        updated = False
+        for xml_file, removed in batch:
+            with instrumentation.phase('parse'):
+                if removed:
+                    logging.info('{} was removed'.format(xml_file))
+                    updated = updated or xml_file in analysis.hashes
+                    analysis.remove(xml_file)
+                elif analysis.update(xml_file):
+                    logging.info('Read {}'.format(xml_file))
+                    updated = True
+
+        if updated:
+            last_change = time.monotonic()
+            with instrumentation.phase('write'):
+                previous_report, report = report, analysis.write(output_dir, cleaned_file_list)
+            _log_problems(report, previous_report)
+            logging.info('{} fields read{}, {} unreadable'.format(
+                report['fields'], '' if cleaned_file_list is None else ' of {}'.format(len(cleaned_file_list)),
+                report['checks']['unreadable']['violations']))
+
+        if cleaned_file_list is not None and report is not None and report['checks']['missing_fields']['violations'] == 0:
+            logging.info('All the fields have been configured')
+            break
+        if idle_timeout is not None and time.monotonic() - last_change > idle_timeout:
+            logging.info('Nothing has changed for {}s, stopping'.format(idle_timeout))
+            break
+
+    if report is None:
+        analysis.write(output_dir, cleaned_file_list)
+    return analysis
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Watch the output directory of configure and keep an '
+                    'analysis of the configured xmls up to date as each job '
+                    'finishes')
+
+    parser.add_argument('configured_dir',
+                        help="""The output directory of configure
+                        (e.g. output/SV_exp1/05-configured)""")
+
+    parser.add_argument('--outdir', dest='output_dir', default='output/live',
+                        help="""name of the directory which will contain the
+                        field table, running summaries and validation report""")
+
+    parser.add_argument('--cleaned', nargs='*', default=None,
+                        help="""The xml files being configured (e.g.
+                        04-cleaned), to stop once all of them are done""")
+
+    parser.add_argument('--contributions_dir', default=None,
+                        help="""Keep the contribution of each field to the
+                        annotated catalogues here (e.g.
+                        output/SV_exp1/catalogs-configured/contributions) so
+                        that add_configured_to_catalogues.py --incremental
+                        doesn't parse the xmls again""")
+
+    parser.add_argument('--poll', default=None, type=float,
+                        help="""Poll the directory every this many seconds
+                        rather than watching it with inotify, e.g. when the
+                        jobs run on other hosts of a network file system""")
+
+    parser.add_argument('--idle_timeout', default=None, type=float,
+                        help='Stop after this many seconds without changes')
+
+    parser.add_argument('--log_level', default='info',
+                        choices=['debug', 'info', 'warning', 'error'],
+                        help='the level for the logging messages')
+
+    instrumentation.add_metrics_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    metrics = instrumentation.start_stage('watch-configured', args.metrics)
+
+    try:
+        watch_configured(args.configured_dir, args.output_dir, cleaned_file_list=args.cleaned,
+                         contributions_dir=args.contributions_dir, poll_interval=args.poll,
+                         idle_timeout=args.idle_timeout)
+    except KeyboardInterrupt:
+        logging.info('Stopped watching {}'.format(args.configured_dir))
+
+    metrics.finish()
@@ -1,11 +1,22 @@
 import pandas as pd
 import numpy as np
 import xml.etree.ElementTree as et
-import matplotlib.pyplot as plt
 import glob
 import logging
 
-PLATE_A_FIBRES, PLATE_B_FIBRES = 964, 948
+from swgworkflow import xmlio
+from swgworkflow.xmlio import PLATE_A_FIBRES, PLATE_B_FIBRES
+
+
+def _xml_root(xml_file):
+    """Return the root element of xml_file, which can be a (possibly compressed) filename or an already parsed
+    ElementTree or Element."""
+    if isinstance(xml_file, et.ElementTree):
+        return xml_file.getroot()
+    if isinstance(xml_file, et.Element):
+        return xml_file
+    return xmlio.parse(xml_file).getroot()
+
 
 def parse_xml(xml_file, df_cols, tag='target'):
     """Parse the input XML file and store the result in a pandas
@@ -17,8 +28,7 @@ def parse_xml(xml_file, df_cols, tag='target'):
     of each sub-element.
     """
 
-    xtree = et.parse(xml_file)
-    xroot = xtree.getroot()
+    xroot = _xml_root(xml_file)
     rows = []
 
     for node in xroot.iter(tag):
@@ -45,7 +55,7 @@ def parse_configure_xml_targets(xml_file, attributes=('targsrvy', 'targra', 'tar
     """Parse an OB xml file on a target-by-target basis and store the result in a pandas
     DataFrame with these columns.
 
-    :param xml_file: the xml file to be parsed
+    :param xml_file: the xml file to be parsed (or its already parsed ElementTree)
     :param attributes: the attributtes to be extracted
     :param add_name: whether each target should also have the field name
     :return: a pandas dataframe of the extracted data
@@ -66,8 +76,7 @@ def parse_configure_xml_targets(xml_file, attributes=('targsrvy', 'targra', 'tar
 
     # Add the name of the OB to each target for bookkeeping
     if add_name:
-        xtree = et.parse(xml_file)
-        xroot = xtree.getroot()
+        xroot = _xml_root(xml_file)
         field_name = xroot.find('observation').get('name')
         df['field_name'] = field_name
 
@@ -79,18 +88,20 @@ def parse_configure_xml_targets(xml_file, attributes=('targsrvy', 'targra', 'tar
     return df
 
 
-def parse_configure_xml_summary(xml_file: str) -> pd.DataFrame:
+def parse_configure_xml_summary(xml_file: str, target_df: pd.DataFrame = None) -> pd.DataFrame:
     """
     Parse an WEAVE OB produced by configure for key information like how many fibres where configured and the hour
     angle range
 
-    :param xml_file: the xml file to parse
+    :param xml_file: the xml file to parse (or its already parsed ElementTree)
+    :param target_df: the output of parse_configure_xml_targets for this file if already available
     :return: a pandas dataframe containing key information
     """
 
     row = {}
     # First count the targets that were assigned to each TARGSRVY (e.g. guide/wd/sky/your survey)
-    target_df = parse_configure_xml_targets(xml_file)
+    if target_df is None:
+        target_df = parse_configure_xml_targets(xml_file)
     assigned_df = target_df[target_df.assigned == True]
     targsrvy_df = assigned_df.groupby(['targsrvy']).size().to_frame(name='assigned').transpose().reset_index(drop=True)
     targsrvy_df['assigned'] = targsrvy_df.sum(axis='columns')  # Add a column for the total fibres assigned
@@ -98,8 +109,7 @@ def parse_configure_xml_summary(xml_file: str) -> pd.DataFrame:
     #row['assigned'] = targsrvy_df.sum(axis='columns')  # the total fibres assigned
 
     # parse the xml and extract the tags we care about by hand
-    xtree = et.parse(xml_file)
-    xroot = xtree.getroot()
+    xroot = _xml_root(xml_file)
 
     row['progtemp'] = xroot.find('observation').get('progtemp')
     row['obstemp'] = xroot.find('observation').get('obstemp')
@@ -112,7 +122,7 @@ def parse_configure_xml_summary(xml_file: str) -> pd.DataFrame:
         row[attribute] = xroot.find('observation/configure').get(attribute)
 
     # add the max fibres for each survey
-    surveys = parse_xml(xml_file, df_cols=['name', 'max_fibres'], tag='survey')
+    surveys = parse_xml(xroot, df_cols=['name', 'max_fibres'], tag='survey')
     for i, survey in surveys.iterrows():
         row['max_' + survey['name']] = survey['max_fibres']
 
@@ -135,6 +145,19 @@ def parse_configure_xml_summary(xml_file: str) -> pd.DataFrame:
     return df
 
 
+def parse_configured_xml(xml_file):
+    """
+    Parse a WEAVE OB produced by configure into its summary and targets, reading the file only once.
+
+    :param xml_file: the xml file to parse
+    :return: a tuple of pandas dataframes (summary, targets)
+    """
+    xroot = _xml_root(xml_file)
+    target_df = parse_configure_xml_targets(xroot)
+    summary_df = parse_configure_xml_summary(xroot, target_df=target_df)
+    return summary_df, target_df
+
+
 def parse_configured_xmls(files):
     summarys = []
     targets = []
@@ -145,18 +168,69 @@ def parse_configured_xmls(files):
         
     for file in file_list:
         try:
-            summarys.append(parse_configure_xml_summary(file))
-            targets.append(parse_configure_xml_targets(file))
+            summary_df, target_df = parse_configured_xml(file)
+            summarys.append(summary_df)
+            targets.append(target_df)
         except:
             logging.info(f'Problem reading {file}')
     return pd.concat(summarys), pd.concat(targets)
 
 
-def group_assign_df(df, by=('targsrvy',), number=True, fraction=True):
-    by.append('assigned')
-    df_out = df.groupby(by).size().reset_index(name='number')
+def _assign_counts(df, by):
+    """Count the targets in each (by, assigned) group of a dataframe.
+
+    :param df: a dataframe of targets with an assigned column
+    :param by: the columns to group on
+    :return: a pandas dataframe with the group columns, assigned and number
+    """
+    keys = list(by) + ['assigned']
+    return df.groupby(keys, observed=True, dropna=False).size().reset_index(name='number')
+
+
+def _finish_assign_df(counts, by, number=True, fraction=True):
+    """Collapse a table of counts onto the columns by (+ assigned) and optionally add the fraction assigned."""
+    by = list(by)
+    df_out = counts.groupby(by + ['assigned'], observed=True)['number'].sum().reset_index()
     if fraction:
-        df_out['fraction'] = df_out['number'] / df_out.groupby(by[:-1])['number'].transform('sum')
+        if by:
+            df_out['fraction'] = df_out['number'] / df_out.groupby(by, observed=True)['number'].transform('sum')
+        else:
+            df_out['fraction'] = df_out['number'] / df_out['number'].sum()
     if not number:
-        df_out.drop(columns=['number'])
+        df_out = df_out.drop(columns=['number'])
     return df_out
+
+
+def group_assign_df(df, by=('targsrvy',), number=True, fraction=True):
+    """Count how many targets were (and were not) assigned a fibre in each group.
+
+    :param df: a dataframe of targets e.g. from parse_configured_xmls
+    :param by: the columns to group on. Not modified.
+    :param number: whether to include the number of targets in each group
+    :param fraction: whether to include the fraction of each group that was (not) assigned
+    :return: a pandas dataframe with one row per (by, assigned) group
+    """
+    return _finish_assign_df(_assign_counts(df, by), by, number=number, fraction=fraction)
+
+
+def rollup_assign_df(df, groupings=(('targsrvy',), ('field_name',), ('targprio',),
+                                    ('targsrvy', 'targprio'), ('field_name', 'targprio')),
+                     number=True, fraction=True):
+    """Count assigned targets for several groupings while only grouping the full dataframe once.
+
+    The targets are grouped once on the union of all the grouping columns and each of the requested groupings
+    is then summed from this (much smaller) table, so the results are identical to calling group_assign_df for
+    each grouping.
+
+    :param df: a dataframe of targets e.g. from parse_configured_xmls
+    :param groupings: a list of the column combinations to group on
+    :param number: whether to include the number of targets in each group
+    :param fraction: whether to include the fraction of each group that was (not) assigned
+    :return: a dictionary from each grouping (as a tuple) to its group_assign_df style dataframe
+    """
+    groupings = [tuple(by) for by in groupings]
+    all_columns = []
+    for by in groupings:
+        all_columns += [column for column in by if column not in all_columns]
+    counts = _assign_counts(df, all_columns)
+    return {by: _finish_assign_df(counts, by, number=number, fraction=fraction) for by in groupings}
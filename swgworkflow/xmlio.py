@@ -0,0 +1,120 @@
+import contextlib
+import gzip
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+# The extension of each supported compression of an xml
+COMPRESSION_EXTENSIONS = {'gz': '.gz', 'zst': '.zst'}
+XML_EXTENSIONS = ('.xml.gz', '.xml.zst', '.xml')
+# The number of fibres of each plate
+PLATE_A_FIBRES, PLATE_B_FIBRES = 964, 948
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading or writing .xml.zst files needs the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def split_xml_ext(filename):
+    """Split filename into its root and its xml extension (.xml, .xml.gz or .xml.zst)."""
+    for extension in XML_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)], extension
+    return os.path.splitext(filename)
+
+
+def xml_basename_wo_ext(filename):
+    """The basename of an xml without its (possibly compressed) extension e.g. F1 for dir/F1.xml.gz."""
+    return split_xml_ext(os.path.basename(filename))[0]
+
+
+def xml_extension(compression=None):
+    """The extension of xml files with compression (None, 'gz' or 'zst')."""
+    if compression is None or compression == 'none':
+        return '.xml'
+    return '.xml' + COMPRESSION_EXTENSIONS[compression]
+
+
+def is_compressed(filename):
+    return split_xml_ext(filename)[1] in ('.xml.gz', '.xml.zst')
+
+
+def open_xml(filename, mode='rb'):
+    """Open a (possibly compressed) xml file as a binary stream, (de)compressing on the fly."""
+    assert mode in ('rb', 'wb')
+    if filename.endswith('.gz'):
+        # No timestamp in the header, so writing the same xml always gives the same bytes
+        return gzip.GzipFile(filename, mode, mtime=0)
+    if filename.endswith('.zst'):
+        zstandard = _zstandard()
+        fd = open(filename, mode)
+        if mode == 'rb':
+            return zstandard.ZstdDecompressor().stream_reader(fd, closefd=True)
+        return zstandard.ZstdCompressor().stream_writer(fd, closefd=True)
+    return open(filename, mode)
+
+
+def parse(filename):
+    """ElementTree.parse for (possibly compressed) xml files."""
+    with open_xml(filename) as fd:
+        return ET.parse(fd)
+
+
+def iterparse(filename, events=('end',)):
+    """ElementTree.iterparse for (possibly compressed) xml files."""
+    with open_xml(filename) as fd:
+        yield from ET.iterparse(fd, events=events)
+
+
+def write(tree, filename):
+    """ElementTree.write for (possibly compressed) xml files."""
+    with open_xml(filename, 'wb') as fd:
+        tree.write(fd)
+
+
+def copy(input_file, output_file):
+    """Copy an xml, (de)compressing it as needed by the extensions of the files."""
+    with open_xml(input_file) as input_fd, open_xml(output_file, 'wb') as output_fd:
+        shutil.copyfileobj(input_fd, output_fd, 1 << 20)
+
+
+@contextlib.contextmanager
+def uncompressed(filename, tmp_dir=None):
+    """
+    Give the name of an uncompressed copy of filename for tools that can only read plain xml, removing it
+    afterwards. If filename isn't compressed it's used as it is.
+    """
+    if not is_compressed(filename):
+        yield filename
+        return
+    fd, tmp_filename = tempfile.mkstemp(suffix='.xml', prefix=xml_basename_wo_ext(filename) + '-', dir=tmp_dir)
+    os.close(fd)
+    try:
+        copy(filename, tmp_filename)
+        yield tmp_filename
+    finally:
+        os.remove(tmp_filename)
+
+
+@contextlib.contextmanager
+def compressed_output(filename):
+    """
+    Give the name of an uncompressed file for tools that can only write plain xml, and compress what is
+    written to it to filename. If filename isn't compressed it's used as it is.
+    """
+    if not is_compressed(filename):
+        yield filename
+        return
+    fd, tmp_filename = tempfile.mkstemp(suffix='.xml', prefix=xml_basename_wo_ext(filename) + '-',
+                                        dir=os.path.dirname(filename) or None)
+    os.close(fd)
+    try:
+        yield tmp_filename
+        copy(tmp_filename, filename)
+    finally:
+        os.remove(tmp_filename)
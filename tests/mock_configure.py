@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+A stand-in for configure in the tests: it copies --field to --output after sleeping MOCK_CONFIGURE_SECONDS, and
+appends the field to MOCK_CONFIGURE_LOG (if set) when it starts, so the tests can count how often each field was
+configured. A field whose name contains MOCK_CONFIGURE_FAIL (if set) fails with exit status 3.
+"""
+import argparse
+import os
+import shutil
+import time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--field', required=True)
+    parser.add_argument('--output', required=True)
+    args, _ = parser.parse_known_args()
+
+    log_file = os.environ.get('MOCK_CONFIGURE_LOG')
+    if log_file:
+        with open(log_file, 'a') as fd:
+            fd.write(os.path.basename(args.field) + '\n')
+    time.sleep(float(os.environ.get('MOCK_CONFIGURE_SECONDS', 0)))
+    fail = os.environ.get('MOCK_CONFIGURE_FAIL')
+    if fail and fail in os.path.basename(args.field):
+        raise SystemExit(3)
+    shutil.copyfile(args.field, args.output)
@@ -0,0 +1,111 @@
+import filecmp
+import os
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from swgworkflow import fits_stream
+from swgworkflow.add_configured_to_catalogues import (add_configured_to_catalogues,
+                                                      annotate_catalogue_chunked,
+                                                      update_configured_catalogue)
+from swgworkflow.xmlanalysis import parse_configured_xmls
+
+N_TARGETS = 60
+
+
+def _write_configured_xml(xml_file, name, seed):
+    # Each field has a random half of the targets of the catalogue, a random
+    # half of which are assigned a fibre
+    rng = np.random.default_rng(seed)
+    targets = []
+    for targid in sorted(rng.choice(N_TARGETS, N_TARGETS // 2, replace=False)):
+        fibre = ' fibreid="{0}" configid="{0}"'.format(targid + 1) if rng.random() < 0.5 else ''
+        targets.append('        <target targsrvy="GA" targid="{}" targra="10.0" targdec="40.0" targuse="T" '
+                       'targprio="8.0"{}/>'.format(targid, fibre))
+    with open(xml_file, 'w') as fd:
+        fd.write("""<?xml version="1.0"?>
+<root>
+  <observation name="{}" progtemp="11331.1+" obstemp="DACEB">
+    <configure plate="PLATE_A" max_sky="100" max_calibration="10" max_guide="8">
+      <hour_angle_limits earliest="-2.0" latest="2.5"/>
+    </configure>
+    <survey name="GA" max_fibres="1000"/>
+    <fields>
+      <field RA_d="10.0" Dec_d="40.0">
+{}
+      </field>
+    </fields>
+  </observation>
+</root>
+""".format(name, '\n'.join(targets)))
+    return xml_file
+
+
+def _write_catalogue(target_cat):
+    Table({'TARGSRVY': ['GA'] * N_TARGETS,
+           'TARGID': [str(i) for i in range(N_TARGETS)],
+           'PROGTEMP': ['11331.1+'] * N_TARGETS,
+           'OBSTEMP': ['DACEB'] * N_TARGETS,
+           'TARGPRIO': np.full(N_TARGETS, 8.0)}).write(target_cat)
+    return target_cat
+
+
+def _assert_same_as_full_rebuild(xml_file_list, target_cat, incremental_dir, tmp_path, step):
+    incremental_file = update_configured_catalogue(xml_file_list, target_cat, incremental_dir)
+    full_dir = str(tmp_path / 'full-{}'.format(step))
+    os.makedirs(full_dir)
+    full_file = add_configured_to_catalogues(xml_file_list, target_cat, full_dir)
+    assert filecmp.cmp(incremental_file, full_file, shallow=False), step
+
+
+def test_incremental_update_is_identical_to_full_rebuild(tmp_path):
+    target_cat = _write_catalogue(str(tmp_path / 'cat.fits'))
+    xml_dir, incremental_dir = tmp_path / 'configured', str(tmp_path / 'incremental')
+    os.makedirs(str(xml_dir))
+    os.makedirs(incremental_dir)
+    xml_file_list = [_write_configured_xml(str(xml_dir / 'F{}-configured.xml'.format(i)), 'F{}'.format(i), i)
+                     for i in range(3)]
+
+    _assert_same_as_full_rebuild(xml_file_list, target_cat, incremental_dir, tmp_path, 'initial')
+    _write_configured_xml(xml_file_list[1], 'F1', 99)
+    _assert_same_as_full_rebuild(xml_file_list, target_cat, incremental_dir, tmp_path, 'reconfigured')
+    xml_file_list.append(_write_configured_xml(str(xml_dir / 'F3-configured.xml'), 'F3-with-a-longer-name', 3))
+    _assert_same_as_full_rebuild(xml_file_list, target_cat, incremental_dir, tmp_path, 'added')
+    del xml_file_list[1]
+    _assert_same_as_full_rebuild(xml_file_list, target_cat, incremental_dir, tmp_path, 'removed')
+
+    # With every field removed, nothing is configured
+    catalogue = Table.read(update_configured_catalogue([], target_cat, incremental_dir))
+    assert np.all(catalogue['CONFIGURED'] == 0)
+    assert np.all(catalogue['ASSIGNED'] == 0)
+
+
+def test_interrupted_chunked_annotation_leaves_no_output(tmp_path, monkeypatch):
+    target_cat = _write_catalogue(str(tmp_path / 'cat.fits'))
+    xml_file = _write_configured_xml(str(tmp_path / 'F0-configured.xml'), 'F0', 0)
+    summaries, xml_targets = parse_configured_xmls([xml_file])
+    output_dir = tmp_path / 'configured'
+    output_dir.mkdir()
+    output_file = str(output_dir / 'cat-configured.fits')
+
+    write = fits_stream.TableWriter.write
+    written = []
+
+    def write_then_die(writer, records):
+        # Dies after writing the first chunk
+        if written:
+            raise MemoryError
+        written.append(len(records))
+        write(writer, records)
+
+    monkeypatch.setattr(fits_stream.TableWriter, 'write', write_then_die)
+    with pytest.raises(MemoryError):
+        annotate_catalogue_chunked(target_cat, output_file, summaries, xml_targets, max_memory_mb=0.0001)
+    assert written
+    assert os.listdir(str(output_dir)) == []
+
+    monkeypatch.setattr(fits_stream.TableWriter, 'write', write)
+    annotate_catalogue_chunked(target_cat, output_file, summaries, xml_targets, max_memory_mb=0.0001)
+    assert os.listdir(str(output_dir)) == ['cat-configured.fits']
+    assert len(Table.read(output_file)) == N_TARGETS
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from swgworkflow.add_configured_to_source_lists import (DEFAULT_VALUES, NEW_COLUMNS,
+                                                        add_columns_to_source_list)
+
+ARCSEC = 1 / 3600
+
+
+def _target_catalogue(filename, gaia_id, ra, targprog):
+    n = len(gaia_id)
+    Table({'GAIA_ID': np.array(gaia_id, dtype=np.int64),
+           'PS_ID': np.arange(1, n + 1, dtype=np.int64) * 1000,
+           'GAIA_RA': np.array(ra, dtype=float),
+           'GAIA_DEC': np.zeros(n),
+           'GA_TARGBITS': np.ones(n, dtype=np.int64),
+           'TARGPROG': np.array([targprog] * n),
+           'TARGPRIO': np.full(n, 5.0),
+           'CONFIGURED': np.ones(n, dtype=np.int64),
+           'ASSIGNED': np.ones(n, dtype=np.int64)}).write(filename)
+    return filename
+
+
+@pytest.mark.parametrize('max_memory_mb', [None, 1])
+def test_position_match_keeps_id_matches_of_other_catalogues(tmp_path, max_memory_mb):
+    # The first source is matched by its ID to the first catalogue, and is
+    # next to a target of the second that has another ID. The third source
+    # has no ID match, so is matched to that catalogue by position.
+    source_file = str(tmp_path / 'sources.fits')
+    Table({'SOURCE_ID': np.array([100, 200, 0], dtype=np.int64),
+           'PS1_ID': np.array([1, 2, 555], dtype=np.int64),
+           'GAIA_REV_ID': np.array([3, 3, 0], dtype=np.int64),
+           'GAIA_RA': np.array([10.0, 20.0, 30.0]),
+           'GAIA_DEC': np.zeros(3)}).write(source_file)
+    target_cats = [_target_catalogue(str(tmp_path / 'cat1.fits'), [100], [10.0], 'ONE'),
+                   _target_catalogue(str(tmp_path / 'cat2.fits'), [999, 998], [10.0 + 0.2 * ARCSEC,
+                                                                               30.0 + 0.2 * ARCSEC], 'TWO')]
+
+    output_file = add_columns_to_source_list(source_file, target_cats, str(tmp_path), NEW_COLUMNS,
+                                             DEFAULT_VALUES, '-configured', max_memory_mb=max_memory_mb,
+                                             match_radius=1.0)
+
+    targprog = [value.strip() for value in Table.read(output_file)['TARGPROG'].astype(str)]
+    assert targprog == ['ONE', '', 'TWO']
@@ -0,0 +1,126 @@
+import collections
+import multiprocessing
+import os
+import signal
+import time
+
+from swgworkflow import configure_queue
+
+MOCK_CONFIGURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_configure.py')
+
+
+def _write_fields(directory, n_fields):
+    os.makedirs(directory)
+    xml_file_list = []
+    for i in range(n_fields):
+        xml_file = os.path.join(directory, 'F{:02d}.xml'.format(i))
+        with open(xml_file, 'w') as fd:
+            fd.write('<OB><target targprio="10"/><target targprio="2"/></OB>\n')
+        xml_file_list.append(xml_file)
+    return xml_file_list
+
+
+def _configured_fields(log_file):
+    with open(log_file) as fd:
+        return collections.Counter(line.strip() for line in fd)
+
+
+def _run_worker(queue_dir, lease_timeout, environment):
+    os.environ.update(environment)
+    configure_queue.run_worker(queue_dir, configure_path=MOCK_CONFIGURE, threads=1,
+                               lease_timeout=lease_timeout, poll_interval=0.05)
+
+
+def _run_worker_in_own_group(queue_dir, lease_timeout, environment):
+    # So the worker can be killed together with its configure
+    os.setpgrp()
+    _run_worker(queue_dir, lease_timeout, environment)
+
+
+def test_workers_claim_each_job_once(tmp_path):
+    queue_dir, output_dir = str(tmp_path / 'queue'), str(tmp_path / 'configured')
+    log_file = str(tmp_path / 'configure.log')
+    os.makedirs(output_dir)
+    xml_file_list = _write_fields(str(tmp_path / 'cleaned'), 12)
+    output_file_list = configure_queue.enqueue(xml_file_list, queue_dir, output_dir)
+
+    environment = {'MOCK_CONFIGURE_LOG': log_file, 'MOCK_CONFIGURE_SECONDS': '0.1'}
+    workers = [multiprocessing.Process(target=_run_worker, args=(queue_dir, 30, environment)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    assert configure_queue.queue_status(queue_dir) == {'pending': 0, 'claimed': 0, 'done': 12, 'failed': 0}
+    assert _configured_fields(log_file) == {os.path.basename(xml_file): 1 for xml_file in xml_file_list}
+    assert all(os.path.exists(output_file) for output_file in output_file_list)
+    failed = configure_queue.collect(queue_dir, str(tmp_path / 'history.jsonl'))
+    assert failed == []
+    with open(str(tmp_path / 'history.jsonl')) as fd:
+        assert len(fd.readlines()) == 12
+
+
+def test_failed_job_is_reported(tmp_path, monkeypatch):
+    queue_dir, output_dir = str(tmp_path / 'queue'), str(tmp_path / 'configured')
+    os.makedirs(output_dir)
+    xml_file_list = _write_fields(str(tmp_path / 'cleaned'), 3)
+    configure_queue.enqueue(xml_file_list, queue_dir, output_dir)
+
+    monkeypatch.setenv('MOCK_CONFIGURE_FAIL', 'F01')
+    configure_queue.run_worker(queue_dir, configure_path=MOCK_CONFIGURE, threads=1, poll_interval=0.05)
+
+    assert configure_queue.queue_status(queue_dir) == {'pending': 0, 'claimed': 0, 'done': 2, 'failed': 1}
+    failed = configure_queue.collect(queue_dir, str(tmp_path / 'history.jsonl'))
+    assert [job['name'] for job in failed] == ['F01-configured']
+
+
+def test_requeue_stale(tmp_path):
+    queue_dir, output_dir = str(tmp_path / 'queue'), str(tmp_path / 'configured')
+    os.makedirs(output_dir)
+    configure_queue.enqueue(_write_fields(str(tmp_path / 'cleaned'), 1), queue_dir, output_dir)
+
+    job, claimed_file = configure_queue.claim(queue_dir, 'dead-worker')
+    assert job['name'] == 'F00-configured'
+    # A fresh claim is left alone
+    assert configure_queue.requeue_stale(queue_dir, lease_timeout=60, max_attempts=2) == 0
+
+    old = time.time() - 120
+    os.utime(claimed_file, (old, old))
+    assert configure_queue.requeue_stale(queue_dir, lease_timeout=60, max_attempts=2) == 1
+    assert configure_queue.queue_status(queue_dir) == {'pending': 1, 'claimed': 0, 'done': 0, 'failed': 0}
+
+    # Once a job has been tried max_attempts times it fails
+    job, claimed_file = configure_queue.claim(queue_dir, 'dead-worker')
+    assert job['attempts'] == 1
+    os.utime(claimed_file, (old, old))
+    assert configure_queue.requeue_stale(queue_dir, lease_timeout=60, max_attempts=2) == 1
+    assert configure_queue.queue_status(queue_dir) == {'pending': 0, 'claimed': 0, 'done': 0, 'failed': 1}
+
+
+def test_job_of_killed_worker_is_requeued(tmp_path, monkeypatch):
+    queue_dir, output_dir = str(tmp_path / 'queue'), str(tmp_path / 'configured')
+    log_file = str(tmp_path / 'configure.log')
+    os.makedirs(output_dir)
+    output_file_list = configure_queue.enqueue(_write_fields(str(tmp_path / 'cleaned'), 1), queue_dir, output_dir)
+
+    worker = multiprocessing.Process(target=_run_worker_in_own_group, args=(
+        queue_dir, 1, {'MOCK_CONFIGURE_LOG': log_file, 'MOCK_CONFIGURE_SECONDS': '60'}))
+    worker.start()
+    deadline = time.time() + 30
+    while not (os.path.exists(log_file) and configure_queue.queue_status(queue_dir)['claimed'] == 1):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    os.killpg(worker.pid, signal.SIGKILL)
+    worker.join()
+
+    # The lease of the dead worker expires and another worker does the job
+    monkeypatch.setenv('MOCK_CONFIGURE_LOG', log_file)
+    configure_queue.run_worker(queue_dir, configure_path=MOCK_CONFIGURE, threads=1, lease_timeout=1,
+                               poll_interval=0.05)
+
+    assert configure_queue.queue_status(queue_dir) == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}
+    assert _configured_fields(log_file) == {'F00.xml': 2}
+    assert os.path.exists(output_file_list[0])
+    job = configure_queue._read_json(os.path.join(queue_dir, 'done', 'F00-configured.json'))
+    assert job['attempts'] == 1
@@ -0,0 +1,35 @@
+from swgworkflow import xmlio
+from swgworkflow.configure_simulator import simulate_field
+
+# Like the xmls of 04-cleaned, the targets have empty fibreid, configid, targx
+# and targy
+CLEANED_XML = """<?xml version="1.0"?>
+<root>
+  <observation name="F0" progtemp="11331.1+" obstemp="DACEB">
+    <configure plate="PLATE_A" max_sky="100" max_calibration="10" max_guide="8">
+      <hour_angle_limits earliest="-2.0" latest="2.5"/>
+    </configure>
+    <survey name="GA" max_fibres="1000"/>
+    <fields>
+      <field RA_d="10.0" Dec_d="40.0">
+        <target targsrvy="GA" targid="1" targra="10.01" targdec="40.01" targuse="T" targprio="10.0"
+                fibreid="" configid="" targx="" targy=""/>
+        <target targsrvy="GA" targid="2" targra="9.98" targdec="39.97" targuse="T" targprio="8.0"
+                fibreid="" configid="" targx="" targy=""/>
+      </field>
+    </fields>
+  </observation>
+</root>
+"""
+
+
+def test_simulate_field_with_empty_attributes(tmp_path):
+    xml_file = str(tmp_path / 'F0.xml')
+    with open(xml_file, 'w') as fd:
+        fd.write(CLEANED_XML)
+    output_file = simulate_field(xml_file, str(tmp_path / 'F0-configured.xml'))
+
+    targets = list(xmlio.parse(output_file).getroot().iter('target'))
+    fibres = [target.get('fibreid') for target in targets]
+    assert all(fibres)
+    assert len(set(fibres)) == len(targets)
@@ -0,0 +1,71 @@
+import collections
+import os
+
+from swgworkflow.configurefields import configure_fields_multistage
+
+MOCK_CONFIGURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_configure.py')
+
+FIELD_XML = """<root>
+ <observation name="{name}">
+  <fields>
+   <field RA_d="10.0" Dec_d="20.0">
+    <target targsrvy="S1" targid="1" targprio="10" targuse="T"/>
+    <target targsrvy="S1" targid="2" targprio="2" targuse="T"/>
+   </field>
+  </fields>
+ </observation>
+</root>
+"""
+
+
+def _write_fields(directory, n_fields):
+    os.makedirs(directory)
+    xml_file_list = []
+    for i in range(n_fields):
+        xml_file = os.path.join(directory, 'F{:02d}.xml'.format(i))
+        with open(xml_file, 'w') as fd:
+            fd.write(FIELD_XML.format(name='F{:02d}'.format(i)))
+        xml_file_list.append(xml_file)
+    return xml_file_list
+
+
+def _configure(xml_file_list, output_dir, log_file, monkeypatch, **kwargs):
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    monkeypatch.setenv('MOCK_CONFIGURE_LOG', log_file)
+    configure_fields_multistage(xml_file_list, output_dir, [5], configure_path=MOCK_CONFIGURE,
+                                threads=1, cost_model=None, **kwargs)
+    if not os.path.exists(log_file):
+        return collections.Counter()
+    with open(log_file) as fd:
+        return collections.Counter(line.strip() for line in fd)
+
+
+def test_multistage_resumes(tmp_path, monkeypatch):
+    xml_file_list = _write_fields(str(tmp_path / 'cleaned'), 2)
+    output_dir, log_file = str(tmp_path / 'configured'), str(tmp_path / 'configure.log')
+    os.makedirs(output_dir)
+
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=1).values()) == 4
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=1).values()) == 0
+
+
+def test_multistage_changed_settings_configure_again(tmp_path, monkeypatch):
+    xml_file_list = _write_fields(str(tmp_path / 'cleaned'), 2)
+    output_dir, log_file = str(tmp_path / 'configured'), str(tmp_path / 'configure.log')
+    os.makedirs(output_dir)
+
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=1).values()) == 4
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=2).values()) == 4
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=2,
+                          extra_configure_options='--foo').values()) == 4
+
+
+def test_multistage_adopts_outputs_without_manifest(tmp_path, monkeypatch):
+    xml_file_list = _write_fields(str(tmp_path / 'cleaned'), 2)
+    output_dir, log_file = str(tmp_path / 'configured'), str(tmp_path / 'configure.log')
+    os.makedirs(output_dir)
+
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=1).values()) == 4
+    os.remove(os.path.join(output_dir, 'multistage_manifest.json'))
+    assert sum(_configure(xml_file_list, output_dir, log_file, monkeypatch, seed=1).values()) == 0